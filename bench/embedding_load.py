@@ -0,0 +1,90 @@
+"""
+Синтетическая нагрузка на очередь микропакетов эмбеддингов.
+
+Запускает N конкурентных "пользователей", каждый из которых отправляет
+запросы на эмбеддинги (как rag.aquery - один короткий текст, как rag.ainsert -
+пакет чанков), и печатает пропускную способность и p95 задержки.
+
+Запуск из корня репозитория:
+    python -m bench.embedding_load --users 32 --requests 20
+    python -m bench.embedding_load --fake   # без модели, для проверки логики пакетирования
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+from moduls.embedding_service import BatchingEmbedder, _percentile
+
+_WORDS = ("документ контекст вопрос ответ таблица договор отчет раздел пункт "
+          "сумма срок сторона обязательство приложение страница данные").split()
+
+
+class FakeEmbeddingService:
+    """Имитация модели: время прохода пропорционально числу токенов с паддингом."""
+
+    def __init__(self, dim: int = 1024, seconds_per_token: float = 2e-6, overhead: float = 0.003):
+        self.dim = dim
+        self.seconds_per_token = seconds_per_token
+        self.overhead = overhead
+
+    def encode_sync(self, texts):
+        lengths = sorted(len(text.split()) for text in texts)
+        time.sleep(self.overhead + self.seconds_per_token * lengths[-1] * len(lengths))
+        return np.random.rand(len(texts), self.dim).astype(np.float32)
+
+
+def _random_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+async def _user(embedder, rng: random.Random, requests: int, latencies: list):
+    for _ in range(requests):
+        if rng.random() < 0.7:
+            texts = [_random_text(rng, 5, 30)]  # вопрос пользователя
+        else:
+            texts = [_random_text(rng, 100, 400) for _ in range(rng.randint(4, 16))]  # чанки документа
+        started = time.perf_counter()
+        await embedder.embed(texts)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(users: int, requests: int, fake: bool, seed: int) -> dict:
+    if fake:
+        service = FakeEmbeddingService()
+    else:
+        from moduls.embedding_service import EmbeddingService
+        service = EmbeddingService()
+        await service.load()
+    embedder = BatchingEmbedder(service)
+    latencies: list = []
+    started = time.perf_counter()
+    await asyncio.gather(*(_user(embedder, random.Random(seed + i), requests, latencies) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    await embedder.close()
+    return {
+        "users": users,
+        "requests": len(latencies),
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_p50": _percentile(latencies, 0.50),
+        "latency_p95": _percentile(latencies, 0.95),
+        "embedder": embedder.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--fake", action="store_true", help="использовать имитацию модели")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.users, args.requests, args.fake, args.seed)), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Локальная заглушка soffice для тестов DocConverterService без LibreOffice.
+
+Понимает те же аргументы, что использует moduls/doc_converter.py:
+    --terminate_after_init          - имитация прогрева профиля;
+    --convert-to docx --outdir DIR FILE
+                                    - создает DIR/<имя>.docx, где каждый
+                                      абзац исходного файла (текст в UTF-8
+                                      или CP1251) становится абзацем DOCX.
+Переменные окружения:
+    FAKE_SOFFICE_DELAY - задержка в секундах перед конвертацией;
+    FAKE_SOFFICE_FAIL  - если задана, конвертация завершается с кодом 1.
+
+Пример:
+    SOFFICE_BINARY="python -m bench.fake_soffice" python bot.py
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+
+def _read_text(path: Path) -> str:
+    raw = path.read_bytes()
+    for encoding in ("utf-8", "cp1251"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode("utf-8", errors="replace")
+
+
+def main(argv) -> int:
+    if "--terminate_after_init" in argv:
+        return 0
+    if "--convert-to" not in argv or "--outdir" not in argv:
+        print("fake_soffice: unsupported arguments", file=sys.stderr)
+        return 2
+
+    time.sleep(float(os.getenv("FAKE_SOFFICE_DELAY", "0")))
+    if os.getenv("FAKE_SOFFICE_FAIL"):
+        print("fake_soffice: forced failure", file=sys.stderr)
+        return 1
+
+    import docx
+
+    out_dir = Path(argv[argv.index("--outdir") + 1])
+    source = Path(argv[-1])
+    document = docx.Document()
+    for paragraph in _read_text(source).split("\n\n"):
+        document.add_paragraph(paragraph.strip())
+    document.save(str(out_dir / (source.stem + ".docx")))
+    print(f"convert {source} -> {out_dir / (source.stem + '.docx')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
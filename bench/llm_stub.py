@@ -0,0 +1,394 @@
+"""
+Локальная заглушка OpenAI-совместимого LLM для бенчмарков и нагрузочных
+тестов без сети и без оплаты провайдеру.
+
+Отвечает на POST /v1/chat/completions (обычный и потоковый режим) так, чтобы
+конвейер LightRAG работал как с настоящей моделью:
+  * извлечение сущностей - сущности из слов текста с заглавной буквы и связи
+    между соседними сущностями в формате LightRAG;
+  * дополнительные проходы извлечения - пустой результат, "есть ли еще
+    сущности" - NO;
+  * ключевые слова запроса - JSON high_level/low_level_keywords;
+  * объединение описаний сущности - первые описания из списка;
+  * ответ на вопрос - текст из найденного контекста (системный промпт).
+Ответы детерминированы: одинаковый запрос - одинаковый ответ. В usage
+возвращается оценка числа токенов (4 символа на токен).
+
+Время ответа моделируется как у провайдера:
+  * --latency - задержка до первого токена, миллисекунды: fixed:300,
+    uniform:100:500, normal:300:80 (среднее, отклонение) или
+    lognormal:300:0.5 (медиана, sigma); случайные значения воспроизводимы
+    (--seed);
+  * --tokens-per-second - скорость генерации: потоковый ответ выдается
+    фрагментами с этой скоростью, обычный - после генерации всего текста.
+
+Записанные ответы:
+  * --record FILE --upstream URL - прокси к настоящему провайдеру (ключ -
+    --upstream-key или заголовок Authorization запроса), ответы пишутся в
+    JSONL; потоковые запросы провайдеру отправляются обычными, клиент
+    получает поток от заглушки;
+  * --replay FILE - ответы из записи по хэшу модели и сообщений, для
+    незаписанных запросов - синтетический ответ (replay_misses в stats()).
+
+Запуск из корня репозитория (LLM_BASE_URL=http://127.0.0.1:8001/v1):
+    python -m bench.llm_stub --port 8001 --latency lognormal:400:0.6 --tokens-per-second 60
+    python -m bench.llm_stub --upstream https://api.provider/v1 --record llm.jsonl
+    python -m bench.llm_stub --replay llm.jsonl --latency fixed:300
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import re
+import socket
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, web
+
+KIND_EXTRACT = "extract"
+KIND_CONTINUE = "continue"
+KIND_LOOP = "loop"
+KIND_KEYWORDS = "keywords"
+KIND_SUMMARY = "summary"
+KIND_ANSWER = "answer"
+
+_MAX_ENTITIES = 6
+_ANSWER_WORDS = 60
+_WORD = re.compile(r"\w+")
+_SAMPLES = 10000
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _section(text: str, start: str, end: str) -> str:
+    begin = text.rfind(start)
+    if begin < 0:
+        return ""
+    begin += len(start)
+    finish = text.find(end, begin)
+    return text[begin:finish if finish >= 0 else len(text)]
+
+
+def capitalized_names(text: str, limit: int) -> List[str]:
+    """Самые частые слова с заглавной буквы (кандидаты в сущности)."""
+    counts = Counter(word for word in _WORD.findall(text) if word[:1].isupper() and len(word) > 3)
+    return [word for word, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+
+def _extraction(text: str) -> str:
+    names = capitalized_names(text, _MAX_ENTITIES)
+    records = [f'("entity"<|>"{name}"<|>"category"<|>"{name} упоминается в тексте.")' for name in names]
+    records.extend(f'("relationship"<|>"{source}"<|>"{target}"<|>"{source} и {target} упоминаются вместе."'
+                   f'<|>"упоминание"<|>0.5)' for source, target in zip(names, names[1:]))
+    return "##".join(records) + "<|COMPLETE|>"
+
+
+def classify(messages: List[dict]) -> str:
+    """Вид запроса LightRAG по последнему сообщению."""
+    prompt = messages[-1].get("content") or "" if messages else ""
+    if "---Real Data---" in prompt and "Entity_types:" in prompt:
+        return KIND_EXTRACT
+    if "entities and relationships were missed" in prompt:
+        return KIND_CONTINUE
+    if "Answer ONLY by `YES` OR `NO`" in prompt:
+        return KIND_LOOP
+    if "high_level_keywords" in prompt:
+        return KIND_KEYWORDS
+    if "Description List:" in prompt:
+        return KIND_SUMMARY
+    return KIND_ANSWER
+
+
+def respond(messages: List[dict]) -> Tuple[str, str]:
+    """Вид запроса LightRAG и синтетический ответ на него."""
+    kind = classify(messages)
+    prompt = messages[-1].get("content") or "" if messages else ""
+    if kind == KIND_EXTRACT:
+        return kind, _extraction(_section(prompt, "Text:\n", "\n######################\nOutput:"))
+    if kind == KIND_CONTINUE:
+        return kind, "<|COMPLETE|>"
+    if kind == KIND_LOOP:
+        return kind, "NO"
+    if kind == KIND_KEYWORDS:
+        query = _section(prompt, "Current Query:", "\n######")
+        names = capitalized_names(query, 3) or _WORD.findall(query)[:3]
+        return kind, json.dumps({"high_level_keywords": names[:1], "low_level_keywords": names}, ensure_ascii=False)
+    if kind == KIND_SUMMARY:
+        descriptions = _section(prompt, "Description List:", "\n#######")
+        return kind, descriptions.strip()[:300] or "Описание отсутствует."
+    system = " ".join(message.get("content") or "" for message in messages[:-1] if message.get("role") == "system")
+    words = _WORD.findall(system)[-_ANSWER_WORDS:] or _WORD.findall(prompt)[:_ANSWER_WORDS]
+    return kind, "По данным контекста: " + " ".join(words) + "."
+
+
+def request_key(body: dict) -> str:
+    """Ключ записанного ответа: модель и сообщения запроса."""
+    payload = json.dumps({"model": body.get("model"), "messages": body.get("messages")}, sort_keys=True,
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LatencyModel:
+    """Распределение задержки до первого токена (спецификация в миллисекундах, см. описание модуля)."""
+
+    def __init__(self, spec: str = "fixed:0", seed: int = 0):
+        self.spec = spec
+        name, *params = spec.split(":")
+        self.name = name
+        self.params = [float(param) for param in params]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if expected.get(name) != len(self.params):
+            raise ValueError(f"Bad latency spec {spec!r}: expected fixed:MS, uniform:MIN:MAX, "
+                             f"normal:MEAN:STD or lognormal:MEDIAN:SIGMA")
+        self._rng = random.Random(seed)
+
+    def sample(self) -> float:
+        """Задержка в секундах."""
+        if self.name == "fixed":
+            value = self.params[0]
+        elif self.name == "uniform":
+            value = self._rng.uniform(*self.params)
+        elif self.name == "normal":
+            value = self._rng.gauss(*self.params)
+        else:
+            value = self._rng.lognormvariate(math.log(max(self.params[0], 1e-9)), self.params[1])
+        return max(0.0, value) / 1000
+
+
+def _chunk(text: str) -> bytes:
+    payload = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": "stub",
+               "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class LLMStub:
+    """aiohttp-приложение заглушки и счетчики вызовов по видам запросов."""
+
+    def __init__(self, latency: str = "fixed:0", tokens_per_second: float = 0.0, seed: int = 0,
+                 replay: Optional[str] = None, record: Optional[str] = None, upstream: Optional[str] = None,
+                 upstream_key: Optional[str] = None):
+        self.latency = LatencyModel(latency, seed)
+        self.tokens_per_second = tokens_per_second
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.upstream_key = upstream_key
+        self.calls: Counter = Counter()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.replay_hits = 0
+        self.replay_misses = 0
+        self.recorded = 0
+        self._durations: List[float] = []
+        self._recorded: Dict[str, dict] = {}
+        if replay:
+            with open(replay, encoding="utf-8") as replay_file:
+                for line in replay_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._recorded[entry["key"]] = entry
+        self._record_file = open(record, "a", encoding="utf-8", buffering=1) if record else None
+        self._session: Optional[ClientSession] = None
+
+    async def _from_upstream(self, request: web.Request, body: dict) -> Tuple[str, dict]:
+        if self._session is None:
+            self._session = ClientSession()
+        headers = {"Authorization": f"Bearer {self.upstream_key}" if self.upstream_key
+                   else request.headers.get("Authorization", "")}
+        async with self._session.post(f"{self.upstream}/chat/completions", json={**body, "stream": False},
+                                      headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data["choices"][0]["message"]["content"], data.get("usage") or {}
+
+    async def _answer(self, request: web.Request, body: dict) -> Tuple[str, str, Optional[dict]]:
+        """Вид запроса, текст ответа и usage (для синтетических ответов - None)."""
+        messages = body.get("messages") or []
+        if self.upstream:
+            content, usage = await self._from_upstream(request, body)
+            kind = classify(messages)
+            if self._record_file is not None:
+                self._record_file.write(json.dumps({"key": request_key(body), "kind": kind, "content": content,
+                                                    "usage": usage}, ensure_ascii=False) + "\n")
+                self.recorded += 1
+            return kind, content, usage
+        if self._recorded:
+            entry = self._recorded.get(request_key(body))
+            if entry is not None:
+                self.replay_hits += 1
+                return entry["kind"], entry["content"], entry.get("usage")
+            self.replay_misses += 1
+        kind, content = respond(messages)
+        return kind, content, None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        started = time.perf_counter()
+        body = await request.json()
+        messages = body.get("messages") or []
+        kind, text, usage = await self._answer(request, body)
+        self.calls[kind] += 1
+        prompt_tokens = (usage or {}).get("prompt_tokens") or sum(
+            estimate_tokens(message.get("content") or "") for message in messages)
+        completion_tokens = (usage or {}).get("completion_tokens") or estimate_tokens(text)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        # Задержки моделируются и поверх записанных ответов; ответы провайдера отдаются сразу
+        first_token = 0.0 if self.upstream else self.latency.sample()
+        rate = 0.0 if self.upstream else self.tokens_per_second
+        if not body.get("stream"):
+            await asyncio.sleep(first_token + (completion_tokens / rate if rate else 0.0))
+            self._finished(started)
+            return web.json_response({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}})
+        await asyncio.sleep(first_token)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in re.findall(r"\S+\s*", text):
+            if rate:
+                await asyncio.sleep(estimate_tokens(word) / rate)
+            await response.write(_chunk(word))
+        await response.write(b"data: [DONE]\n\n")
+        self._finished(started)
+        return response
+
+    def _finished(self, started: float):
+        if len(self._durations) < _SAMPLES:
+            self._durations.append(time.perf_counter() - started)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 2 ** 20)
+        app.router.add_post("/v1/chat/completions", self.handle)
+        app.router.add_post("/chat/completions", self.handle)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def _close(self, app: web.Application):
+        if self._session is not None:
+            await self._session.close()
+        if self._record_file is not None:
+            self._record_file.close()
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "response_p50_ms": (_percentile(self._durations, 0.5) or 0) * 1000,
+            "response_p95_ms": (_percentile(self._durations, 0.95) or 0) * 1000,
+            "replay_hits": self.replay_hits,
+            "replay_misses": self.replay_misses,
+            "recorded": self.recorded,
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def _serve(port: int, connection=None, **options):
+    stub = LLMStub(**options)
+    runner = web.AppRunner(stub.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    if connection is None:
+        print(f"LLM stub: http://127.0.0.1:{port}/v1")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+    connection.send("ready")
+    # Команда остановки от бенчмарка; в ответ - счетчики вызовов
+    await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+    await runner.cleanup()
+    connection.send(stub.stats())
+
+
+def serve_process(port: int, connection, options: dict):
+    """Точка входа отдельного процесса заглушки (multiprocessing, связь через Pipe)."""
+    asyncio.run(_serve(port, connection, **options))
+
+
+def start_process(options: dict, timeout: float = 60.0):
+    """
+    Запускает заглушку в отдельном процессе (spawn) и ждет ее готовности;
+    возвращает процесс, конец Pipe для команды остановки и порт.
+    """
+    context = multiprocessing.get_context("spawn")
+    connection, stub_connection = context.Pipe()
+    port = free_port()
+    process = context.Process(target=serve_process, args=(port, stub_connection, options))
+    process.start()
+    deadline = time.monotonic() + timeout
+    # Заглушка, упавшая при запуске (неверные параметры, занятый порт), "ready" не пришлет никогда
+    while not connection.poll(0.1):
+        if not process.is_alive() or time.monotonic() > deadline:
+            process.kill()
+            process.join()
+            raise RuntimeError(f"LLM stub failed to start (exit code {process.exitcode}), options: {options}")
+    connection.recv()
+    return process, connection, port
+
+
+def latency_spec(spec: str) -> str:
+    """Проверка спецификации задержки при разборе аргументов, а не при запуске процесса заглушки."""
+    try:
+        LatencyModel(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
+
+
+def add_arguments(parser: argparse.ArgumentParser, prefix: str = ""):
+    """Параметры заглушки в командной строке (prefix - для бенчмарков, запускающих заглушку)."""
+    parser.add_argument(f"--{prefix}latency", type=latency_spec, default="fixed:0",
+                        help="задержка до первого токена, мс")
+    parser.add_argument(f"--{prefix}tokens-per-second", type=float, default=0.0,
+                        help="скорость генерации (0 - без задержки)")
+    parser.add_argument(f"--{prefix}seed", type=int, default=0)
+    parser.add_argument(f"--{prefix}replay", help="JSONL с записанными ответами")
+
+
+def options_from(args: argparse.Namespace, prefix: str = "") -> dict:
+    attribute = prefix.replace("-", "_")
+    return {"latency": getattr(args, f"{attribute}latency"),
+            "tokens_per_second": getattr(args, f"{attribute}tokens_per_second"),
+            "seed": getattr(args, f"{attribute}seed"),
+            "replay": getattr(args, f"{attribute}replay")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    add_arguments(parser)
+    parser.add_argument("--record", help="JSONL для записи ответов провайдера (с --upstream)")
+    parser.add_argument("--upstream", help="URL OpenAI-совместимого провайдера для записи")
+    parser.add_argument("--upstream-key", help="ключ API провайдера (по умолчанию - из запроса)")
+    args = parser.parse_args()
+    if args.record and not args.upstream:
+        parser.error("--record requires --upstream")
+    try:
+        asyncio.run(_serve(args.port, record=args.record, upstream=args.upstream, upstream_key=args.upstream_key,
+                           **options_from(args)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
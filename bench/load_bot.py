@@ -0,0 +1,436 @@
+"""
+Нагрузочный стенд бота: синтетические пользователи задают вопросы через
+настоящие обработчики aiogram, стенд ищет точку насыщения на одной машине.
+
+Стенд поднимает на одной машине:
+  * заглушку LLM bench/llm_stub.py в отдельном процессе (--llm-latency,
+    --llm-tokens-per-second, --llm-replay - время и содержание ответов);
+  * заглушку Bot API из bench/replay_updates.py в отдельном процессе;
+  * webhook.serve (webhook.py) с --workers воркерами и диспетчером бота
+    (bot.create_dispatcher); эмбеддинги - хэширующий эмбеддер на CPU, как в
+    bench/pipeline.py.
+Контекст "bench" загружается один раз из документов (по умолчанию PDF и
+DOCX из test_data/) и копируется каждому из --users пользователей; в
+хранилище FSM пользователи уже выбрали контекст и находятся в режиме
+вопросов. Все данные - во временной директории, репозиторий не меняется.
+
+Нагрузка - ступени с частотой вопросов из --rates (вопросов в секунду на
+всех пользователей) длительностью --duration секунд: вопросы приходят по
+расписанию (открытая модель, --arrival poisson или fixed) от случайных
+пользователей, каждый пользователь отправляет свои сообщения по порядку,
+как Telegram. Перед ступенями каждый пользователь задает вопрос прогрева
+(открытие RAG и импорт LightRAG в воркере не входят в замер; --no-warm-up -
+холодный старт). Вопросы разные (кэш ответов не срабатывает), режимы поиска -
+по кругу из --modes. После ступени стенд ждет ответов на все вопросы
+ступени (не дольше --drain-timeout).
+
+Вопрос завершен, когда бот прислал "Введите следующий вопрос..." (ответ
+или ошибка RAG) или отказал из-за перегрузки ("Сейчас слишком много
+запросов"). По каждой ступени - задержка вопрос -> завершение (p50/p95/p99),
+пропускная способность, отказы и ошибки. Ступень выдержана, если
+отказов и ошибок нет, пропускная способность не ниже 90% фактической частоты и
+p95 не больше --slo-ms; точка насыщения - частота последней выдержанной
+ступени. Следующие ступени после первой невыдержанной не запускаются.
+
+Результат - JSON в --output (по умолчанию bench/results/load-<время>.json).
+Нужен config.py (адрес LLM и директория контекстов подменяются).
+
+Запуск из корня репозитория:
+    python -m bench.load_bot --users 20 --rates 0.5 1 2 4 --duration 30 --llm-latency lognormal:800:0.5
+    python -m bench.load_bot --workers 2 --rates 2 4 8 --llm-replay llm.jsonl --llm-tokens-per-second 40
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession
+
+from aiogram import Dispatcher
+
+from bench import llm_stub
+from bench.pipeline import make_questions, run_child, setup_offline_pipeline
+from bench.replay_updates import replies, stub_main, wait_for_workers
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TEST_DATA_DIR = os.path.join(_REPO_DIR, "test_data")
+_RESULTS_DIR = os.path.join(_REPO_DIR, "bench", "results")
+_TOKEN = "123456:load-bench-token"
+_BOT_ID = 123456
+_CONTEXT = "bench"
+_FIRST_USER_ID = 5000
+
+# Сообщения бота, которыми заканчивается обработка вопроса (handlers/question.py)
+_DONE = "Введите следующий вопрос"
+_REJECTED = "😔 Сейчас слишком много запросов"
+_FAILED = ("❌", "😕")
+# Ошибка открытия RAG: вопрос завершен, режим вопросов сброшен
+_CANCELLED = "Запрос отменен."
+
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_REJECTED = "rejected"
+# Номер "ступени" вопросов прогрева
+WARM_UP = -1
+
+
+# --- Диспетчер (выполняется в воркерах) ---
+
+def create_load_dispatcher() -> Dispatcher:
+    """Диспетчер бота с директорией контекстов стенда, заглушкой LLM и хэширующим эмбеддером."""
+    import config
+
+    # До импорта обработчиков: они читают BASE_STORAGE_DIR при импорте
+    config.BASE_STORAGE_DIR = os.environ["LOAD_STORAGE_DIR"]
+    setup_offline_pipeline(os.environ["LOAD_LLM_URL"])
+    from bot import create_dispatcher
+    return create_dispatcher()
+
+
+# --- Подготовка ---
+
+async def _seed_users(db_path: str, user_ids: List[int]):
+    """Пользователи уже выбрали контекст стенда и задают вопросы."""
+    from aiogram.fsm.storage.base import StorageKey
+
+    from moduls.fsm_storage import SqliteStorage
+
+    storage = SqliteStorage(db_path)
+    for user_id in user_ids:
+        key = StorageKey(bot_id=_BOT_ID, chat_id=user_id, user_id=user_id)
+        await storage.set_data(key, {"current_context": _CONTEXT})
+        # Имя состояния QuestionStates.asking_questions_in_context
+        await storage.set_state(key, "QuestionStates:asking_questions_in_context")
+    await storage.close()
+
+
+def _prepare(work_dir: str, files: List[str], users: int, llm_url: str) -> dict:
+    """Загружает контекст-образец и раздает его копии пользователям; возвращает замер загрузки."""
+    template = os.path.join(work_dir, "template")
+    ingest = run_child("ingest", {"storage_dir": os.path.join(template, "storage"),
+                                  "text_dir": os.path.join(template, "text"), "files": files,
+                                  "llm_url": llm_url}, work_dir)
+    user_ids = [_FIRST_USER_ID + index for index in range(users)]
+    for user_id in user_ids:
+        shutil.copytree(os.path.join(template, "storage"),
+                        os.path.join(work_dir, "contexts", str(user_id), _CONTEXT, "storage"))
+    asyncio.run(_seed_users(os.environ["FSM_STORAGE_DB"], user_ids))
+    return ingest
+
+
+# --- Нагрузка ---
+
+def _update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user, "text": text}}
+
+
+def _arrivals(rate: float, duration: float, arrival: str, rng: random.Random) -> List[float]:
+    """Моменты прихода вопросов ступени, секунды от ее начала."""
+    if arrival == "fixed":
+        return [index / rate for index in range(int(duration * rate))]
+    moments, at = [], rng.expovariate(rate)
+    while at < duration:
+        moments.append(at)
+        at += rng.expovariate(rate)
+    return moments
+
+
+def outcomes(calls: list) -> Dict[int, List[tuple]]:
+    """Завершения вопросов по чатам в порядке отправки: (время, OUTCOME_*)."""
+    finished, failed = defaultdict(list), set()
+    for at, chat_id, text in replies(calls):
+        if text.startswith(_FAILED):
+            failed.add(chat_id)
+        elif text.startswith(_REJECTED):
+            finished[chat_id].append((at, OUTCOME_REJECTED))
+        elif text.startswith(_CANCELLED):
+            finished[chat_id].append((at, OUTCOME_ERROR))
+            failed.discard(chat_id)
+        elif text.startswith(_DONE):
+            finished[chat_id].append((at, OUTCOME_ERROR if chat_id in failed else OUTCOME_OK))
+            failed.discard(chat_id)
+    return finished
+
+
+class LoadGenerator:
+    """Отправляет вопросы пользователей на вебхук по расписанию ступеней и считает завершения."""
+
+    def __init__(self, webhook_url: str, api_connection, user_ids: List[int], questions: List[str],
+                 modes: List[str], arrival: str, seed: int):
+        self.webhook_url = webhook_url
+        self.api_connection = api_connection
+        self.user_ids = user_ids
+        self.questions = questions
+        self.modes = modes
+        self.arrival = arrival
+        self._rng = random.Random(seed)
+        self._locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._update_id = 0
+        # Отправленные вопросы по чатам в порядке отправки: (время, номер ступени)
+        self.sent: Dict[int, List[tuple]] = defaultdict(list)
+        self.post_errors = 0
+
+    def _next_question(self) -> str:
+        self._update_id += 1
+        question = self.questions[(self._update_id - 1) % len(self.questions)]
+        # Номер делает вопрос уникальным и при повторе списка вопросов
+        return f"{question} #{self._update_id} | {self.modes[(self._update_id - 1) % len(self.modes)]}"
+
+    async def _post(self, session: ClientSession, step: int, at: float, user_id: int, text: str, update_id: int):
+        await asyncio.sleep(max(0.0, at - time.perf_counter()))
+        # Сообщения одного пользователя - по порядку, как их доставляет Telegram
+        async with self._locks[user_id]:
+            self.sent[user_id].append((time.time(), step))
+            try:
+                async with session.post(self.webhook_url, json=_update(update_id, user_id, text)) as response:
+                    if response.status != 200:
+                        raise RuntimeError(f"Webhook answered {response.status}")
+            except Exception as e:
+                logging.warning(f"Load: update {update_id} was not delivered: {e!r}")
+                self.sent[user_id].pop()
+                self.post_errors += 1
+
+    async def run_step(self, session: ClientSession, step: int, rate: float, duration: float) -> int:
+        """Отправляет вопросы ступени; возвращает их число."""
+        started = time.perf_counter()
+        posts = []
+        for at in _arrivals(rate, duration, self.arrival, self._rng):
+            text = self._next_question()
+            posts.append(self._post(session, step, started + at, self._rng.choice(self.user_ids), text,
+                                    self._update_id))
+        await asyncio.gather(*posts)
+        return len(posts)
+
+    async def warm_up(self, session: ClientSession) -> int:
+        """По вопросу от каждого пользователя вне ступеней: открытие RAG и импорт LightRAG не входят в замер."""
+        started = time.perf_counter()
+        posts = []
+        for user_id in self.user_ids:
+            text = self._next_question()
+            posts.append(self._post(session, WARM_UP, started, user_id, text, self._update_id))
+        await asyncio.gather(*posts)
+        return len(posts)
+
+    async def calls(self, command: str = "calls") -> list:
+        """Вызовы Bot API из процесса заглушки (после "stop" заглушка останавливается)."""
+        loop = asyncio.get_running_loop()
+        self.api_connection.send(command)
+        return await loop.run_in_executor(None, self.api_connection.recv)
+
+    async def drain(self, timeout: float) -> float:
+        """Ждет завершения всех отправленных вопросов; возвращает время ожидания."""
+        started = time.perf_counter()
+        expected = sum(len(sent) for sent in self.sent.values())
+        while time.perf_counter() - started < timeout:
+            finished = outcomes(await self.calls())
+            if sum(min(len(finished[chat]), len(sent)) for chat, sent in self.sent.items()) >= expected:
+                break
+            await asyncio.sleep(0.5)
+        return time.perf_counter() - started
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def step_results(sent: Dict[int, List[tuple]], calls: list, rates: List[float], starts: List[float],
+                 duration: float) -> List[dict]:
+    """Показатели ступеней: k-е завершение в чате относится к k-му вопросу этого чата."""
+    finished = outcomes(calls)
+    per_step = [{"latencies": [], OUTCOME_OK: 0, OUTCOME_ERROR: 0, OUTCOME_REJECTED: 0, "posted": 0,
+                 "last_finish": None} for _ in rates]
+    for chat_id, chat_sent in sent.items():
+        chat_finished = finished[chat_id]
+        for index, (posted_at, step) in enumerate(chat_sent):
+            if step == WARM_UP:
+                continue
+            data = per_step[step]
+            data["posted"] += 1
+            if index >= len(chat_finished):
+                continue
+            at, outcome = chat_finished[index]
+            data[outcome] += 1
+            if outcome == OUTCOME_OK:
+                data["latencies"].append(at - posted_at)
+                data["last_finish"] = max(data["last_finish"] or at, at)
+    results = []
+    for rate, started, data in zip(rates, starts, per_step):
+        latencies = data["latencies"]
+        elapsed = (data["last_finish"] - started) if data["last_finish"] else None
+        results.append({
+            "rate_per_s": rate,
+            "posted": data["posted"],
+            # Фактическая частота: при приходе по Пуассону отличается от заданной
+            "offered_per_s": data["posted"] / duration,
+            "answered": data[OUTCOME_OK],
+            "errors": data[OUTCOME_ERROR],
+            "rejected": data[OUTCOME_REJECTED],
+            "unfinished": data["posted"] - data[OUTCOME_OK] - data[OUTCOME_ERROR] - data[OUTCOME_REJECTED],
+            "throughput_per_s": data[OUTCOME_OK] / elapsed if elapsed else 0.0,
+            "latency_p50_ms": (_percentile(latencies, 0.5) or 0) * 1000,
+            "latency_p95_ms": (_percentile(latencies, 0.95) or 0) * 1000,
+            "latency_p99_ms": (_percentile(latencies, 0.99) or 0) * 1000,
+        })
+    return results
+
+
+def sustained(step: dict, slo_ms: float) -> bool:
+    return (step["posted"] > 0 and not step["errors"] and not step["rejected"] and not step["unfinished"]
+            and step["throughput_per_s"] >= 0.9 * step["offered_per_s"] and step["latency_p95_ms"] <= slo_ms)
+
+
+async def _load(args, questions: List[str]) -> dict:
+    import webhook
+
+    context = multiprocessing.get_context("spawn")
+    connection, api_connection = context.Pipe()
+    api_port = llm_stub.free_port()
+    api = context.Process(target=stub_main, args=(api_port, api_connection))
+    api.start()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, connection.recv)
+
+    port = llm_stub.free_port()
+    stop = asyncio.Event()
+    server = asyncio.create_task(webhook.serve(
+        host="127.0.0.1", port=port, workers=args.workers, factory_path="bench.load_bot:create_load_dispatcher",
+        token=_TOKEN, api_url=f"http://127.0.0.1:{api_port}", secret="", drain_timeout=args.drain_timeout,
+        stop=stop))
+    user_ids = [_FIRST_USER_ID + index for index in range(args.users)]
+    generator = LoadGenerator(f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}", connection, user_ids, questions,
+                              args.modes, args.arrival, args.llm_seed)
+    rates, starts, drains, warm_up_seconds = [], [], [], None
+    try:
+        await wait_for_workers(port, args.workers, server)
+        async with ClientSession() as session:
+            if args.warm_up:
+                await generator.warm_up(session)
+                warm_up_seconds = await generator.drain(args.drain_timeout)
+            for step, rate in enumerate(args.rates):
+                rates.append(rate)
+                starts.append(time.time())
+                posted = await generator.run_step(session, step, rate, args.duration)
+                drains.append(await generator.drain(args.drain_timeout))
+                result = step_results(generator.sent, await generator.calls(), rates, starts, args.duration)[-1]
+                print(f"Ступень {rate}/с: вопросов {posted}, ответов {result['answered']}, "
+                      f"{result['throughput_per_s']:.2f}/с, p95 {result['latency_p95_ms']:.0f} мс, "
+                      f"отказов {result['rejected']}", file=sys.stderr)
+                if not sustained(result, args.slo_ms):
+                    break
+    finally:
+        stop.set()
+        front = await server
+        calls = await generator.calls("stop")
+        api.join()
+    steps = step_results(generator.sent, calls, rates, starts, args.duration)
+    for step, drain_seconds in zip(steps, drains):
+        step["drain_seconds"] = drain_seconds
+        step["sustained"] = sustained(step, args.slo_ms)
+    saturation = None
+    for step in steps:
+        if not step["sustained"]:
+            break
+        saturation = step["rate_per_s"]
+    return {"warm_up_seconds": warm_up_seconds, "steps": steps, "saturation_rate_per_s": saturation,
+            "post_errors": generator.post_errors,
+            "front": front}
+
+
+def run(args) -> dict:
+    # Загрузка выполняется в дочернем процессе с рабочей директорией work_dir: пути - абсолютные
+    files = [os.path.abspath(path) for path in args.files] or sorted(path for path in glob.glob(os.path.join(_TEST_DATA_DIR, "*"))
+                                 if os.path.splitext(path)[1].lower() in (".pdf", ".docx"))
+    result = {"environment": {
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "cpu_count": os.cpu_count(),
+        "users": args.users,
+        "workers": args.workers,
+        "rates": args.rates,
+        "duration_seconds": args.duration,
+        "arrival": args.arrival,
+        "modes": args.modes,
+        "slo_ms": args.slo_ms,
+        "documents": [os.path.basename(path) for path in files],
+        "llm_stub": llm_stub.options_from(args, "llm-"),
+    }}
+    work_dir = tempfile.mkdtemp(prefix="load_bench_")
+    stub, connection, port = llm_stub.start_process(llm_stub.options_from(args, "llm-"))
+    cwd = os.getcwd()
+    llm_url = f"http://127.0.0.1:{port}/v1"
+    # Воркеры webhook запускаются через spawn и наследуют окружение и рабочую директорию:
+    # data/ и lightrag.log бота остаются во временной директории
+    os.environ.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [_REPO_DIR, os.environ.get("PYTHONPATH")])),
+        "LOAD_STORAGE_DIR": os.path.join(work_dir, "contexts"),
+        "LOAD_LLM_URL": llm_url,
+        "FSM_STORAGE": "sqlite",
+        "FSM_STORAGE_DB": os.path.join(work_dir, "data", "fsm.sqlite3"),
+        "INGEST_QUEUE_DB": os.path.join(work_dir, "data", "ingest_queue.sqlite3"),
+        "EMBED_PRELOAD": "0",
+        "EMBED_CACHE_ENABLED": "0",
+    })
+    os.environ.setdefault("COSINE_THRESHOLD", "0.02")
+    try:
+        result["ingest"] = _prepare(work_dir, files, args.users, llm_url)
+        os.chdir(work_dir)
+        questions = make_questions(os.path.join(work_dir, "template", "text"), 50)
+        result.update(asyncio.run(_load(args, questions)))
+    finally:
+        os.chdir(cwd)
+        connection.send("stop")
+        result["llm_stub"] = connection.recv()
+        stub.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="документы контекста (по умолчанию PDF и DOCX из test_data/)")
+    parser.add_argument("--users", type=int, default=20, help="синтетических пользователей")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров webhook")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.5, 1, 2, 4, 8],
+                        help="частоты вопросов по ступеням, в секунду")
+    parser.add_argument("--duration", type=float, default=30.0, help="длительность ступени, секунды")
+    parser.add_argument("--arrival", choices=("poisson", "fixed"), default="poisson")
+    parser.add_argument("--modes", nargs="+", default=["hybrid"], help="режимы поиска (VALID_QUERY_MODES)")
+    parser.add_argument("--slo-ms", type=float, default=10000.0, help="допустимая p95 задержка ответа")
+    parser.add_argument("--no-warm-up", dest="warm_up", action="store_false",
+                        help="без вопроса прогрева от каждого пользователя перед ступенями")
+    parser.add_argument("--drain-timeout", type=float, default=120.0,
+                        help="ожидание ответов после ступени, секунды")
+    llm_stub.add_arguments(parser, "llm-")
+    parser.add_argument("--output", help="файл результата (по умолчанию bench/results/load-<время>.json)")
+    args = parser.parse_args()
+
+    result = run(args)
+    output = args.output or os.path.join(
+        _RESULTS_DIR, f"load-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(result, output_file, indent=2, ensure_ascii=False)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    print(f"Результат: {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
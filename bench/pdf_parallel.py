@@ -0,0 +1,71 @@
+"""
+Бенчмарк постраничного параллельного разбора PDF.
+
+Для каждого PDF из test_data/ (или переданных путей) замеряет время
+extract_markdown_from_pdf_with_tables при разном числе процессов, считает
+ускорение относительно последовательного режима и проверяет, что результат
+побайтно совпадает с последовательным.
+
+Запуск из корня репозитория:
+    python -m bench.pdf_parallel
+    python -m bench.pdf_parallel --workers 1 2 4 8 --repeat 3 path/to/report.pdf
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+
+from moduls import extract_text
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data")
+
+
+def bench_file(pdf_path: str, workers_list, repeat: int) -> dict:
+    # Параллельный режим должен включаться на любом документе из набора
+    extract_text.PDF_PARALLEL_MIN_PAGES = 1
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    reference = None
+    results = []
+    for workers in workers_list:
+        timings = []
+        output = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            output = extract_text.extract_markdown_from_pdf_with_tables(pdf_path, workers=workers)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        if reference is None:
+            reference = (output, best)
+        results.append({
+            "workers": workers,
+            "seconds": best,
+            "pages_per_second": page_count / best if best else None,
+            "speedup": reference[1] / best if best else None,
+            "identical_to_serial": output == reference[0],
+        })
+    return {"file": os.path.basename(pdf_path), "pages": page_count, "runs": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="PDF-файлы (по умолчанию все PDF из test_data/)")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    workers_list = [1] + [w for w in args.workers if w != 1]
+    paths = args.paths or sorted(glob.glob(os.path.join(_TEST_DATA_DIR, "*.pdf")))
+    report = {"cpu_count": os.cpu_count(), "files": [bench_file(path, workers_list, args.repeat) for path in paths]}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
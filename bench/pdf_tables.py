@@ -0,0 +1,138 @@
+"""
+Проверка и бенчмарк раскладки текстовых блоков и таблиц на странице PDF.
+
+Сравнивает _layout_page_elements (заметание по y) с эталонной квадратичной
+реализацией, которая использовалась раньше (проверка каждого блока против
+каждой таблицы и пересканирование списка таблиц на каждом блоке):
+  * на реальных страницах PDF из test_data/ - результат должен совпадать;
+  * на синтетических плотных страницах (десятки таблиц, тысячи блоков) -
+    совпадение и время обеих реализаций.
+
+Запуск из корня репозитория:
+    python -m bench.pdf_tables
+    python -m bench.pdf_tables --tables 80 --blocks 4000 --pages 20
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import time
+
+import fitz
+
+from moduls import extract_text
+from moduls.extract_text import _is_block_inside_bbox, _layout_page_elements
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data")
+
+
+def reference_layout(blocks, table_bboxes, rendered_tables):
+    """Прежний алгоритм раскладки (до перехода на заметание), без изменений по смыслу."""
+    page_elements = []
+    table_insertion_points = {idx: table_bboxes[idx].y0 for idx in rendered_tables}
+    sorted_table_indices = sorted(table_insertion_points, key=table_insertion_points.get)
+    yielded_tables = {idx: False for idx in sorted_table_indices}
+    last_y_pos = 0
+    for block in blocks:
+        block_bbox = fitz.Rect(block[:4])
+        block_text = block[4].strip()
+        block_top_y = block_bbox.y0
+        for table_idx in sorted_table_indices:
+            if not yielded_tables[table_idx] and table_insertion_points[table_idx] <= block_top_y:
+                if table_insertion_points[table_idx] >= last_y_pos - 5:
+                    page_elements.append(rendered_tables[table_idx])
+                    yielded_tables[table_idx] = True
+                    last_y_pos = max(last_y_pos, table_bboxes[table_idx].y1)
+        if block_text and not _is_block_inside_bbox(block_bbox, table_bboxes):
+            page_elements.append(block_text)
+            last_y_pos = max(last_y_pos, block_bbox.y1)
+    for table_idx in sorted_table_indices:
+        if not yielded_tables[table_idx]:
+            page_elements.append(rendered_tables[table_idx])
+    return page_elements
+
+
+def _page_inputs(page):
+    tabs = page.find_tables(snap_tolerance=3, join_tolerance=3)
+    table_bboxes = [fitz.Rect(t.bbox) for t in tabs.tables]
+    rendered_tables = {}
+    for i, table in enumerate(tabs.tables):
+        table_data = table.extract()
+        if table_data:
+            md_table = extract_text._convert_extracted_table_to_markdown(table_data)
+            if md_table:
+                rendered_tables[i] = md_table
+    return page.get_text("blocks", sort=True), table_bboxes, rendered_tables
+
+
+def _synthetic_page(rng: random.Random, n_tables: int, n_blocks: int, height: float = 10000.0):
+    """Плотная страница: таблицы на всю ширину друг под другом, блоки вперемешку внутри и между ними."""
+    table_bboxes = []
+    rendered_tables = {}
+    band = height / n_tables
+    for i in range(n_tables):
+        y0 = i * band + rng.uniform(0, band * 0.3)
+        y1 = y0 + rng.uniform(band * 0.2, band * 0.6)
+        table_bboxes.append(fitz.Rect(20, y0, 580, y1))
+        if rng.random() < 0.9:
+            rendered_tables[i] = f"| table {i} |\n| --- |\n"
+    blocks = []
+    for j in range(n_blocks):
+        y0 = rng.uniform(0, height)
+        y1 = y0 + rng.uniform(2, 30)
+        x0 = rng.uniform(10, 400)
+        blocks.append((x0, y0, x0 + rng.uniform(20, 180), y1, f"block {j}", j, 0))
+    # Тот же порядок, что и у get_text("blocks", sort=True)
+    blocks.sort(key=lambda b: (b[3], b[0]))
+    return blocks, table_bboxes, rendered_tables
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, default=60)
+    parser.add_argument("--blocks", type=int, default=3000)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = {"test_data": [], "synthetic": {}}
+    for pdf_path in sorted(glob.glob(os.path.join(_TEST_DATA_DIR, "*.pdf"))):
+        mismatched_pages = []
+        with fitz.open(pdf_path) as doc:
+            for page_num in range(len(doc)):
+                inputs = _page_inputs(doc.load_page(page_num))
+                if _layout_page_elements(*inputs) != reference_layout(*inputs):
+                    mismatched_pages.append(page_num + 1)
+            report["test_data"].append({"file": os.path.basename(pdf_path), "pages": len(doc),
+                                        "identical": not mismatched_pages, "mismatched_pages": mismatched_pages})
+
+    rng = random.Random(args.seed)
+    sweep_seconds = reference_seconds = 0.0
+    identical = True
+    for _ in range(args.pages):
+        inputs = _synthetic_page(rng, args.tables, args.blocks)
+        new, new_time = _timed(_layout_page_elements, *inputs)
+        old, old_time = _timed(reference_layout, *inputs)
+        sweep_seconds += new_time
+        reference_seconds += old_time
+        identical = identical and new == old
+    report["synthetic"] = {
+        "pages": args.pages, "tables_per_page": args.tables, "blocks_per_page": args.blocks,
+        "identical": identical, "sweep_seconds": sweep_seconds, "reference_seconds": reference_seconds,
+        "speedup": reference_seconds / sweep_seconds if sweep_seconds else None,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
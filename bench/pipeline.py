@@ -0,0 +1,428 @@
+"""
+Воспроизводимый набор замеров конвейера бота: извлечение текста, загрузка
+в RAG и ответы на вопросы. Работает без сети и GPU.
+
+Разделы (каждый - в отдельном процессе):
+  * extract - process_document для каждого документа (по умолчанию все
+    файлы test_data/; .doc - только при установленном soffice): лучшее и
+    медианное время из --repeat прогонов, страницы/с (PDF), МБ/с, пиковый
+    RSS процесса и его дочерних процессов (постраничный разбор PDF);
+  * ingest - build_rag нового контекста и ainsert_text_files извлеченного
+    текста (одинаковые по содержимому файлы загружаются один раз);
+  * query - build_rag заполненного контекста: холодный (первый в свежем
+    процессе) и теплый (повторный) запуск, затем задержка rag.aquery по
+    каждому режиму VALID_QUERY_MODES (p50/p95, --queries разных вопросов на
+    режим, кэш ответов LightRAG не срабатывает). Требует раздела ingest.
+LLM - заглушка bench/llm_stub.py в отдельном процессе (--llm-latency,
+--llm-tokens-per-second - время ответа, --llm-replay - записанные ответы). Эмбеддинги - хэширующий эмбеддер на CPU через общую
+очередь микропакетов embedding_service (дисковый кэш эмбеддингов выключен);
+порог сходства COSINE_THRESHOLD по умолчанию снижен до 0.02 - сходство
+хэшированных векторов ниже, чем у модели. Если словарь tiktoken нельзя
+скачать, используется приближенный токенизатор (4 символа на токен), это
+отмечается в результате ("tokenizer": "approximate").
+
+Результат - JSON с описанием окружения (коммит, версии, число CPU) в
+--output (по умолчанию bench/results/pipeline-<время>.json); --compare
+прошлый.json печатает изменение числовых показателей. Для раздела ingest и
+query нужен config.py (адрес LLM подменяется на заглушку).
+
+Запуск из корня репозитория:
+    python -m bench.pipeline
+    python -m bench.pipeline --sections extract --repeat 5 --compare bench/results/pipeline-old.json
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from importlib import metadata
+from typing import Dict, List
+
+import numpy as np
+
+from bench import llm_stub
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TEST_DATA_DIR = os.path.join(_REPO_DIR, "test_data")
+_RESULTS_DIR = os.path.join(_REPO_DIR, "bench", "results")
+_FORMATS = (".pdf", ".docx", ".doc")
+SECTIONS = ("extract", "ingest", "query")
+
+EMBED_DIM = 1024
+_WORD = re.compile(r"\w+")
+
+
+# --- Окружение процессов замера ---
+
+class ApproximateTokenizer:
+    """Обратимый токенизатор без сети: фрагменты по 4 символа (примерно столько в токене BPE)."""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._pieces: List[str] = []
+
+    def encode(self, text: str) -> List[int]:
+        tokens = []
+        for start in range(0, len(text), 4):
+            piece = text[start:start + 4]
+            token = self._ids.get(piece)
+            if token is None:
+                token = self._ids[piece] = len(self._pieces)
+                self._pieces.append(piece)
+            tokens.append(token)
+        return tokens
+
+    def decode(self, tokens: List[int]) -> str:
+        return "".join(self._pieces[token] for token in tokens)
+
+
+def hashing_encode(texts: List[str], dim: int = EMBED_DIM) -> np.ndarray:
+    """Эмбеддинг мешка слов с хэшированием признаков: детерминированный, быстрый, без модели."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in _WORD.findall(text.lower()):
+            digest = zlib.crc32(word.encode("utf-8"))
+            vectors[row, digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def setup_offline_pipeline(llm_url: str) -> str:
+    """
+    Подменяет LLM (адрес заглушки) и модель эмбеддингов (хэширующий эмбеддер)
+    в текущем процессе; возвращает использованный токенизатор.
+    """
+    import lightrag.utils as lightrag_utils
+    from moduls import lightrag_module
+    from moduls.embedding_service import embedding_service
+
+    logging.getLogger("lightrag").setLevel(logging.WARNING)
+    lightrag_module.LLM_BASE_URL = llm_url
+    lightrag_module.LLM_API_KEY = "bench"
+    embedding_service.encode_sync = hashing_encode
+    embedding_service.cache_enabled = False
+    try:
+        lightrag_utils.encode_string_by_tiktoken("probe")
+        return "tiktoken"
+    except Exception:
+        lightrag_utils.ENCODER = ApproximateTokenizer()
+        return "approximate"
+
+
+def _peak_rss_mb(who: int) -> float:
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux - в КБ, macOS - в байтах
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 1024
+
+
+def _stage_totals() -> dict:
+    """Число и суммарное время этапов конвейера по метрикам moduls/metrics.py."""
+    from moduls.metrics import STAGE_SECONDS
+
+    totals = {}
+    for labels, count, seconds in STAGE_SECONDS.samples():
+        name = labels["stage"] + (f"/{labels['detail']}" if "detail" in labels else "")
+        entry = totals.setdefault(name, {"count": 0, "seconds": 0.0})
+        entry["count"] += count
+        entry["seconds"] += seconds
+    return dict(sorted(totals.items()))
+
+
+def _percentiles(latencies: List[float]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "p50_ms": ordered[len(ordered) // 2] * 1000 if ordered else None,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000 if ordered else None,
+        "mean_ms": statistics.fmean(ordered) * 1000 if ordered else None,
+    }
+
+
+# --- Разделы (выполняются в дочерних процессах) ---
+
+def measure_extraction(path: str, repeat: int) -> dict:
+    from moduls.extract_text import document_page_count, process_document
+
+    timings, chars = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        text = process_document(path)
+        timings.append(time.perf_counter() - started)
+        chars = len(text) if text else 0
+    best = min(timings)
+    size = os.path.getsize(path)
+    pages = document_page_count(path)
+    return {
+        "format": os.path.splitext(path)[1].lower().lstrip("."),
+        "bytes": size,
+        "pages": pages,
+        "chars": chars,
+        "seconds_best": best,
+        "seconds_median": statistics.median(timings),
+        "pages_per_second": pages / best if pages else None,
+        "mb_per_second": size / 2 ** 20 / best,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_children_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+async def measure_ingest(storage_dir: str, text_dir: str, files: List[str], llm_url: str) -> dict:
+    tokenizer = setup_offline_pipeline(llm_url)
+    from moduls import lightrag_module
+    from moduls.admission import KIND_INGEST, admission
+    from moduls.embedding_service import embedding_service
+    from moduls.extract_text import process_document
+
+    os.makedirs(text_dir, exist_ok=True)
+    txt_paths = {}
+    for path in files:
+        txt_path = os.path.join(text_dir, os.path.basename(path) + ".txt")
+        with open(txt_path, "w", encoding="utf-8") as txt_file:
+            txt_file.write(process_document(path) or "")
+        txt_paths[os.path.basename(path)] = txt_path
+    chars = sum(os.path.getsize(txt_path) for txt_path in txt_paths.values())
+
+    started = time.perf_counter()
+    rag = await lightrag_module.build_rag(storage_dir)
+    init_seconds = time.perf_counter() - started
+    # Как в задании загрузки бота: вызовы LLM учитываются как вызовы загрузки
+    async with admission.admit(0, KIND_INGEST):
+        started = time.perf_counter()
+        doc_ids = await lightrag_module.ainsert_text_files(rag, txt_paths)
+        insert_seconds = time.perf_counter() - started
+    chunks, failed = await lightrag_module.summarize_doc_status(rag, [i for ids in doc_ids.values() for i in ids])
+    await rag.finalize_storages()
+    await embedding_service.shutdown()
+    return {
+        "tokenizer": tokenizer,
+        "documents": len(txt_paths),
+        "text_bytes": chars,
+        "init_empty_seconds": init_seconds,
+        "insert_seconds": insert_seconds,
+        "chunks": chunks,
+        "failed_documents": len(failed),
+        "text_mb_per_second": chars / 2 ** 20 / insert_seconds,
+        "chunks_per_second": chunks / insert_seconds,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "stages": _stage_totals(),
+    }
+
+
+def make_questions(text_dir: str, count: int) -> List[str]:
+    text = "".join(open(path, encoding="utf-8").read() for path in sorted(glob.glob(os.path.join(text_dir, "*.txt"))))
+    names = llm_stub.capitalized_names(text, 20) or ["документ"]
+    # Номер делает вопросы разными: ответ не берется из кэша LightRAG
+    return [f"Что известно о {names[index % len(names)]}? Вопрос {index + 1}." for index in range(count)]
+
+
+async def measure_queries(storage_dir: str, text_dir: str, queries: int, llm_url: str) -> dict:
+    tokenizer = setup_offline_pipeline(llm_url)
+    from lightrag import QueryParam
+    from lightrag.prompt import PROMPTS
+
+    from handlers.question import VALID_QUERY_MODES
+    from moduls import lightrag_module
+    from moduls.embedding_service import embedding_service
+
+    started = time.perf_counter()
+    rag = await lightrag_module.build_rag(storage_dir)
+    cold_seconds = time.perf_counter() - started
+    await rag.finalize_storages()
+    started = time.perf_counter()
+    rag = await lightrag_module.build_rag(storage_dir)
+    warm_seconds = time.perf_counter() - started
+
+    questions = make_questions(text_dir, queries)
+    modes = {}
+    for mode in VALID_QUERY_MODES:
+        latencies, no_context, answer_chars = [], 0, 0
+        for question in questions:
+            started = time.perf_counter()
+            answer = await rag.aquery(f"{question} ({mode})", param=QueryParam(mode=mode))
+            latencies.append(time.perf_counter() - started)
+            answer = answer or ""
+            no_context += answer == PROMPTS["fail_response"]
+            answer_chars += len(answer)
+        modes[mode] = {"queries": len(latencies), "no_context": no_context,
+                       "answer_chars_mean": answer_chars / max(1, len(latencies)), **_percentiles(latencies)}
+    await rag.finalize_storages()
+    await embedding_service.shutdown()
+    return {
+        "tokenizer": tokenizer,
+        "cold_init_seconds": cold_seconds,
+        "warm_init_seconds": warm_seconds,
+        "modes": modes,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "stages": _stage_totals(),
+    }
+
+
+def _child_main(section: str, params: dict) -> dict:
+    if section == "extract":
+        return measure_extraction(params["path"], params["repeat"])
+    if section == "ingest":
+        return asyncio.run(measure_ingest(params["storage_dir"], params["text_dir"], params["files"],
+                                          params["llm_url"]))
+    if section == "query":
+        return asyncio.run(measure_queries(params["storage_dir"], params["text_dir"], params["queries"],
+                                           params["llm_url"]))
+    raise ValueError(f"Unknown section: {section}")
+
+
+# --- Запуск и сравнение ---
+
+def run_child(section: str, params: dict, work_dir: str) -> dict:
+    """Выполняет раздел замера в отдельном процессе с рабочей директорией work_dir; результат - dict раздела."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [_REPO_DIR, env.get("PYTHONPATH")]))
+    env.setdefault("COSINE_THRESHOLD", "0.02")
+    env["EMBED_CACHE_ENABLED"] = "0"
+    # Рабочая директория - временная: data/ и lightrag.log процесса замера не попадают в репозиторий
+    completed = subprocess.run([sys.executable, "-m", "bench.pipeline", "--child", section, json.dumps(params)],
+                               cwd=work_dir, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Section {section} failed:\n{completed.stderr[-3000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _environment(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        lightrag_version = metadata.version("lightrag-hku")
+    except metadata.PackageNotFoundError:
+        lightrag_version = None
+    return {
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "lightrag": lightrag_version,
+        "sections": args.sections,
+        "repeat": args.repeat,
+        "queries": args.queries,
+        "llm_stub": llm_stub.options_from(args, "llm-"),
+        "storage_profile": os.getenv("RAG_STORAGE_PROFILE", "local"),
+    }
+
+
+def _unique_by_content(files: List[str]) -> List[str]:
+    seen, unique = set(), []
+    for path in files:
+        with open(path, "rb") as source:
+            digest = hashlib.sha256(source.read()).hexdigest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(path)
+    return unique
+
+
+def run(args) -> dict:
+    # Замеры выполняются в дочерних процессах с рабочей директорией work_dir: пути - абсолютные
+    files = [os.path.abspath(path) for path in args.files] or sorted(path for path in glob.glob(os.path.join(_TEST_DATA_DIR, "*"))
+                                 if os.path.splitext(path)[1].lower() in _FORMATS)
+    has_soffice = shutil.which(os.getenv("SOFFICE_BINARY", "soffice")) is not None
+    skipped = [path for path in files if path.lower().endswith(".doc") and not has_soffice]
+    files = [path for path in files if path not in skipped]
+    result = {"environment": _environment(args)}
+    work_dir = tempfile.mkdtemp(prefix="pipeline_bench_")
+    try:
+        if "extract" in args.sections:
+            result["extract"] = {os.path.basename(path): run_child("extract", {"path": path, "repeat": args.repeat},
+                                                                   work_dir)
+                                 for path in files}
+            result["extract"].update({os.path.basename(path): {"skipped": "soffice not found"} for path in skipped})
+
+        if "ingest" in args.sections or "query" in args.sections:
+            stub, connection, port = llm_stub.start_process(llm_stub.options_from(args, "llm-"))
+            try:
+                params = {"storage_dir": os.path.join(work_dir, "context", "storage"),
+                          "text_dir": os.path.join(work_dir, "context", "text"),
+                          "llm_url": f"http://127.0.0.1:{port}/v1"}
+                # Вопросам нужен заполненный контекст, поэтому загрузка выполняется и без раздела ingest
+                ingest = run_child("ingest", {**params, "files": _unique_by_content(files)}, work_dir)
+                if "ingest" in args.sections:
+                    result["ingest"] = ingest
+                if "query" in args.sections:
+                    result["query"] = run_child("query", {**params, "queries": args.queries}, work_dir)
+            finally:
+                connection.send("stop")
+                result["llm_stub"] = connection.recv()
+                stub.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def _flatten(value, prefix: str = "") -> Dict[str, float]:
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def compare(previous: dict, current: dict) -> List[str]:
+    """Строки с изменением числовых показателей относительно прошлого прогона."""
+    old = _flatten({key: value for key, value in previous.items() if key != "environment"})
+    new = _flatten({key: value for key, value in current.items() if key != "environment"})
+    lines = [f"Сравнение с коммитом {previous.get('environment', {}).get('commit')} "
+             f"от {previous.get('environment', {}).get('started_at')}:"]
+    for key in sorted(new.keys() & old.keys()):
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+        lines.append(f"  {key}: {old[key]:.4g} -> {new[key]:.4g} ({change})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="документы (по умолчанию все PDF/DOCX/DOC из test_data/)")
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--repeat", type=int, default=3, help="прогонов извлечения на документ")
+    parser.add_argument("--queries", type=int, default=10, help="вопросов на режим")
+    llm_stub.add_arguments(parser, "llm-")
+    parser.add_argument("--output", help="файл результата (по умолчанию bench/results/pipeline-<время>.json)")
+    parser.add_argument("--compare", help="результат прошлого прогона для сравнения")
+    parser.add_argument("--child", nargs=2, metavar=("SECTION", "PARAMS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        section, params = args.child
+        print(json.dumps(_child_main(section, json.loads(params)), ensure_ascii=False))
+        return
+
+    result = run(args)
+    output = args.output or os.path.join(
+        _RESULTS_DIR, f"pipeline-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(result, output_file, indent=2, ensure_ascii=False)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    print(f"Результат: {output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as previous_file:
+            print("\n".join(compare(json.load(previous_file), result)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Локальный стенд для режима webhook (webhook.py): воспроизводит записанные
+апдейты Telegram через front с несколькими воркерами.
+
+Стенд поднимает заглушку Bot API (отвечает на sendMessage, editMessageText
+и т.д. и запоминает вызовы), запускает webhook.serve с TELEGRAM_API_URL на
+заглушку, отправляет апдейты на вебхук и сразу инициирует остановку -
+плавная остановка должна обработать все принятые апдейты. Затем проверяет
+по вызовам заглушки:
+  * что на каждое сообщение пришел ответ;
+  * что ответы каждому пользователю идут в порядке его апдейтов
+    (для эхо-диспетчера, он отвечает текстом сообщения);
+и считает пропускную способность и задержку апдейт -> ответ.
+
+Апдейты - файл JSONL (по одному Update на строку), например записанный
+front с WEBHOOK_RECORD_FILE, или синтетические текстовые сообщения
+(--synthetic). По умолчанию обработчик - эхо-диспетчер этого модуля с
+REPLAY_HANDLER_MS миллисекунд вычислений на апдейт (имитация разбора PDF и
+эмбеддингов); --dispatcher bot:create_dispatcher воспроизводит апдейты на
+настоящих обработчиках бота (нужны config.py и данные контекстов).
+
+Запуск из корня репозитория:
+    python -m bench.replay_updates --synthetic 2000 --users 50 --workers 4 --handler-ms 5
+    python -m bench.replay_updates --updates updates.jsonl --dispatcher bot:create_dispatcher
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession, web
+
+from aiogram import Dispatcher, F, Router
+from aiogram.types import Message
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_TOKEN = "123456:replay-bench-token"
+_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+
+# --- Эхо-диспетчер (выполняется в воркерах) ---
+
+def create_echo_dispatcher() -> Dispatcher:
+    handler_seconds = float(os.getenv("REPLAY_HANDLER_MS", "0")) / 1000
+    router = Router()
+
+    @router.message(F.text)
+    async def echo(message: Message):
+        # Вычисления блокируют цикл воркера, как синхронный разбор документа
+        deadline = time.perf_counter() + handler_seconds
+        while time.perf_counter() < deadline:
+            pass
+        await message.answer(message.text)
+
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+    return dispatcher
+
+
+# --- Заглушка Bot API ---
+
+class StubTelegramAPI:
+    """Отвечает на вызовы Bot API правдоподобными результатами и запоминает их."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_id = 0
+
+    def _message(self, fields: dict) -> dict:
+        self._message_id += 1
+        chat_id = int(fields.get("chat_id", 0))
+        return {"message_id": int(fields.get("message_id", self._message_id)), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": _BOT_USER, "text": fields.get("text", "")}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        fields = dict(await request.post())
+        # Время по часам системы: сравнивается со временем отправки в другом процессе
+        self.calls.append((time.time(), method, fields))
+        if method == "getMe":
+            result = _BOT_USER
+        elif method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            result = self._message(fields)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def replies(calls: list) -> list:
+    """Отправленные ботом сообщения: (время, chat_id, текст)."""
+    return [(at, int(fields.get("chat_id", 0)), fields.get("text", ""))
+            for at, method, fields in calls if method == "sendMessage"]
+
+
+async def _serve_stub(port: int, connection):
+    stub = StubTelegramAPI()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", stub.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    connection.send("ready")
+    # Команды стенда: "calls" - вызовы на текущий момент, остановка - все вызовы после остановки
+    while await asyncio.get_running_loop().run_in_executor(None, connection.recv) == "calls":
+        connection.send(stub.calls)
+    await runner.cleanup()
+    connection.send(stub.calls)
+
+
+def stub_main(port: int, connection):
+    # Отдельный процесс: заглушка не делит цикл событий с front и отправкой апдейтов
+    asyncio.run(_serve_stub(port, connection))
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# --- Апдейты ---
+
+def synthetic_updates(count: int, users: int) -> list:
+    updates = []
+    for index in range(count):
+        user_id = 1000 + index % users
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        updates.append({"update_id": index + 1, "message": {
+            "message_id": index + 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+            "from": user, "text": str(index)}})
+    return updates
+
+
+def load_updates(path: str) -> list:
+    with open(path, encoding="utf-8") as updates_file:
+        return [json.loads(line) for line in updates_file if line.strip()]
+
+
+# --- Воспроизведение ---
+
+async def _post_all(url: str, updates: list, concurrency: int, rate: float) -> dict:
+    """Отправляет апдейты; апдейты одного пользователя - последовательно, как это делает Telegram."""
+    from webhook import update_user_id
+
+    by_user = defaultdict(list)
+    for update in updates:
+        by_user[update_user_id(update)].append(update)
+    sent = {}
+    interval = 1 / rate if rate > 0 else 0
+    started = time.perf_counter()
+    slots = asyncio.Semaphore(concurrency)
+    counter = iter(range(len(updates)))
+
+    async def post_user(session: ClientSession, user_updates: list):
+        for update in user_updates:
+            async with slots:
+                if interval:
+                    # Общий темп: n-й апдейт не раньше started + n * interval
+                    await asyncio.sleep(max(0.0, started + next(counter) * interval - time.perf_counter()))
+                sent[update["update_id"]] = time.time()
+                async with session.post(url, json=update) as response:
+                    if response.status != 200:
+                        raise RuntimeError(f"Webhook answered {response.status} for update {update['update_id']}")
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post_user(session, user_updates) for user_updates in by_user.values()))
+    return sent
+
+
+async def wait_for_workers(port: int, workers: int, server: asyncio.Task):
+    """Ждет, пока front на port сообщит о готовности всех воркеров (ошибка запуска server пробрасывается)."""
+    health_url = f"http://127.0.0.1:{port}/health"
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(health_url) as response:
+                    if response.status == 200 and (await response.json())["workers_ready"] == workers:
+                        return
+            except OSError:
+                pass
+            if server.done():
+                server.result()
+            await asyncio.sleep(0.1)
+
+
+async def replay(updates: list, workers: int, factory_path: str, concurrency: int, rate: float,
+                 drain_timeout: float) -> dict:
+    import webhook
+
+    context = multiprocessing.get_context("spawn")
+    connection, stub_connection = context.Pipe()
+    stub_port = _free_port()
+    stub = context.Process(target=stub_main, args=(stub_port, stub_connection))
+    stub.start()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, connection.recv)
+
+    port = _free_port()
+    stop = asyncio.Event()
+    server = asyncio.create_task(webhook.serve(
+        host="127.0.0.1", port=port, workers=workers, factory_path=factory_path, token=_TOKEN,
+        api_url=f"http://127.0.0.1:{stub_port}", secret="", drain_timeout=drain_timeout, stop=stop))
+    # Время запуска воркеров не входит в замер
+    await wait_for_workers(port, workers, server)
+
+    started = time.time()
+    sent = await _post_all(f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}", updates, concurrency, rate)
+    posted_seconds = time.time() - started
+    # Остановка сразу после отправки: ответы на все принятые апдейты должны прийти во время плавной остановки
+    stop_requested = time.perf_counter()
+    stop.set()
+    front_stats = await server
+    drain_seconds = time.perf_counter() - stop_requested
+    connection.send("stop")
+    calls = await loop.run_in_executor(None, connection.recv)
+    stub.join()
+
+    bot_replies = replies(calls)
+    messages = {update["update_id"]: update["message"] for update in updates if "text" in update.get("message", {})}
+    by_chat = defaultdict(list)
+    for at, chat_id, text in bot_replies:
+        by_chat[chat_id].append((at, text))
+    latencies, ordered = [], True
+    texts_to_update = {(message["chat"]["id"], message["text"]): update_id for update_id, message in messages.items()}
+    for chat_id, chat_replies in by_chat.items():
+        update_ids = [texts_to_update.get((chat_id, text)) for _, text in chat_replies]
+        known = [update_id for update_id in update_ids if update_id is not None]
+        ordered = ordered and known == sorted(known)
+        latencies.extend(at - sent[update_id] for (at, _), update_id in zip(chat_replies, update_ids)
+                         if update_id is not None)
+    latencies.sort()
+    last_reply = max((at for at, _, _ in bot_replies), default=started)
+    return {
+        "updates": len(updates),
+        "workers": workers,
+        "dispatcher": factory_path,
+        "posted_seconds": posted_seconds,
+        "drain_seconds": drain_seconds,
+        "throughput_updates_per_s": len(updates) / max(1e-9, last_reply - started),
+        "replies": len(bot_replies),
+        "answered_messages": len(latencies),
+        "text_messages": len(messages),
+        "per_user_order_preserved": ordered,
+        "latency_p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "latency_p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000 if latencies else None,
+        "api_calls": len(calls),
+        "front": front_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="файл JSONL с записанными апдейтами")
+    parser.add_argument("--synthetic", type=int, default=1000, help="число синтетических сообщений без --updates")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--dispatcher", default="bench.replay_updates:create_echo_dispatcher")
+    parser.add_argument("--handler-ms", type=float, default=0.0, help="вычисления эхо-обработчика на апдейт")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных запросов к вебхуку")
+    parser.add_argument("--rate", type=float, default=0.0, help="апдейтов в секунду (0 - без ограничения)")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    args = parser.parse_args()
+    # Воркеры запускаются через spawn и наследуют окружение
+    os.environ["REPLAY_HANDLER_MS"] = str(args.handler_ms)
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.synthetic, args.users)
+    result = asyncio.run(replay(updates, args.workers, args.dispatcher, args.concurrency, args.rate,
+                                args.drain_timeout))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Сравнение профилей хранилищ LightRAG: "json" (файлы LightRAG) и "local"
+(SQLite и memory-mapped векторы, moduls/local_storage.py).
+
+Генерирует синтетический контекст из N чанков в формате JSON, переносит его
+копию в локальные хранилища (python -m moduls.local_storage) и для каждого
+профиля в отдельном процессе замеряет:
+  * время открытия (создание LightRAG и initialize_storages);
+  * задержку поиска: chunks_vdb.query и чтение найденных чанков, как в режиме naive;
+  * прирост RSS после открытия и после запросов.
+Для профиля "local" считается recall@k относительно точного поиска "json"
+(ниже 1.0 только при включенном IVF-индексе).
+
+Запуск из корня репозитория:
+    python -m bench.storage_backends --chunks 20000 --dim 1024 --queries 200
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_CLUSTERS = 64
+
+
+def _centers(dim: int) -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((_CLUSTERS, dim)).astype(np.float32)
+
+
+def _vector(text: str, dim: int, centers: np.ndarray) -> np.ndarray:
+    """Детерминированный вектор текста рядом с одним из центров (данные с кластерами, как у реальных эмбеддингов)."""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+    return centers[seed % _CLUSTERS] + rng.standard_normal(dim).astype(np.float32)
+
+
+def generate_json_context(storage_dir: str, chunks: int, dim: int, chunks_per_doc: int = 50):
+    """Записывает контекст в формате стандартных хранилищ LightRAG."""
+    from nano_vectordb import NanoVectorDB
+
+    centers = _centers(dim)
+    full_docs, text_chunks, doc_status = {}, {}, {}
+    vectors = []
+    for doc_index in range(0, chunks, chunks_per_doc):
+        doc_id = f"doc-{doc_index:08d}"
+        contents = []
+        for order in range(min(chunks_per_doc, chunks - doc_index)):
+            chunk_id = f"chunk-{doc_index + order:08d}"
+            content = f"Фрагмент {doc_index + order} документа {doc_id}. " + "Текст договора и приложений. " * 40
+            contents.append(content)
+            text_chunks[chunk_id] = {"tokens": 300, "content": content, "full_doc_id": doc_id,
+                                     "chunk_order_index": order, "file_path": f"{doc_id}.pdf"}
+            vectors.append({"__id__": chunk_id, "__vector__": _vector(chunk_id, dim, centers),
+                            "__created_at__": time.time(), "full_doc_id": doc_id, "content": content,
+                            "file_path": f"{doc_id}.pdf"})
+        full_docs[doc_id] = {"content": "".join(contents)}
+        doc_status[doc_id] = {"status": "processed", "content": contents[0][:100], "content_summary": contents[0][:100],
+                              "content_length": len(full_docs[doc_id]["content"]), "chunks_count": len(contents),
+                              "created_at": "", "updated_at": "", "file_path": f"{doc_id}.pdf"}
+    for namespace, data in (("full_docs", full_docs), ("text_chunks", text_chunks), ("doc_status", doc_status),
+                            ("llm_response_cache", {})):
+        with open(os.path.join(storage_dir, f"kv_store_{namespace}.json"), "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, ensure_ascii=False)
+    for namespace, data in (("chunks", vectors), ("entities", []), ("relationships", [])):
+        client = NanoVectorDB(dim, storage_file=os.path.join(storage_dir, f"vdb_{namespace}.json"))
+        if data:
+            client.upsert(data)
+        client.save()
+
+
+async def _measure(profile: str, storage_dir: str, dim: int, queries: int, top_k: int) -> dict:
+    from lightrag import LightRAG
+    from lightrag.kg.shared_storage import initialize_pipeline_status
+    from lightrag.utils import EmbeddingFunc
+
+    from moduls.embedding_service import get_rss_bytes
+    from moduls.local_storage import STORAGE_PROFILES
+
+    logging.getLogger("lightrag").setLevel(logging.WARNING)
+    # Импорт модулей хранилищ (graspologic, scipy и т.д.) не входит в замер открытия контекста
+    import lightrag.kg.json_doc_status_impl  # noqa: F401
+    import lightrag.kg.json_kv_impl  # noqa: F401
+    import lightrag.kg.nano_vector_db_impl  # noqa: F401
+    import lightrag.kg.networkx_impl  # noqa: F401
+    centers = _centers(dim)
+
+    async def embed(texts):
+        return np.stack([_vector(text, dim, centers) for text in texts])
+
+    async def llm(*args, **kwargs):
+        return ""
+
+    rss_before = get_rss_bytes()
+    started = time.perf_counter()
+    rag = LightRAG(working_dir=storage_dir, llm_model_func=llm,
+                   embedding_func=EmbeddingFunc(embedding_dim=dim, max_token_size=8192, func=embed),
+                   cosine_better_than_threshold=-1.0, **STORAGE_PROFILES[profile])
+    await rag.initialize_storages()
+    await initialize_pipeline_status()
+    open_seconds = time.perf_counter() - started
+    rss_open = get_rss_bytes()
+
+    latencies, results = [], []
+    for index in range(queries):
+        started = time.perf_counter()
+        found = await rag.chunks_vdb.query(f"вопрос {index}", top_k=top_k)
+        await rag.text_chunks.get_by_ids([item["id"] for item in found])
+        latencies.append(time.perf_counter() - started)
+        results.append([item["id"] for item in found])
+    rss_queries = get_rss_bytes()
+    await rag.finalize_storages()
+    latencies.sort()
+    return {
+        "profile": profile,
+        "open_seconds": open_seconds,
+        "query_p50_ms": latencies[len(latencies) // 2] * 1000,
+        "query_p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        "rss_open_mb": (rss_open - rss_before) / 2 ** 20,
+        "rss_after_queries_mb": (rss_queries - rss_before) / 2 ** 20,
+        "results": results,
+    }
+
+
+def _run_child(profile: str, storage_dir: str, args) -> dict:
+    # Отдельный процесс на профиль: чистые замеры RSS и холодное открытие
+    output = subprocess.run(
+        [sys.executable, "-m", "bench.storage_backends", "--child", profile, storage_dir,
+         "--dim", str(args.dim), "--queries", str(args.queries), "--top-k", str(args.top_k)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(args) -> dict:
+    from moduls.local_storage import migrate_context
+
+    work_dir = tempfile.mkdtemp(prefix="storage_bench_")
+    try:
+        json_dir = os.path.join(work_dir, "json")
+        local_dir = os.path.join(work_dir, "local")
+        os.makedirs(json_dir)
+        started = time.perf_counter()
+        generate_json_context(json_dir, args.chunks, args.dim)
+        generate_seconds = time.perf_counter() - started
+        shutil.copytree(json_dir, local_dir)
+        started = time.perf_counter()
+        migrate_context(local_dir)
+        migrate_seconds = time.perf_counter() - started
+
+        reports = {profile: _run_child(profile, directory, args)
+                   for profile, directory in (("json", json_dir), ("local", local_dir))}
+        exact = reports["json"].pop("results")
+        approximate = reports["local"].pop("results")
+        hits = sum(len(set(a) & set(e)) for a, e in zip(approximate, exact))
+        reports["local"]["recall_at_k"] = hits / max(1, sum(len(e) for e in exact))
+        return {
+            "chunks": args.chunks,
+            "dim": args.dim,
+            "queries": args.queries,
+            "top_k": args.top_k,
+            "generate_seconds": generate_seconds,
+            "migrate_seconds": migrate_seconds,
+            "profiles": reports,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--child", nargs=2, metavar=("PROFILE", "STORAGE_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        profile, storage_dir = args.child
+        print(json.dumps(asyncio.run(_measure(profile, storage_dir, args.dim, args.queries, args.top_k))))
+        return
+    print(json.dumps(run(args), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
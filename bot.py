@@ -1,23 +1,41 @@
 import logging
 import asyncio
+import functools
+from typing import Callable, List, Optional
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
 
 from config import BOT_TOKEN
 from handlers.start import router as start_router  # Импортируем router из start.py
 from handlers.context import router as context_router  # Импортируем router из context.py
-from handlers.document import router as document_router  # Импортируем router из document.py
-from handlers.question import router as question_router  # Импортируем router из question.py
+from handlers.document import router as document_router, run_ingest_job  # Импортируем router из document.py
+from handlers.question import router as question_router, query_flights  # Импортируем router из question.py
 from handlers.main_menu import router as main_menu_router # Импортируем router из main_menu.py
+from moduls.rag_pool import rag_pool
+from moduls.embedding_service import embedding_service, EMBED_PRELOAD
+from moduls.extract_pool import extraction_pool
+from moduls.doc_converter import doc_converter
+from moduls.ingest_queue import ingest_queue
+from moduls.fsm_storage import build_fsm_storage
+from moduls.admission import admission, llm_rate_limiter
+from moduls.answer_cache import answer_cache
+from moduls.llm_client import llm_client
+from moduls.metrics import (TelegramRequestMetrics, UpdateMetricsMiddleware, metrics_server,
+                            register_collector)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
-# Инициализация диспетчера
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+# Фоновые задачи, запущенные on_startup (отменяются в on_shutdown)
+_background_tasks: List[asyncio.Task] = []
+
+
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер со всеми обработчиками; фоновые службы запускаются и останавливаются вместе с ним."""
+    # Состояния FSM (в том числе выбранный контекст) переживают перезапуск; закрывается диспетчером
+    dp = Dispatcher(storage=build_fsm_storage())
+    # Идентификатор корреляции и время обработки каждого апдейта
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
 
     # Регистрация обработчиков
     dp.include_routers(start_router,
@@ -26,13 +44,69 @@ async def main():
                        question_router,
                        main_menu_router)
 
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    # Счетчики служб бота на /metrics
+    for component, stats in (("rag_pool", rag_pool.stats), ("ingest_queue", ingest_queue.stats),
+                             ("admission", admission.stats), ("llm_rate", llm_rate_limiter.stats),
+                             ("embedding", embedding_service.stats), ("extraction_pool", extraction_pool.stats),
+                             ("doc_converter", doc_converter.stats), ("answer_cache", answer_cache.stats),
+                             ("query_flights", query_flights.stats), ("llm_client", llm_client.stats)):
+        register_collector(component, stats)
+    if hasattr(dp.storage, "stats"):
+        register_collector("fsm", dp.storage.stats)
+    return dp
+
+
+async def on_startup(bot: Bot, worker_index: int = 0, owns_user: Optional[Callable[[int], bool]] = None):
+    """
+    Запуск фоновых служб. В режиме webhook (webhook.py) процесс получает свой
+    номер и owns_user - фильтр пользователей, чьи загрузки он выполняет.
+    """
     # Установка команд для бота
-    commands = [
-        BotCommand(command="start", description="Запустить бота"),
-    ]
-    await bot.set_my_commands(commands)
+    if worker_index == 0:
+        commands = [
+            BotCommand(command="start", description="Запустить бота"),
+        ]
+        await bot.set_my_commands(commands)
+
+    # Время запросов к Bot API; endpoint /metrics (у воркеров webhook - METRICS_PORT + номер)
+    bot.session.middleware(TelegramRequestMetrics())
+    await metrics_server.start(port_offset=worker_index)
+
+    # Загрузка модели эмбеддингов заранее, чтобы первый пользователь не ждал
+    if EMBED_PRELOAD:
+        await embedding_service.load()
+
+    # Прогрев профилей soffice для конвертации .doc (в фоне, не задерживает запуск); профили у процесса свои
+    _background_tasks.append(asyncio.create_task(doc_converter.start(instance=worker_index)))
+
+    # Воркеры фоновой загрузки документов; прерванные прошлым запуском задания продолжаются
+    ingest_queue.start(functools.partial(run_ingest_job, bot), owns_user=owns_user)
+
+
+async def on_shutdown():
+    # Остановка загрузки до закрытия RAG: прерванные задания возобновятся при следующем старте
+    await ingest_queue.close()
+    # Сброс на диск всех прогретых экземпляров RAG
+    await rag_pool.close()
+    await llm_client.close()
+    await embedding_service.shutdown()
+    extraction_pool.shutdown()
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    await doc_converter.close()
+    await metrics_server.close()
+
+
+# Запуск в режиме long polling (режим webhook с несколькими процессами - webhook.py)
+async def main():
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
 
-    # Начало опроса
+    # Начало опроса; службы запускаются и останавливаются хуками диспетчера
     await dp.start_polling(bot)
 
     # Закрытие сессии бота
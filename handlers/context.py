@@ -10,6 +10,8 @@ from aiogram.types import ReplyKeyboardRemove
 
 from keyboards.main_menu import main_menu
 from keyboards.document_menu import document_menu
+from moduls.rag_pool import rag_pool
+from moduls.ingest_queue import ingest_queue
 
 from config import BASE_STORAGE_DIR, MAX_CONTEXTS
 
@@ -141,6 +143,12 @@ async def delete_context_confirmed(callback: CallbackQuery, state: FSMContext):
         pass  # Если сообщение нельзя удалить, просто игнорируем
 
     if os.path.exists(context_path):
+        # Задания загрузки документов этого контекста больше не нужны; выполняемое задание
+        # извлекает текст без аренды RAG - дожидаемся его остановки, чтобы оно не писало в удаляемую папку
+        ingest_queue.cancel_context(user_id, context_name)
+        await ingest_queue.wait_running(user_id, context_name)
+        # Сначала убираем экземпляр RAG из пула, иначе при вытеснении он запишет хранилище обратно
+        await rag_pool.discard(os.path.join(context_path, "storage"))
         shutil.rmtree(context_path)  # Полностью удаляем папку контекста
         await callback.message.answer(f"✅ Контекст '{context_name}' был успешно удален.")
     else:
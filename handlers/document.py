@@ -1,13 +1,25 @@
+import asyncio
 import os
-from aiogram import Router, F
+from typing import Callable, Dict, List, Optional
+from aiogram import Bot, Router, F
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from moduls.lightrag_module import build_rag
-from moduls.extract_text import process_document
+from moduls.admission import KIND_INGEST, admission
+from moduls.rag_pool import rag_pool
+from moduls.lightrag_module import (ainsert_text_file, ainsert_text_files, adelete_documents, acompact_storage,
+                                    summarize_doc_status)
+from moduls.extract_text import document_page_count, extract_document_to_file
+from moduls.ingest_manifest import (IngestManifest, ExtractedTextStore, PlannedDocument, ACTION_DUPLICATE,
+                                    txt_name_for)
+from moduls.extract_pool import extraction_pool
+from moduls.doc_converter import doc_converter
+from moduls.ingest_queue import IngestJob, ingest_queue
+from moduls.metrics import counter, new_trace, stage
+from moduls.status_message import StatusMessage
 from keyboards.document_menu import document_menu
 
 import datetime
@@ -20,6 +32,18 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 router = Router()
 
+# Общее для всех контекстов хранилище извлеченного текста по хэшу содержимого
+extracted_text_store = ExtractedTextStore()
+EXTRACTED_BYTES = counter("extracted_bytes_total", "Source document bytes extracted, by format")
+EXTRACTED_PAGES = counter("extracted_pages_total", "PDF pages extracted, by format")
+
+# Пакетная вставка всех новых документов контекста (0 - по одному документу, как раньше)
+INGEST_BATCH_INSERT = os.getenv("INGEST_BATCH_INSERT", "1") == "1"
+# Сколько файлов контекста одновременно ждут конвертера и пула извлечения
+INGEST_EXTRACT_CONCURRENCY = int(os.getenv("INGEST_EXTRACT_CONCURRENCY", "8"))
+# Уборка хранилища RAG после каждого удаления документа
+RAG_COMPACT_ON_DELETE = os.getenv("RAG_COMPACT_ON_DELETE", "0") == "1"
+
 class DocumentStates(StatesGroup):
     waiting_for_document = State()
     proccessing_document = State()
@@ -62,67 +86,245 @@ async def upload_document_request(message: Message, state: FSMContext):
     await state.set_state(DocumentStates.waiting_for_document)
 
 
-# функция для обработки доков
-async def processing_uploaded_docs(message: Message, state: FSMContext):
-    await message.answer("⏳Обработка загруженных документов...")
+# Загрузка документов контекста в RAG, выполняется воркером фоновой очереди
+async def run_ingest_job(bot: Bot, job: IngestJob):
+    # Все этапы задания (извлечение, вставка, вызовы LLM) в трассировке под одним идентификатором
+    new_trace(f"ingest{job.id}")
+    context_path = os.path.join(BASE_STORAGE_DIR, str(job.user_id), job.context)
+    if not os.path.isdir(context_path):
+        logging.info(f"Context {job.context} of user {job.user_id} no longer exists, skipping job {job.id}")
+        return
 
-    user_id = message.from_user.id
-    user_data = await state.get_data()
-    current_context = user_data.get('current_context')
+    progress = StatusMessage(bot, job.chat_id, job.status_message_id,
+                             header=f"⏳ Обработка документов контекста '{job.context}'...")
 
-    user_storage_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "storage")
-    user_txt_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "text")
-    user_documents_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "documents")
+    queued = False
+
+    async def show_position(position: int):
+        nonlocal queued
+        queued = True
+        progress.update("queue", f"Сервер занят, загрузка #{position} в очереди.")
+
+    # Загрузки уступают слоты вопросам; задание из персистентной очереди не отклоняется, а ждет
+    async with admission.admit(job.user_id, KIND_INGEST, on_queued=show_position, reject_when_full=False):
+        if queued:
+            progress.update("queue", "Обработка началась.")
+        await _run_admitted_ingest_job(bot, job, progress, context_path)
+
+
+async def _run_admitted_ingest_job(bot: Bot, job: IngestJob, progress: StatusMessage, context_path: str):
+    processed = await _process_context_documents(progress, context_path, lambda: ingest_queue.is_cancelled(job.id))
+    if processed is None:
+        logging.info(f"Ingest job {job.id} stopped: context {job.context} of user {job.user_id} is being deleted")
+        await progress.finish("Загрузка отменена: контекст удален.")
+        return
+
+    progress.header = f"Обработка документов контекста '{job.context}'"
+    await progress.finish("Документы обработаны!" if processed else "Новых документов для обработки нет.")
+    await bot.send_message(job.chat_id, "Можно загрузить еще документы или вернуться в меню.", reply_markup=document_menu)
 
-    # --- 1. Инициализация RAG ---
-    rag = None
+
+def _document_volume(file_path: str, source_path: str) -> dict:
+    volume = {"bytes": os.path.getsize(file_path)}
+    try:
+        pages = document_page_count(source_path)
+    except Exception:
+        pages = None
+    if pages is not None:
+        volume["pages"] = pages
+    return volume
+
+
+async def _extracted_volume(file_format: str, file_path: str, source_path: str) -> dict:
+    """Объем документа в метрики по форматам: вместе с временем этапа extract дает страницы/с и МБ/с."""
+    # Подсчет страниц открывает документ в PyMuPDF - в потоке, а не в event loop
+    volume = await asyncio.to_thread(_document_volume, file_path, source_path)
+    EXTRACTED_BYTES.inc(volume["bytes"], format=file_format)
+    if "pages" in volume:
+        EXTRACTED_PAGES.inc(volume["pages"], format=file_format)
+    return volume
+
+
+async def _extract_document(progress: StatusMessage, item: PlannedDocument, txt_file_path: str) -> Optional[str]:
+    """Извлекает текст файла в .txt; возвращает описание ошибки или None. RAG на этом этапе не используется."""
+    filename = item.filename
+    progress.update(filename, f"⏳ {filename}: извлечение текста...")
+    logging.info(f"TXT file path: {txt_file_path}")
     try:
-        # Используем await для асинхронного вызова build_rag
-        rag = await build_rag(user_storage_path)
-        logging.info(f"Successfully created/initialized RAG for context {current_context} of user {user_id}")
+        # Копирование текста (если жесткая ссылка невозможна) - файловая операция, в потоке
+        if await asyncio.to_thread(extracted_text_store.fetch, item.content_hash, txt_file_path):
+            logging.info(f"Reusing extracted text of {filename} ({item.content_hash})")
+        else:
+            # .doc конвертируется прогретым soffice, извлечение выполняется в пуле процессов
+            # и потоково пишется сразу в .txt
+            file_format = os.path.splitext(filename)[1].lower().lstrip(".")
+            async with doc_converter.as_docx(item.path) as source_path:
+                async with stage("extract", detail=file_format) as span:
+                    extracted_chars = await extraction_pool.run(extract_document_to_file, source_path, txt_file_path)
+                    span.set(chars=extracted_chars, **await _extracted_volume(file_format, item.path, source_path))
+            if extracted_chars is None:
+                raise ValueError(f"No text extracted from {filename}")
+            await asyncio.to_thread(extracted_text_store.store, item.content_hash, txt_file_path)
+        logging.info(f"Extract text from file {filename}")
     except Exception as e:
-        # Логируем полное исключение для отладки
-        logging.exception(f"An exception occurred while creating RAG for context {current_context} of user {user_id}: {e}")
-        await message.answer("❌ Произошла ошибка при инициализации системы RAG 😔")
-        return False # Сигнализируем об ошибке
-
-    # Проверка, что RAG успешно создан (на всякий случай)
-    if rag is None:
-         logging.error(f"RAG object is None after initialization for context {current_context}, user {user_id}.")
-         await message.answer("❌ Не удалось инициализировать RAG. Обработка документа прервана.")
-         return False # Сигнализируем об ошибке
-
-    for filename in os.listdir(user_documents_path):
-        await message.answer(f"⏳ Извлечение текста из документа {filename.split('/')[-1]}")
+        logging.exception(f"Ошибка при извлечении текста из документа {filename}: {repr(e)}")
+        progress.update(filename, f"❌ {filename}: ошибка при извлечении текста 😔")
+        return repr(e)
+    progress.update(filename, f"⏳ {filename}: текст извлечен, ожидает добавления в RAG...")
+    return None
+
+
+async def _insert_documents(progress: StatusMessage, rag, txt_paths: dict) -> dict:
+    """Добавляет извлеченные документы в RAG, возвращает идентификаторы документов LightRAG по файлам."""
+    for filename in txt_paths:
+        progress.update(filename, f"⏳ {filename}: добавление в RAG...")
+    if INGEST_BATCH_INSERT:
+        # Одна пакетная вставка: LightRAG обрабатывает документы параллельно
+        logging.info(f"Adding {len(txt_paths)} documents to the RAG in batch mode")
+        return await ainsert_text_files(rag, txt_paths)
+    doc_ids = {}
+    for filename, txt_file_path in txt_paths.items():
+        logging.info(f"Adding text from file {filename} to the RAG")
+        # Текст добавляется частями, без чтения файла целиком
+        doc_ids[filename] = await ainsert_text_file(rag, txt_file_path, file_path=filename)
+    return doc_ids
+
+
+async def _process_context_documents(progress: StatusMessage, context_path: str,
+                                     cancelled: Callable[[], bool] = lambda: False) -> Optional[int]:
+    """Загружает новые и измененные файлы контекста; None - задание отменено (контекст удаляется)."""
+    # Удаление контекста ждет выполняемое задание: до записи в контекст оно проверяет отмену
+    if cancelled():
+        return None
+    user_txt_path = os.path.join(context_path, "text")
+    os.makedirs(user_txt_path, exist_ok=True)
+
+    with IngestManifest(context_path) as manifest:
+        # Манифест определяет, какие файлы новые или изменились; остальные пропускаются.
+        # Хэши измененных файлов считаются в потоке: большие файлы читаются целиком
+        plan = await asyncio.to_thread(manifest.plan)
+        if not plan:
+            return 0
+
+        # --- 1. Извлечение текста из всех файлов параллельно (ограничено пулами конвертера и извлечения) ---
+        # Выполняется без аренды RAG: вопросы к контексту в это время обрабатываются как обычно
+        to_extract = [item for item in plan if item.action != ACTION_DUPLICATE]
+        txt_paths = {item.filename: os.path.join(user_txt_path, txt_name_for(item.filename)) for item in to_extract}
+        semaphore = asyncio.Semaphore(INGEST_EXTRACT_CONCURRENCY)
+
+        async def extract(item: PlannedDocument) -> Optional[str]:
+            async with semaphore:
+                if cancelled():
+                    return "cancelled"
+                return await _extract_document(progress, item, txt_paths[item.filename])
+
+        errors = dict(zip(txt_paths, await asyncio.gather(*(extract(item) for item in to_extract))))
+
+        # --- 2. Изменение RAG с эксклюзивным доступом на запись ---
+        if cancelled():
+            return None
+        storage_path = os.path.join(context_path, "storage")
         try:
-          name_of_file = filename.split('.')[0]
-          txt_file_path = os.path.join(user_txt_path, f"{name_of_file}.txt")
-          logging.info(f"TXT file path: {txt_file_path}")
-          if not os.path.isfile(txt_file_path):
-              extracted_text = process_document(os.path.join(user_documents_path, filename))
-              logging.info(f"Extract text from file {filename.split('/')[-1]}")
-              #print(extracted_text)
-              with open(txt_file_path, 'w', encoding="utf-8") as txt_out_file:
-                  txt_out_file.write(extracted_text)
-              await message.answer(f"✅ Текст из документа {filename.split('/')[-1]} извлечен!")
-              await message.answer(f"⏳ Добавление информации из документа {filename.split('/')[-1]} в RAG...")
-              logging.info(f"Adding text from file {filename.split('/')[-1]} to the RAG")
-              try:
-                with open(txt_file_path) as read_file:
-                    await rag.ainsert(read_file.read())
-                logging.info(f"Text from file {filename.split('/')[-1]} was added to the RAG")
-                await message.answer(f"✅ Данные из документа {filename.split('/')[-1]} успешно добавлены в RAG!")
-              except Exception as e:
-                logging.info(f"An exception was occured while adding text from file {filename} to the RAG: {e}")
-                await message.answer(f"❌ Произошла ошибка при добавлении данных из документа {filename.split('/')[-1]} в RAG 😔")
-          else:
-              continue
+            lease = await rag_pool.acquire(storage_path, write=True)
+            logging.info(f"Successfully created/initialized RAG for {context_path}")
         except Exception as e:
-          print(f"Ошибка при извлечении текста из документа {filename}: {repr(e)}")
-          await message.answer(f"❌ Произошла ошибка при извлечении текста из документа {filename.split('/')[-1]} 😔")
-          continue
+            # Логируем полное исключение для отладки
+            logging.exception(f"An exception occurred while creating RAG for {context_path}: {e}")
+            await progress.finish("❌ Произошла ошибка при инициализации системы RAG 😔")
+            raise
+        try:
+            await _update_rag(progress, manifest, lease.rag, plan, errors, txt_paths)
+        finally:
+            await lease.release()
+    return len(plan)
+
+
+async def _update_rag(progress: StatusMessage, manifest: IngestManifest, rag, plan: List[PlannedDocument],
+                      errors: Dict[str, Optional[str]], txt_paths: Dict[str, str]):
+    """Удаляет прежние данные измененных файлов и добавляет извлеченные документы; вызывается под арендой на запись."""
+    items = {}
+    for item in plan:
+        filename = item.filename
+        if not os.path.exists(item.path):
+            # Файл удалили, пока извлекался текст: его данные уже убраны из RAG и манифеста
+            logging.info(f"Document {filename} was removed during extraction, skipping")
+            continue
+        if item.previous is not None and item.previous.doc_ids:
+            # Файл изменился или заменен копией другого: старые данные удаляются из RAG
+            logging.info(f"Document {filename} changed, removing {len(item.previous.doc_ids)} old RAG documents")
+            try:
+                await adelete_documents(rag, item.previous.doc_ids)
+            except Exception as e:
+                logging.exception(f"Failed to remove old RAG documents of {filename}: {e}")
+                # Идентификаторы остаются в манифесте, удаление повторится при следующей загрузке
+                manifest.mark_failed(item, repr(e), item.previous.doc_ids)
+                progress.update(filename, f"❌ {filename}: ошибка при добавлении в RAG 😔")
+                continue
+        if item.action == ACTION_DUPLICATE:
+            logging.info(f"Document {filename} duplicates {item.duplicate_of}, skipping")
+            manifest.mark_duplicate(item)
+            progress.update(filename, f"ℹ️ {filename}: совпадает с уже загруженным {item.duplicate_of}, пропущен")
+        elif errors[filename] is not None:
+            manifest.mark_failed(item, errors[filename])
+        else:
+            manifest.mark_pending(item)
+            items[filename] = item
+    if not items:
+        return
 
-    await message.answer("Документы обработаны!", reply_markup=document_menu)
+    # Статус добавления отслеживается по каждому документу
+    try:
+        async with stage("rag_insert", documents=len(items)):
+            doc_ids = await _insert_documents(progress, rag, {name: txt_paths[name] for name in items})
+    except Exception as e:
+        logging.exception(f"An exception was occured while adding documents to the RAG: {e}")
+        for filename, item in items.items():
+            manifest.mark_failed(item, repr(e))
+            progress.update(filename, f"❌ {filename}: ошибка при добавлении в RAG 😔")
+        return
+
+    for filename, item in items.items():
+        chunk_count, failed_ids = await summarize_doc_status(rag, doc_ids[filename])
+        if failed_ids:
+            logging.info(f"LightRAG failed to process {len(failed_ids)} of {len(doc_ids[filename])} parts of {filename}")
+            manifest.mark_failed(item, f"LightRAG failed to process parts: {', '.join(failed_ids)}", doc_ids[filename])
+            progress.update(filename, f"❌ {filename}: ошибка при добавлении в RAG 😔")
+        else:
+            manifest.mark_processed(item, doc_ids[filename], chunk_count)
+            logging.info(f"Text from file {filename} was added to the RAG ({chunk_count} chunks)")
+            progress.update(filename, f"✅ {filename}: добавлен в RAG")
+
+
+# Удаление документа из RAG, манифеста и файловой системы
+async def _remove_document(context_path: str, filename: str) -> bool:
+    lease = await rag_pool.acquire(os.path.join(context_path, "storage"), write=True)
+    try:
+        with IngestManifest(context_path) as manifest:
+            # Документы контекстов, загруженных до появления манифеста, попадают в него здесь
+            await asyncio.to_thread(manifest.plan)
+            record = manifest.get(filename)
+            duplicates = manifest.duplicates_of(filename)
+            if record is not None and record.doc_ids:
+                # Одинаковые фрагменты разных файлов - один документ LightRAG, его оставляем
+                in_use = manifest.doc_ids_in_use(exclude=filename)
+                doc_ids = [doc_id for doc_id in record.doc_ids if doc_id not in in_use]
+                logging.info(f"Removing {len(doc_ids)} RAG documents of {filename}")
+                await adelete_documents(lease.rag, doc_ids)
+            os.remove(os.path.join(context_path, "documents", filename))
+            txt_paths = [os.path.join(context_path, "text", txt_name_for(filename))]
+            legacy_stem = filename.split('.')[0]
+            if not any(name.split('.')[0] == legacy_stem for name in os.listdir(os.path.join(context_path, "documents"))):
+                # .txt по старой схеме именования, если он не принадлежит другому файлу
+                txt_paths.append(os.path.join(context_path, "text", f"{legacy_stem}.txt"))
+            for txt_path in txt_paths:
+                if os.path.exists(txt_path):
+                    os.remove(txt_path)
+            manifest.remove(filename)
+        if RAG_COMPACT_ON_DELETE:
+            await acompact_storage(lease.rag)
+    finally:
+        await lease.release()
+    return bool(duplicates)
 
 
 # Хендлер обработки загруженного документа
@@ -138,11 +340,10 @@ async def save_uploaded_document(message: Message, state: FSMContext):
 
     document = message.document
     user_documents_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "documents")
-    user_txt_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "txt")
+    user_txt_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "text")
 
-    if not os.path.exists(user_documents_path):
-        os.makedirs(user_documents_path)
-        os.makedirs(user_txt_path)
+    os.makedirs(user_documents_path, exist_ok=True)
+    os.makedirs(user_txt_path, exist_ok=True)
 
     sanitized_filename = document.file_name.replace(' ', '_')
     document_path = os.path.join(user_documents_path, sanitized_filename)
@@ -151,8 +352,15 @@ async def save_uploaded_document(message: Message, state: FSMContext):
     file = await message.bot.get_file(document.file_id)
     await message.bot.download_file(file.file_path, document_path)
 
-    await message.answer(f"✅ Документ '{sanitized_filename}' успешно загружен в контекст '{current_context}'!")
-    await processing_uploaded_docs(message, state)
+    # Обработка выполняется в фоне; документы, пришедшие пока задание ждет, попадут в него же
+    if ingest_queue.queued_job(user_id, current_context) is not None:
+        await message.answer(f"✅ Документ '{sanitized_filename}' загружен и будет обработан вместе с остальными.")
+        await ingest_queue.enqueue(user_id, current_context, message.chat.id)
+        return
+    # Сообщение о прогрессе отправляется до постановки: свободный воркер захватывает задание сразу
+    status = await message.answer(f"✅ Документ '{sanitized_filename}' загружен в контекст '{current_context}' "
+                                  f"и поставлен в очередь на обработку.")
+    await ingest_queue.enqueue(user_id, current_context, message.chat.id, status_message_id=status.message_id)
 
 
 # Команда для выбора документа для удаления
@@ -203,8 +411,17 @@ async def delete_document(callback: CallbackQuery, state: FSMContext):
     document_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "documents", document_name)
 
     if os.path.exists(document_path):
-        os.remove(document_path)
+        context_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context)
+        try:
+            requeue = await _remove_document(context_path, document_name)
+        except Exception as e:
+            logging.exception(f"Failed to remove document {document_name} from the RAG of context {current_context}: {e}")
+            await callback.message.answer(f"❌ Не удалось удалить данные документа '{document_name}' из RAG 😔")
+            return
         await callback.message.answer(f"✅ Файл '{document_name}' удалён.")
+        if requeue:
+            # Копии удаленного файла раньше пропускались - теперь они загружаются как самостоятельные документы
+            await ingest_queue.enqueue(user_id, current_context, callback.message.chat.id)
     else:
         await callback.message.answer(f"⚠ Файл '{document_name}' уже отсутствует.")
 
@@ -1,5 +1,7 @@
 import os
 import logging
+import time
+from typing import Dict, List, Optional, Tuple
 from aiogram import Router, F 
 from aiogram.types import KeyboardButton, Message, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
@@ -7,8 +9,15 @@ from aiogram.fsm.state import State, StatesGroup
 
 from lightrag import QueryParam
 
-from moduls.lightrag_module import build_rag
+from moduls.admission import KIND_QUERY, AdmissionRejected, admission
+from moduls.rag_pool import rag_pool
+from moduls.status_message import MessageStreamer, StatusMessage
+from moduls.answer_cache import answer_cache, normalize_question
+from moduls.metrics import histogram, stage
+from moduls.single_flight import SingleFlight
+from moduls.multi_query import MULTI_QUERY_MAX_CONTEXTS, multi_context_query
 from config import BASE_STORAGE_DIR
+from handlers.context import get_user_contexts
 from keyboards.document_menu import document_menu
 from keyboards.main_menu import main_menu
 
@@ -17,6 +26,14 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 router = Router()
 
 VALID_QUERY_MODES = ["naive", "local", "global", "hybrid", "mix"]
+# Потоковый вывод ответа по мере генерации (0 - ответ одним сообщением после генерации)
+ANSWER_STREAMING = os.getenv("ANSWER_STREAMING", "1") == "1"
+ANSWER_PREFIX = "💡 **Ответ:**\n\n"
+# Вместо списка контекстов - все контексты пользователя
+ALL_CONTEXTS = ("*", "все")
+
+# Одновременные одинаковые вопросы к одному контексту выполняются одним запросом
+query_flights = SingleFlight("rag_query")
 
 back_keyboard = ReplyKeyboardMarkup(
   keyboard=[[KeyboardButton(text="⬅️ Назад")]],
@@ -26,6 +43,30 @@ back_keyboard = ReplyKeyboardMarkup(
 class QuestionStates(StatesGroup):
   asking_questions_in_context = State()
 
+FIRST_TOKEN_SECONDS = histogram("answer_first_token_seconds", "Time from admission to the first answer fragment")
+
+
+async def deliver_answer(streamer: MessageStreamer, response, started: float) -> str:
+  """Выводит ответ LightRAG (строку или асинхронный поток фрагментов) и возвращает его полный текст."""
+  if isinstance(response, str) or response is None:
+    # Ответ из кэша LightRAG или сообщение об отсутствии контекста приходят строкой
+    chunks = [response] if response else []
+    for chunk in chunks:
+      await streamer.append(chunk)
+  else:
+    chunks = []
+    async for chunk in response:
+      if not chunks:
+        logging.info(f"First answer token after {time.perf_counter() - started:.1f}s")
+        FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+      chunks.append(chunk)
+      await streamer.append(chunk)
+  text = "".join(chunks)
+  if text.strip():
+    await streamer.finish()
+  return text
+
+
 @router.message(F.text.lower() == "задать вопрос")
 async def ask_for_question(message: Message, state: FSMContext):
   user_data = await state.get_data()
@@ -46,7 +87,10 @@ async def ask_for_question(message: Message, state: FSMContext):
     f" • `global` - Использует глобальные сущности и связи  графа знаний.\n"
     f" • `hybrid` - Комбинация local и global.\n\n"
     f" • `mix` - Комбинация векторного хранилища и графа знаний.\n\n"
-    f"*Пример:* `Каковы основные выводы документа? | naive`",
+    f"*Пример:* `Каковы основные выводы документа? | naive`\n\n"
+    f"Чтобы спросить сразу несколько контекстов, перечислите их через запятую третьей частью "
+    f"(не больше {MULTI_QUERY_MAX_CONTEXTS}) или укажите `*` - все ваши контексты:\n"
+    f"`Ваш вопрос | режим | контекст1, контекст2`",
     reply_markup=back_keyboard, # Убираем клавиатуру document_menu
     parse_mode="Markdown" # Используем Markdown для форматирования
   )
@@ -69,9 +113,9 @@ async def process_rag_question(message: Message, state: FSMContext):
     return
 
   user_input = message.text.strip()
-  parts = user_input.split("|", 1)
+  parts = user_input.split("|", 2)
 
-  if len(parts) != 2:
+  if len(parts) < 2:
     await message.answer(
       f"❗️ **Ошибка формата.** Пожалуйста, введите вопрос и режим, разделенные ' | ', или нажмите кнопку '⬅️ Назад'\n\n"
       f"**Пример:** `Текст вашего вопроса | naive`"
@@ -92,35 +136,223 @@ async def process_rag_question(message: Message, state: FSMContext):
     )
     return
 
-  await message.answer("⏳ Обработка вашего запроса...")
+  context_names = None
+  if len(parts) == 3:
+    context_names, problem = resolve_contexts(user_id, parts[2])
+    if problem:
+      await message.answer(problem)
+      return
+
+  status = await message.answer("⏳ Обработка вашего запроса...")
+  if context_names is not None:
+    await process_multi_context_question(message, state, status, context_names, question_text, query_mode)
+    return
   logging.info(f"User {user_id} asked in context '{current_context}': '{question_text}' with mode '{query_mode}'")
 
-  storage_dir = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context, "storage")
-  rag = None
+  context_path = os.path.join(BASE_STORAGE_DIR, str(user_id), current_context)
+  storage_dir = os.path.join(context_path, "storage")
+
+  # Повторный вопрос к неизменившемуся контексту отвечается из кэша, без поиска и LLM
+  cached = None
+  try:
+    cached = await answer_cache.lookup(context_path, question_text, query_mode)
+  except Exception as e:
+    logging.warning(f"Answer cache lookup failed for context '{current_context}' (User: {user_id}): {e!r}")
+  if cached is not None and cached.hit:
+    streamer = MessageStreamer(message.bot, message.chat.id, status.message_id, prefix=ANSWER_PREFIX)
+    await streamer.append(cached.answer)
+    await streamer.finish()
+    await message.answer("Введите следующий вопрос или нажмите '⬅️ Назад'.")
+    return
+
+  # При потоковом выводе ответ появляется правками сообщения "Обработка вашего запроса..."
+  streamer = MessageStreamer(message.bot, message.chat.id, status.message_id if ANSWER_STREAMING else None,
+                             prefix=ANSWER_PREFIX)
+  started = time.perf_counter()
+
+  # Такой же вопрос к этому контексту уже обрабатывается: ждем его ответ вместо второго запроса к LLM
+  flight, leader = query_flights.join((storage_dir, normalize_question(question_text), query_mode))
+  if not leader:
+    await _answer_as_follower(message, flight, streamer, started, f"context '{current_context}'")
+    return
+
+  await _lead_admitted(message, status, flight,
+                       lambda: _answer_as_leader(message, state, flight, streamer, cached, storage_dir,
+                                                 current_context, question_text, query_mode))
+
+
+def resolve_contexts(user_id: int, spec: str) -> Tuple[List[str], Optional[str]]:
+  """Контексты из третьей части вопроса (через запятую или '*') и текст ошибки, если список неверен."""
+  available = sorted(get_user_contexts(user_id))
+  names = []
+  for name in (part.strip() for part in spec.split(",")):
+    if name.lower() in ALL_CONTEXTS:
+      names = available
+      break
+    if name and name not in names:
+      names.append(name)
+
+  unknown = [name for name in names if name not in available]
+  if unknown:
+    return [], (f"❗️ Контексты не найдены: {', '.join(unknown)}.\n\n"
+                f"Ваши контексты: {', '.join(available) or 'нет'}.")
+  # Контекст без загруженных документов ничего не добавит к ответу
+  names = [name for name in names if os.path.isdir(os.path.join(BASE_STORAGE_DIR, str(user_id), name, "storage"))]
+  if not names:
+    return [], "❗️ В указанных контекстах нет загруженных документов."
+  if len(names) > MULTI_QUERY_MAX_CONTEXTS:
+    return [], f"❗️ В одном вопросе можно указать не больше {MULTI_QUERY_MAX_CONTEXTS} контекстов."
+  return names, None
+
+
+async def _answer_as_follower(message: Message, flight, streamer: MessageStreamer, started: float, where: str):
+  user_id = message.from_user.id
+  try:
+    response = await deliver_answer(streamer, flight.follow(), started)
+    if not response:
+      await message.answer("😕 Не удалось получить структурированный ответ от системы. Возможно, информация отсутствует или произошла внутренняя ошибка.")
+  except Exception as e:
+    logging.warning(f"Shared RAG query failed for {where} (User: {user_id}): {e}")
+    await message.answer("❌ Произошла ошибка во время обработки вашего запроса к RAG.")
+  await message.answer("Введите следующий вопрос или нажмите '⬅️ Назад'.")
+
+
+async def _lead_admitted(message: Message, status: Message, flight, answer):
+  """Выполняет answer() ведущего запроса после допуска или завершает flight отказом."""
+  try:
+    # При перегрузке вопрос ждет свободного слота, пользователь видит свое место в очереди
+    queue_status = StatusMessage(message.bot, message.chat.id, status.message_id, header="⏳ Обработка вашего запроса...")
+
+    async def show_position(position: int):
+      queue_status.update("queue", f"Сейчас много запросов, вы #{position} в очереди.")
+      await queue_status.flush()
+
+    async with admission.admit(message.from_user.id, KIND_QUERY, on_queued=show_position):
+      await answer()
+  except AdmissionRejected as e:
+    await query_flights.finish(flight, e)
+    await message.answer("😔 Сейчас слишком много запросов. Пожалуйста, повторите вопрос через минуту.")
+  except BaseException as e:
+    # Отмена в очереди допуска (остановка бота) или ошибка до ответа: присоединившиеся к запросу
+    # не должны ждать его вечно, а ключ - оставаться занятым
+    if not flight.done:
+      await query_flights.finish(flight, e)
+    raise
+
+
+async def process_multi_context_question(message: Message, state: FSMContext, status: Message,
+                                         context_names: List[str], question_text: str, query_mode: str):
+  """Вопрос к нескольким контекстам: общий поиск и один ответ LLM (moduls/multi_query.py), без кэша ответов."""
+  user_id = message.from_user.id
+  logging.info(f"User {user_id} asked in contexts {context_names}: '{question_text}' with mode '{query_mode}'")
+  storage_dirs = {name: os.path.join(BASE_STORAGE_DIR, str(user_id), name, "storage") for name in context_names}
+
+  streamer = MessageStreamer(message.bot, message.chat.id, status.message_id if ANSWER_STREAMING else None,
+                             prefix=ANSWER_PREFIX)
+  started = time.perf_counter()
+  flight, leader = query_flights.join(("multi", tuple(sorted(storage_dirs.values())),
+                                       normalize_question(question_text), query_mode))
+  if not leader:
+    await _answer_as_follower(message, flight, streamer, started, f"contexts {context_names}")
+    return
+
+  await _lead_admitted(message, status, flight,
+                       lambda: _answer_multi_as_leader(message, state, flight, streamer, storage_dirs,
+                                                       question_text, query_mode))
+
+
+async def _answer_multi_as_leader(message: Message, state: FSMContext, flight, streamer: MessageStreamer,
+                                  storage_dirs: Dict[str, str], question_text: str, query_mode: str):
+  user_id = message.from_user.id
+  started = time.perf_counter()
+  leases = {}
+  try:
+    # Аренды берутся по очереди в порядке путей: при параллельном захвате два таких вопроса
+    # и ожидающие загрузки документов могли бы заблокировать друг друга
+    for name, storage_dir in sorted(storage_dirs.items(), key=lambda item: item[1]):
+      leases[name] = await rag_pool.acquire(storage_dir)
+  except Exception as e:
+    logging.exception(f"Failed to initialize RAG for contexts {list(storage_dirs)} (User: {user_id}: {e})")
+    for lease in leases.values():
+      await lease.release()
+    await query_flights.finish(flight, e)
+    await message.answer("❌ Не удалось инициализировать RAG для выбранных контекстов. Попробуйте позже.")
+    await state.clear()
+    await message.answer("Запрос отменен.", reply_markup=document_menu)
+    return
+
+  error = None
+  try:
+    async with stage("rag_query", detail=f"multi/{query_mode}"):
+      response, summary = await multi_context_query({name: leases[name].rag for name in storage_dirs},
+                                                    question_text, query_mode, stream=ANSWER_STREAMING)
+    async with stage("answer", detail=f"multi/{query_mode}"):
+      response = await deliver_answer(streamer, flight.tee(response), started)
+    if response:
+      logging.info(f"Succsessfuly got multi-context answer for user {user_id} in {time.perf_counter() - started:.1f}s "
+                   f"({summary['used']} from {summary['used_contexts']})")
+      if summary["failed"]:
+        await message.answer(f"⚠️ Поиск не удался в контекстах: {', '.join(summary['failed'])}. "
+                             f"Ответ составлен по остальным.")
+    else:
+      logging.warning(f"RAG returned no multi-context answer for user {user_id}. Response: {response}")
+      await message.answer("😕 Не удалось получить структурированный ответ от системы. Возможно, информация отсутствует или произошла внутренняя ошибка.")
+
+  except Exception as e:
+    error = e
+    logging.exception(f"Error during multi-context RAG query (User: {user_id}): {e}")
+    await message.answer("❌ Произошла ошибка во время обработки вашего запроса к RAG.")
+
+  finally:
+    await query_flights.finish(flight, error)
+    for lease in leases.values():
+      await lease.release()
+    await message.answer("Введите следующий вопрос или нажмите '⬅️ Назад'.")
+
+
+async def _answer_as_leader(message: Message, state: FSMContext, flight, streamer: MessageStreamer, cached,
+                            storage_dir: str, current_context: str, question_text: str, query_mode: str):
+  user_id = message.from_user.id
+  # Время ответа считается без ожидания в очереди допуска
+  started = time.perf_counter()
+  lease = None
   try:
-    rag = await build_rag(storage_dir)
+    lease = await rag_pool.acquire(storage_dir)
     logging.info(f"RAG initialized seccessfuly for context '{current_context}' for user {user_id}")
   except Exception as e:
     logging.exception(f"Failed to initialize RAG for context '{current_context}' (User: {user_id}: {e})")
+    await query_flights.finish(flight, e)
     await message.answer("❌ Не удалось инициализировать RAG для этого контекста. Попробуйте позже.")
     await state.clear()
     await message.answer("Запрос отменен.", reply_markup=document_menu)
     return
 
+  error = None
   try:
-    response = await rag.aquery(question_text, param=QueryParam(mode=query_mode))
+    # rag_query - поиск и вызов LLM до начала ответа, answer - вывод ответа пользователю
+    async with stage("rag_query", detail=query_mode):
+      response = await lease.rag.aquery(question_text, param=QueryParam(mode=query_mode, stream=ANSWER_STREAMING))
+    # Фрагменты ответа публикуются и для присоединившихся к запросу пользователей
+    async with stage("answer", detail=query_mode):
+      response = await deliver_answer(streamer, flight.tee(response), started)
     if response:
-      logging.info(f"Succsessfuly got answer for user {user_id} in context '{current_context}'")
-      await message.answer(f"💡 **Ответ:**\n\n{response}")
+      elapsed = time.perf_counter() - started
+      logging.info(f"Succsessfuly got answer for user {user_id} in context '{current_context}' "
+                   f"in {elapsed:.1f}s ({streamer.edits} message updates)")
+      if cached is not None:
+        await answer_cache.store(cached, response, elapsed)
     else:
       logging.warning(f"RAG returned no answer or unexpected structure for user {user_id} in context '{current_context}'. Response: {response}")
       await message.answer("😕 Не удалось получить структурированный ответ от системы. Возможно, информация отсутствует или произошла внутренняя ошибка.")
 
   except Exception as e:
+    error = e
     logging.exception(f"Error during RAG query for context '{current_context}' (User: {user_id}): {e}")
     await message.answer("❌ Произошла ошибка во время обработки вашего запроса к RAG.")
   
   finally:
+    await query_flights.finish(flight, error)
+    await lease.release()
     await message.answer("Введите следующий вопрос или нажмите '⬅️ Назад'.")
 
 @router.message(QuestionStates.asking_questions_in_context, F.text.lower() == "⬅️ назад")
@@ -0,0 +1,283 @@
+# Файл: moduls/admission.py
+"""
+Контроль допуска тяжелых операций и частоты вызовов LLM.
+
+Раньше число одновременных rag.aquery и загрузок документов ничем не
+ограничивалось: всплеск пользователей превышал лимит запросов провайдера
+LLM, и все запросы разом падали с ошибкой. Теперь:
+  * AdmissionController выдает слоты на операцию: не больше
+    ADMISSION_MAX_ACTIVE операций всего, из них не больше
+    ADMISSION_MAX_INGEST загрузок (остальные слоты всегда достаются
+    вопросам) и не больше ADMISSION_PER_USER операций одного вида у одного
+    пользователя. Освободившийся слот получает ожидающий с наивысшим
+    приоритетом - вопросы (KIND_QUERY) раньше загрузок (KIND_INGEST), при
+    равном приоритете - кто раньше пришел;
+  * ожидающий получает свою позицию в очереди (on_queued) при постановке и
+    при ее изменении, не чаще раза в ADMISSION_POSITION_INTERVAL секунд;
+  * при ADMISSION_MAX_QUEUE ожидающих новые вопросы отклоняются
+    (AdmissionRejected) - лучше сразу попросить повторить позже, чем
+    держать пользователя минутами;
+  * TokenBucket ограничивает вызовы LLM частотой LLM_RATE_LIMIT_RPM в минуту
+    с запасом LLM_RATE_BURST; ожидающие вызовы обслуживаются по приоритету
+    операции, внутри которой они сделаны (вызовы LightRAG из вопроса
+    обгоняют извлечение сущностей загрузки).
+Время ожидания, число ожидавших и отклоненных операций - в stats().
+"""
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from moduls.metrics import record_span
+
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "8"))
+ADMISSION_MAX_INGEST = int(os.getenv("ADMISSION_MAX_INGEST", "2"))
+ADMISSION_PER_USER = int(os.getenv("ADMISSION_PER_USER", "1"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "50"))
+ADMISSION_POSITION_INTERVAL = float(os.getenv("ADMISSION_POSITION_INTERVAL", "3"))
+# 0 - без ограничения частоты вызовов LLM
+LLM_RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+
+KIND_QUERY = "query"
+KIND_INGEST = "ingest"
+# Меньше - важнее
+PRIORITIES = {KIND_QUERY: 0, KIND_INGEST: 1}
+
+# Приоритет операции, внутри которой выполняется код (наследуется задачами LightRAG)
+current_priority: ContextVar[int] = ContextVar("admission_priority", default=PRIORITIES[KIND_QUERY])
+
+QueuedCallback = Callable[[int], Awaitable[None]]
+
+_WAIT_SAMPLES = 1000
+
+
+class AdmissionRejected(Exception):
+    """Очередь ожидающих переполнена, операцию нужно повторить позже."""
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    user_id: int = field(compare=False)
+    kind: str = field(compare=False)
+    granted: asyncio.Future = field(compare=False)
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class AdmissionController:
+    """Слоты на тяжелые операции с лимитами на всех, на загрузки и на пользователя."""
+
+    def __init__(self, max_active: int = ADMISSION_MAX_ACTIVE, max_ingest: int = ADMISSION_MAX_INGEST,
+                 per_user: int = ADMISSION_PER_USER, max_queue: int = ADMISSION_MAX_QUEUE,
+                 position_interval: float = ADMISSION_POSITION_INTERVAL):
+        self.max_active = max_active
+        self.max_ingest = max_ingest
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.position_interval = position_interval
+        self._seq = itertools.count()
+        self._waiters: List[_Waiter] = []
+        self._active = 0
+        self._active_kinds: Counter = Counter()
+        self._active_users: Counter = Counter()
+        self.admitted: Counter = Counter()
+        self.queued: Counter = Counter()
+        self.rejected: Counter = Counter()
+        self._waits: Dict[str, Deque[float]] = {kind: deque(maxlen=_WAIT_SAMPLES) for kind in PRIORITIES}
+
+    def _can_run(self, user_id: int, kind: str) -> bool:
+        if self._active >= self.max_active:
+            return False
+        if kind == KIND_INGEST and self._active_kinds[KIND_INGEST] >= self.max_ingest:
+            return False
+        return self._active_users[(user_id, kind)] < self.per_user
+
+    def _take(self, user_id: int, kind: str):
+        self._active += 1
+        self._active_kinds[kind] += 1
+        self._active_users[(user_id, kind)] += 1
+
+    def _release(self, user_id: int, kind: str):
+        self._active -= 1
+        self._active_kinds[kind] -= 1
+        self._active_users[(user_id, kind)] -= 1
+        if not self._active_users[(user_id, kind)]:
+            del self._active_users[(user_id, kind)]
+        self._grant()
+
+    def _grant(self):
+        """Раздает свободные слоты ожидающим по приоритету; ожидающий, упершийся в свой лимит, не задерживает остальных."""
+        for waiter in list(self._waiters):
+            if waiter.granted.done():
+                self._waiters.remove(waiter)
+            elif self._can_run(waiter.user_id, waiter.kind):
+                self._take(waiter.user_id, waiter.kind)
+                waiter.granted.set_result(True)
+                self._waiters.remove(waiter)
+
+    def position(self, waiter: _Waiter) -> int:
+        return 1 + sum(1 for other in self._waiters if other < waiter and not other.granted.done())
+
+    async def _wait(self, waiter: _Waiter, on_queued: Optional[QueuedCallback]):
+        reported = None
+        while True:
+            position = self.position(waiter)
+            if on_queued is not None and position != reported:
+                reported = position
+                try:
+                    await on_queued(position)
+                except Exception as e:
+                    logging.warning(f"Admission: queue position callback failed: {e!r}")
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.granted), self.position_interval)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    @asynccontextmanager
+    async def admit(self, user_id: int, kind: str, on_queued: Optional[QueuedCallback] = None,
+                    reject_when_full: bool = True) -> AsyncIterator[None]:
+        """
+        Ждет слот для операции вида kind пользователя user_id. on_queued(position)
+        вызывается, если пришлось ждать. AdmissionRejected - очередь переполнена
+        (только при reject_when_full; загрузки из персистентной очереди ждут всегда).
+        """
+        priority = PRIORITIES[kind]
+        waiter = _Waiter(priority, next(self._seq), user_id, kind, asyncio.get_running_loop().create_future())
+        bisect.insort(self._waiters, waiter)
+        self._grant()
+        started = time.perf_counter()
+        if not waiter.granted.done():
+            if reject_when_full and len(self._waiters) > self.max_queue:
+                self._waiters.remove(waiter)
+                waiter.granted.cancel()
+                self.rejected[kind] += 1
+                logging.warning(f"Admission: rejected {kind} of user {user_id}, {len(self._waiters)} operations waiting")
+                raise AdmissionRejected(f"{len(self._waiters)} operations waiting")
+            self.queued[kind] += 1
+            try:
+                await self._wait(waiter, on_queued)
+            except BaseException:
+                # Отмена ожидания: уже выданный слот возвращается
+                if waiter.granted.done() and not waiter.granted.cancelled():
+                    self._release(user_id, kind)
+                else:
+                    waiter.granted.cancel()
+                    self._grant()
+                raise
+            waited = time.perf_counter() - started
+            logging.info(f"Admission: {kind} of user {user_id} waited {waited:.1f}s for a slot")
+            record_span("admission_wait", time.time() - waited, waited, detail=kind)
+        else:
+            waited = 0.0
+        self.admitted[kind] += 1
+        self._waits[kind].append(waited)
+        token = current_priority.set(priority)
+        try:
+            yield
+        finally:
+            current_priority.reset(token)
+            self._release(user_id, kind)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "active_ingest": self._active_kinds[KIND_INGEST],
+            "waiting": sum(1 for waiter in self._waiters if not waiter.granted.done()),
+            "admitted": dict(self.admitted),
+            "queued": dict(self.queued),
+            "rejected": dict(self.rejected),
+            "wait_p50_seconds": {kind: _percentile(list(waits), 0.5) for kind, waits in self._waits.items()},
+            "wait_p95_seconds": {kind: _percentile(list(waits), 0.95) for kind, waits in self._waits.items()},
+        }
+
+
+class TokenBucket:
+    """Ограничение частоты вызовов: rate_per_minute в минуту, до burst подряд; ожидающие - по приоритету."""
+
+    def __init__(self, rate_per_minute: float = LLM_RATE_LIMIT_RPM, burst: int = LLM_RATE_BURST):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.calls = 0
+        self.waited_calls = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: Optional[int] = None):
+        """Ждет разрешения на один вызов."""
+        self.calls += 1
+        if self.rate <= 0:
+            return
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (current_priority.get() if priority is None else priority,
+                                       next(self._seq), granted))
+        self._schedule()
+        started = time.monotonic()
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                self._tokens += 1
+            raise
+        self.waited_calls += 1
+        self.wait_seconds += time.monotonic() - started
+
+    def _schedule(self):
+        if self._timer is not None or not self._waiters:
+            return
+        delay = max(0.0, (1 - self._tokens) / self.rate)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, granted = heapq.heappop(self._waiters)
+            if granted.done():
+                continue
+            self._tokens -= 1
+            granted.set_result(None)
+        self._schedule()
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_minute": self.rate * 60,
+            "calls": self.calls,
+            "waiting": len(self._waiters),
+            "waited_calls": self.waited_calls,
+            "wait_seconds": self.wait_seconds,
+        }
+
+
+# Общие для процесса контроль допуска и ограничение вызовов LLM
+admission = AdmissionController()
+llm_rate_limiter = TokenBucket()
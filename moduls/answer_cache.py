@@ -0,0 +1,231 @@
+# Файл: moduls/answer_cache.py
+"""
+Кэш ответов на вопросы к контексту.
+
+Пользователи многократно задают одни и те же вопросы к одним и тем же
+контекстам ("каковы основные выводы документа?"), и каждый раз выполняются
+полный поиск и вызов LLM. Ответ кэшируется в SQLite в директории контекста
+(answer_cache.sqlite3) с ключом из нормализованного вопроса, режима запроса
+и версии содержимого контекста из манифеста загрузки
+(IngestManifest.content_version). Версия увеличивается при каждом
+добавлении и удалении документа, поэтому ответы, полученные по старому
+набору документов, перестают находиться автоматически и удаляются при
+следующей записи.
+
+При ANSWER_CACHE_SEMANTIC=1 вопрос, не найденный точно, сравнивается по
+косинусной близости эмбеддинга (общая модель embedding_service) с уже
+закэшированными вопросами того же режима; ответ берется при близости не
+ниже ANSWER_CACHE_SIMILARITY.
+
+Работа с SQLite и сравнение эмбеддингов выполняются в потоке (asyncio.to_thread):
+файл кэша лежит в директории контекста, и поиск не должен останавливать
+event loop бота, пока диск занят загрузкой документов.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from moduls.ingest_manifest import IngestManifest
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "0") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_FILE_NAME = "answer_cache.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    content_version INTEGER NOT NULL,
+    answer TEXT NOT NULL,
+    embedding BLOB,
+    latency REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_lookup ON answers (content_version, mode);
+"""
+
+
+def normalize_question(question: str) -> str:
+    """Приводит вопрос к каноническому виду: регистр, ё, пробелы и концевая пунктуация не важны."""
+    text = question.lower().replace("ё", "е")
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!.…; ").strip()
+
+
+def answer_key(question: str, mode: str, content_version: int) -> str:
+    return hashlib.sha256(f"{content_version}\x00{mode}\x00{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+
+@dataclass
+class AnswerProbe:
+    """Результат поиска в кэше; нужен для записи ответа после промаха."""
+    context_path: str
+    question: str
+    mode: str
+    content_version: int
+    key: str
+    embedding: Optional[np.ndarray] = None
+    answer: Optional[str] = None
+    similarity: Optional[float] = None
+    saved_seconds: float = 0.0
+
+    @property
+    def hit(self) -> bool:
+        return self.answer is not None
+
+
+class AnswerCache:
+    """Кэш ответов; данные хранятся в директории каждого контекста, статистика - на процесс."""
+
+    def __init__(self, enabled: bool = ANSWER_CACHE_ENABLED, semantic: bool = ANSWER_CACHE_SEMANTIC,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 embedder=None):
+        self.enabled = enabled
+        self.semantic = semantic
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self._embedder = embedder
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # Файлы кэша, в которых схема уже создана этим процессом
+        self._schema_ready = set()
+
+    @contextmanager
+    def _connect(self, context_path: str):
+        path = os.path.join(context_path, ANSWER_CACHE_FILE_NAME)
+        # Файла может не быть после удаления и повторного создания контекста с тем же именем
+        fresh = path not in self._schema_ready or not os.path.exists(path)
+        db = sqlite3.connect(path)
+        try:
+            if fresh:
+                db.executescript(_SCHEMA)
+                self._schema_ready.add(path)
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    async def _embed(self, question: str) -> Optional[np.ndarray]:
+        if self._embedder is None:
+            from moduls.embedding_service import embedding_service
+            self._embedder = embedding_service
+        try:
+            vector = np.asarray((await self._embedder.embed([normalize_question(question)]))[0], dtype=np.float32)
+        except Exception as e:
+            logging.warning(f"Answer cache: failed to embed question: {e!r}")
+            return None
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    @staticmethod
+    def _content_version(context_path: str) -> int:
+        with IngestManifest(context_path) as manifest:
+            return manifest.content_version
+
+    def _find(self, probe: AnswerProbe):
+        """Запись с ответом (key, answer, latency) или None; при probe.embedding - и по близости вопроса."""
+        with self._connect(probe.context_path) as db:
+            row = db.execute("SELECT key, answer, latency FROM answers WHERE key = ?", (probe.key,)).fetchone()
+            if row is None and probe.embedding is not None:
+                row = self._nearest(db, probe)
+            if row is not None:
+                db.execute("UPDATE answers SET hits = hits + 1, last_used = ? WHERE key = ?", (time.time(), row[0]))
+            return row
+
+    async def lookup(self, context_path: str, question: str, mode: str) -> AnswerProbe:
+        """Ищет ответ: сначала точное совпадение нормализованного вопроса, затем (опционально) близкий вопрос."""
+        content_version = await asyncio.to_thread(self._content_version, context_path)
+        probe = AnswerProbe(context_path=context_path, question=question, mode=mode,
+                            content_version=content_version, key=answer_key(question, mode, content_version))
+        if not self.enabled:
+            return probe
+
+        row = await asyncio.to_thread(self._find, probe)
+        if row is None and self.semantic:
+            probe.embedding = await self._embed(question)
+            if probe.embedding is not None:
+                row = await asyncio.to_thread(self._find, probe)
+        if row is None:
+            self.misses += 1
+            return probe
+        _, probe.answer, probe.saved_seconds = row
+
+        if probe.similarity is None:
+            self.exact_hits += 1
+        else:
+            self.semantic_hits += 1
+        self.saved_seconds += probe.saved_seconds
+        stats = self.stats()
+        logging.info(f"Answer cache hit for '{question}' ({mode}) in {context_path}"
+                     + (f", similarity {probe.similarity:.3f}" if probe.similarity is not None else "")
+                     + f"; hit rate {stats['hit_rate']:.0%}, saved {stats['saved_seconds']:.0f}s in total")
+        return probe
+
+    def _nearest(self, db: sqlite3.Connection, probe: AnswerProbe):
+        rows = db.execute("SELECT key, answer, latency, embedding FROM answers "
+                          "WHERE content_version = ? AND mode = ? AND embedding IS NOT NULL",
+                          (probe.content_version, probe.mode)).fetchall()
+        rows = [row for row in rows if len(row[3]) == probe.embedding.nbytes]
+        if not rows:
+            return None
+        matrix = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        scores = matrix @ probe.embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        probe.similarity = float(scores[best])
+        return rows[best][:3]
+
+    async def store(self, probe: AnswerProbe, answer: str, latency: float):
+        """Сохраняет полученный ответ; записи прежних версий контекста удаляются."""
+        if not self.enabled or not answer or not answer.strip():
+            return
+        if await asyncio.to_thread(self._content_version, probe.context_path) != probe.content_version:
+            # Пока готовился ответ, документы контекста изменились - ответ может быть устаревшим
+            return
+        if self.semantic and probe.embedding is None:
+            probe.embedding = await self._embed(probe.question)
+        await asyncio.to_thread(self._store, probe, answer, latency)
+
+    def _store(self, probe: AnswerProbe, answer: str, latency: float):
+        now = time.time()
+        with self._connect(probe.context_path) as db:
+            db.execute("DELETE FROM answers WHERE content_version < ?", (probe.content_version,))
+            db.execute(
+                "INSERT OR REPLACE INTO answers (key, question, mode, content_version, answer, embedding, latency, "
+                "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (probe.key, normalize_question(probe.question), probe.mode, probe.content_version, answer,
+                 probe.embedding.tobytes() if probe.embedding is not None else None, latency, now, now))
+            db.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used DESC "
+                       "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self) -> dict:
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else None,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+# Общий для процесса кэш ответов
+answer_cache = AnswerCache()
@@ -0,0 +1,228 @@
+# Файл: moduls/doc_converter.py
+"""
+Сервис конвертации DOC -> DOCX через headless LibreOffice.
+
+Раньше convert_doc_to_docx на каждую загрузку .doc синхронно запускал новый
+soffice с общим пользовательским профилем: несколько секунд холодного старта,
+блокировка цикла событий и ошибки при двух одновременных конвертациях
+(профиль LibreOffice нельзя использовать из двух процессов сразу).
+
+Здесь держится небольшой пул "исполнителей", у каждого свой изолированный
+профиль (-env:UserInstallation), который создается и прогревается один раз
+при старте бота - это основная часть холодного старта soffice. Конвертации
+запускаются асинхронно (asyncio subprocess), ждут свободного исполнителя в
+очереди, ограничены таймаутом; зависший процесс убивается, а профиль
+исполнителя пересоздается и прогревается заново.
+
+Команда конвертера настраивается (SOFFICE_BINARY), поэтому для тестов можно
+подставить локальную заглушку, например bench/fake_soffice.py.
+"""
+import asyncio
+import logging
+import os
+import shlex
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
+
+from moduls.metrics import stage
+
+SOFFICE_BINARY = os.getenv("SOFFICE_BINARY", "soffice")
+DOC_CONVERTER_WORKERS = int(os.getenv("DOC_CONVERTER_WORKERS", "2"))
+DOC_CONVERTER_TIMEOUT = float(os.getenv("DOC_CONVERTER_TIMEOUT", "120"))
+DOC_CONVERTER_PROFILE_DIR = os.getenv("DOC_CONVERTER_PROFILE_DIR",
+                                      os.path.join(tempfile.gettempdir(), "maria_bot_soffice"))
+# После стольких ошибок подряд профиль исполнителя пересоздается
+_MAX_CONSECUTIVE_FAILURES = 3
+
+
+class ConversionError(Exception):
+    """Ошибка конвертации документа."""
+
+
+class _SofficeWorker:
+    """Исполнитель с собственным профилем LibreOffice."""
+
+    def __init__(self, index: int, binary: List[str], profile_root: str, instance: int = 0):
+        self.index = index
+        self.binary = binary
+        self.profile_dir = self.profile_path(profile_root, instance, index)
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.warm = False
+        self.conversions = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.restarts = 0
+
+    @staticmethod
+    def profile_path(profile_root: str, instance: int, index: int) -> str:
+        # Номера исполнителей одинаковы во всех процессах бота (webhook.py) - профили разделены по процессам
+        return os.path.join(profile_root, f"process-{instance}", f"worker-{index}")
+
+    def _base_cmd(self) -> List[str]:
+        return self.binary + [
+            "--headless", "--norestore", "--nologo", "--nodefault", "--nolockcheck",
+            f"-env:UserInstallation={Path(self.profile_dir).resolve().as_uri()}",
+        ]
+
+    async def _run(self, cmd: List[str], timeout: float):
+        self.process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(self.process.communicate(), timeout)
+            return self.process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.kill()
+            raise
+        finally:
+            self.process = None
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def warm_up(self, timeout: float):
+        """Создает профиль: первый запуск soffice с пустым профилем - самый долгий."""
+        started = time.perf_counter()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        code, _, stderr = await self._run(self._base_cmd() + ["--terminate_after_init"], timeout)
+        if code != 0:
+            raise ConversionError(f"soffice warm-up failed with code {code}: {stderr.strip()}")
+        self.warm = True
+        logging.info(f"soffice worker {self.index} warmed up in {time.perf_counter() - started:.1f}s")
+
+    async def restart(self, timeout: float):
+        """Пересоздает профиль исполнителя (после зависания или серии ошибок)."""
+        self.kill()
+        self.warm = False
+        self.restarts += 1
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        try:
+            await self.warm_up(timeout)
+        except Exception as e:
+            logging.warning(f"soffice worker {self.index} failed to restart: {e}")
+
+    async def convert(self, doc_path: str, output_dir: str, timeout: float) -> str:
+        output_path = Path(output_dir) / (Path(doc_path).stem + ".docx")
+        cmd = self._base_cmd() + ["--convert-to", "docx", "--outdir", str(output_dir), str(doc_path)]
+        logging.info(f"soffice worker {self.index}: converting {doc_path}")
+        code, stdout, stderr = await self._run(cmd, timeout)
+        if code != 0 or not output_path.exists():
+            if output_path.exists():
+                output_path.unlink()
+            raise ConversionError(f"Failed to convert {doc_path} (code {code}): {stderr.strip() or stdout.strip()}")
+        return str(output_path)
+
+
+class DocConverterService:
+    """Пул прогретых конвертеров soffice с очередью, таймаутами и автоперезапуском."""
+
+    def __init__(self, workers: int = DOC_CONVERTER_WORKERS,
+                 timeout: float = DOC_CONVERTER_TIMEOUT,
+                 binary: str = SOFFICE_BINARY,
+                 profile_root: str = DOC_CONVERTER_PROFILE_DIR):
+        self.timeout = timeout
+        self.profile_root = profile_root
+        self._workers = [_SofficeWorker(i, shlex.split(binary), profile_root) for i in range(workers)]
+        self._idle: Optional[asyncio.Queue] = None
+        self.waiting = 0
+
+    def _ensure_queue(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+
+    async def start(self, instance: int = 0):
+        """
+        Прогревает профили всех исполнителей. Ошибки прогрева не фатальны.
+        instance - номер процесса бота (webhook.py): у каждого процесса свои
+        профили. На время прогрева исполнитель забирается из очереди
+        свободных, чтобы конвертация не запустила второй soffice на том же
+        профиле; в очередь он возвращается сразу после своего прогрева.
+        """
+        self._ensure_queue()
+        workers = [await self._idle.get() for _ in self._workers]
+        for worker in workers:
+            worker.profile_dir = worker.profile_path(self.profile_root, instance, worker.index)
+
+        async def warm_up(worker: _SofficeWorker):
+            try:
+                await worker.warm_up(self.timeout)
+            except Exception as e:
+                logging.warning(f"soffice worker {worker.index} warm-up failed: {e!r}")
+            finally:
+                self._idle.put_nowait(worker)
+
+        await asyncio.gather(*(warm_up(worker) for worker in workers))
+
+    async def convert(self, doc_path: str, output_dir: str) -> str:
+        """Конвертирует DOC в DOCX и возвращает путь к результату."""
+        if not Path(doc_path).exists():
+            raise ConversionError(f"DOC file not found: {doc_path}")
+        self._ensure_queue()
+        self.waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.waiting -= 1
+        try:
+            try:
+                async with stage("soffice_convert"):
+                    result = await worker.convert(doc_path, output_dir, self.timeout)
+            except asyncio.TimeoutError:
+                worker.failures += 1
+                logging.error(f"soffice worker {worker.index}: conversion of {doc_path} timed out, restarting")
+                await worker.restart(self.timeout)
+                raise ConversionError(f"Conversion of {doc_path} exceeded {self.timeout:.0f}s")
+            except FileNotFoundError:
+                raise ConversionError("`soffice` command not found. Is LibreOffice installed and in the system's PATH?")
+            except ConversionError:
+                worker.failures += 1
+                worker.consecutive_failures += 1
+                if worker.consecutive_failures >= _MAX_CONSECUTIVE_FAILURES:
+                    logging.warning(f"soffice worker {worker.index}: {worker.consecutive_failures} failures in a row, restarting")
+                    worker.consecutive_failures = 0
+                    await worker.restart(self.timeout)
+                raise
+            worker.conversions += 1
+            worker.consecutive_failures = 0
+            return result
+        finally:
+            self._idle.put_nowait(worker)
+
+    @asynccontextmanager
+    async def as_docx(self, file_path: str):
+        """
+        Для .doc отдает путь к сконвертированному DOCX во временной директории
+        (удаляется при выходе), для остальных форматов - исходный путь.
+        """
+        if Path(file_path).suffix.lower() != ".doc":
+            yield file_path
+            return
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield await self.convert(file_path, temp_dir)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._workers),
+            "idle": self._idle.qsize() if self._idle is not None else len(self._workers),
+            "waiting": self.waiting,
+            "conversions": sum(worker.conversions for worker in self._workers),
+            "failures": sum(worker.failures for worker in self._workers),
+            "restarts": sum(worker.restarts for worker in self._workers),
+        }
+
+    async def close(self):
+        for worker in self._workers:
+            worker.kill()
+
+
+# Общий для процесса сервис
+doc_converter = DocConverterService()
@@ -0,0 +1,222 @@
+# Файл: moduls/embedding_cache.py
+"""
+Персистентный кэш эмбеддингов с адресацией по содержимому.
+
+Повторная загрузка документа или загрузка одного файла в несколько
+контекстов раньше заново прогоняла одинаковые чанки через модель. Ключ кэша -
+SHA-256 от идентификатора модели и текста чанка. Векторы хранятся строками
+фиксированной ширины (float32) в memory-mapped файле, индекс ключ -> слот
+и время последнего обращения - в SQLite. При заполнении вытесняются
+давно не использованные записи (LRU).
+
+Кэш может быть общим для нескольких процессов (webhook.py): между чтением
+индекса и чтением вектора другой процесс может вытеснить слот и записать в
+него вектор другого текста. Поэтому рядом с каждым вектором хранится ключ
+записи (keys.bin): запись обнуляет его, пишет вектор и затем новый ключ, а
+чтение принимает вектор, только если ключ слота совпадал до и после чтения.
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", os.path.join("data", "embed_cache"))
+EMBED_CACHE_MAX_ITEMS = int(os.getenv("EMBED_CACHE_MAX_ITEMS", "50000"))
+# Ключ записи в слоте - SHA-256 (32 байта)
+_KEY_BYTES = 32
+
+
+def content_key(model_id: str, text: str) -> str:
+    """Ключ кэша: хэш идентификатора модели и текста."""
+    return hashlib.sha256(f"{model_id}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Дисковый кэш векторов для одной модели эмбеддингов."""
+
+    def __init__(self, model_id: str, cache_dir: str = EMBED_CACHE_DIR,
+                 max_items: int = EMBED_CACHE_MAX_ITEMS):
+        self.model_id = model_id
+        self.max_items = max_items
+        # Отдельная поддиректория на модель: у разных моделей разная размерность
+        self.cache_dir = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", model_id))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._db.commit()
+        self._vectors: Optional[np.memmap] = None
+        self._slot_keys: Optional[np.memmap] = None
+        self.dim: Optional[int] = None
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row is not None:
+            self._open_vectors(int(row[0]))
+        # Число записей для stats(): обновляется при записи, stats() не ждет _lock и SQLite
+        self._items = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_reads = 0
+
+    def _open_vectors(self, dim: int):
+        path = os.path.join(self.cache_dir, "vectors.f32")
+        keys_path = os.path.join(self.cache_dir, "keys.bin")
+        if not os.path.exists(keys_path):
+            # Кэш без ключей слотов (созданный до их появления) проверить нельзя - начинаем заново
+            self._db.execute("DELETE FROM entries")
+        # Размер файлов подгоняется под текущий лимит (лимит мог измениться между запусками)
+        with open(path, "ab") as vectors_file:
+            vectors_file.truncate(self.max_items * dim * 4)
+        with open(keys_path, "ab") as keys_file:
+            keys_file.truncate(self.max_items * _KEY_BYTES)
+        self._db.execute("DELETE FROM entries WHERE slot >= ?", (self.max_items,))
+        self._db.commit()
+        self._vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(self.max_items, dim))
+        self._slot_keys = np.memmap(keys_path, dtype=np.uint8, mode="r+", shape=(self.max_items, _KEY_BYTES))
+        self.dim = dim
+
+    def _read_slot(self, slot: int, key: str) -> Optional[np.ndarray]:
+        """Вектор слота, если во время чтения в слоте лежала запись key, иначе None."""
+        expected = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+        if not np.array_equal(self._slot_keys[slot], expected):
+            return None
+        vector = np.array(self._vectors[slot])
+        if not np.array_equal(self._slot_keys[slot], expected):
+            return None
+        return vector
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Возвращает вектор для каждого текста или None, если его нет в кэше."""
+        keys = [content_key(self.model_id, text) for text in texts]
+        result: List[Optional[np.ndarray]] = [None] * len(texts)
+        if self._vectors is None:
+            self.misses += len(texts)
+            return result
+        with self._lock:
+            slots = {}
+            unique_keys = list(set(keys))
+            # SQLite ограничивает число параметров в запросе
+            for start in range(0, len(unique_keys), 500):
+                part = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                for key, slot in self._db.execute(
+                        f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", part):
+                    slots[key] = slot
+            if slots:
+                now = time.time()
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                     [(now, key) for key in slots])
+                self._db.commit()
+            for i, key in enumerate(keys):
+                slot = slots.get(key)
+                if slot is not None:
+                    result[i] = self._read_slot(slot, key)
+                    if result[i] is None:
+                        # Слот вытеснен и перезаписан другим процессом после чтения индекса
+                        self.stale_reads += 1
+        hits = sum(vector is not None for vector in result)
+        self.hits += hits
+        self.misses += len(texts) - hits
+        return result
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray):
+        """Сохраняет векторы, при необходимости вытесняя самые старые записи."""
+        if len(texts) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self._vectors is None:
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)",
+                                 (str(vectors.shape[1]),))
+                self._open_vectors(vectors.shape[1])
+            elif vectors.shape[1] != self.dim:
+                logging.warning(f"Embedding cache: dimension mismatch ({vectors.shape[1]} != {self.dim}), skipping")
+                return
+
+            # Кэш может быть общим для нескольких процессов бота (webhook.py):
+            # BEGIN IMMEDIATE сериализует между ними выбор ключей и слотов
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._put_locked(texts, vectors)
+            except BaseException:
+                self._db.rollback()
+                raise
+            self._db.commit()
+
+    def _put_locked(self, texts: Sequence[str], vectors: np.ndarray):
+        pending = {}
+        for text, vector in zip(texts, vectors):
+            pending[content_key(self.model_id, text)] = vector
+        known = set()
+        keys = list(pending)
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            known.update(key for (key,) in self._db.execute(
+                f"SELECT key FROM entries WHERE key IN ({placeholders})", part))
+        new_keys = [key for key in keys if key not in known][:self.max_items]
+        if not new_keys:
+            return
+
+        # Пока кэш не заполнен, слоты занимаются подряд; после заполнения
+        # освобождаются только вытеснением и сразу переиспользуются
+        used = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if used < self.max_items:
+            taken = {slot for (slot,) in self._db.execute("SELECT slot FROM entries WHERE slot >= ?", (used,))}
+            free_slots = [slot for slot in range(used, self.max_items) if slot not in taken][:len(new_keys)]
+        else:
+            free_slots = []
+        evicted = []
+        shortage = len(new_keys) - len(free_slots)
+        if shortage > 0:
+            evicted = self._db.execute(
+                "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (shortage,)).fetchall()
+            self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+            free_slots.extend(slot for _, slot in evicted)
+            self.evictions += len(evicted)
+
+        now = time.time()
+        for key, slot in zip(new_keys, free_slots):
+            # Пока вектор перезаписывается, ключ слота не совпадает ни с одной записью
+            self._slot_keys[slot] = 0
+            self._vectors[slot] = pending[key]
+            self._slot_keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+        self._vectors.flush()
+        self._slot_keys.flush()
+        self._db.executemany("INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                             [(key, slot, now) for key, slot in zip(new_keys, free_slots)])
+        self._items = used - len(evicted) + min(len(new_keys), len(free_slots))
+
+    def __len__(self) -> int:
+        return self._items
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "items": self._items,
+            "max_items": self.max_items,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else None,
+            "evictions": self.evictions,
+            "stale_reads": self.stale_reads,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._slot_keys.flush()
+                self._vectors = None
+                self._slot_keys = None
+            self._db.close()
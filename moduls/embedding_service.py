@@ -0,0 +1,343 @@
+# Файл: moduls/embedding_service.py
+"""
+Общий для процесса сервис эмбеддингов.
+
+Раньше EmbeddingFunc в build_rag вызывал AutoTokenizer.from_pretrained и
+AutoModel.from_pretrained внутри лямбды, то есть веса модели перечитывались с
+диска на каждый пакет эмбеддингов. Здесь модель загружается один раз (лениво
+или при старте бота) и переиспользуется всеми экземплярами LightRAG.
+
+Запросы на эмбеддинги от разных пользователей (rag.ainsert, rag.aquery)
+собираются в микропакеты: тексты копятся до EMBED_BATCH_WAIT_MS миллисекунд
+или до EMBED_BATCH_MAX_ITEMS штук, сортируются по длине в токенах, чтобы
+уменьшить паддинг, и прогоняются через модель в отдельном потоке. Каждый
+вызывающий получает обратно свои строки матрицы.
+"""
+import asyncio
+import gc
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import EMBED_TOKENIZER_NAME, MAX_TOKEN_SIZE_EMBED
+from moduls.embedding_cache import EmbeddingCache
+from moduls.metrics import SIZE_BUCKETS, histogram, record_span, trace_id
+
+EMBED_PRELOAD = os.getenv("EMBED_PRELOAD", "1") == "1"
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "64"))
+# Максимум токенов (с учетом паддинга) в одном прямом проходе модели
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "16384"))
+
+# Сколько последних задержек хранить для расчета перцентилей
+_LATENCY_WINDOW = 10000
+
+EMBED_BATCH_ITEMS = histogram("embed_batch_items", "Texts per embedding model call", SIZE_BUCKETS)
+
+
+def get_rss_bytes() -> int:
+    """Текущий резидентный объем памяти процесса (RSS) в байтах."""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Запасной вариант: пиковый RSS (в КБ на Linux, в байтах на macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class EmbeddingService:
+    """Лениво загружаемая HF-модель эмбеддингов, одна на процесс."""
+
+    def __init__(self, model_name: str = EMBED_TOKENIZER_NAME,
+                 max_length: int = MAX_TOKEN_SIZE_EMBED,
+                 max_batch_tokens: int = EMBED_MAX_BATCH_TOKENS):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.max_batch_tokens = max_batch_tokens
+        self.tokenizer = None
+        self.model = None
+        self.load_seconds: Optional[float] = None
+        self.rss_delta_bytes: Optional[int] = None
+        self._load_lock = threading.Lock()
+        self._forward_lock = threading.Lock()
+        self._batcher: Optional["BatchingEmbedder"] = None
+        # Дисковый кэш открывается при первом вычислении эмбеддингов, а не при импорте модуля
+        self.cache_enabled = EMBED_CACHE_ENABLED
+        self.cache: Optional[EmbeddingCache] = None
+        self._cache_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    def _load_sync(self):
+        with self._load_lock:
+            if self.model is not None:
+                return
+            from transformers import AutoModel, AutoTokenizer
+
+            rss_before = get_rss_bytes()
+            started = time.perf_counter()
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name, device_map="auto")
+            model = AutoModel.from_pretrained(self.model_name, device_map="auto")
+            model.eval()
+            self.load_seconds = time.perf_counter() - started
+            self.rss_delta_bytes = get_rss_bytes() - rss_before
+            self.tokenizer = tokenizer
+            self.model = model
+            logging.info(f"Embedding model '{self.model_name}' loaded in {self.load_seconds:.2f}s, "
+                         f"resident memory +{self.rss_delta_bytes / 1024 / 1024:.1f} MB "
+                         f"(process RSS {get_rss_bytes() / 1024 / 1024:.1f} MB)")
+
+    async def load(self):
+        """Загружает модель в отдельном потоке, не блокируя цикл событий."""
+        if self.model is None:
+            await asyncio.to_thread(self._load_sync)
+
+    def encode_sync(self, texts: List[str]) -> np.ndarray:
+        """
+        Синхронно считает эмбеддинги (вызывается из рабочего потока).
+        Тексты сортируются по длине в токенах и режутся на проходы не больше
+        max_batch_tokens токенов с учетом паддинга, каждый проход дополняется
+        только до своей максимальной длины.
+        """
+        import torch
+
+        self._load_sync()
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+        input_ids = encoded["input_ids"]
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+
+        # Разбиение отсортированных текстов на проходы с ограничением по токенам
+        passes: List[List[int]] = []
+        current: List[int] = []
+        for idx in order:
+            longest = len(input_ids[idx])  # текущий текст самый длинный в проходе
+            if current and longest * (len(current) + 1) > self.max_batch_tokens:
+                passes.append(current)
+                current = []
+            current.append(idx)
+        if current:
+            passes.append(current)
+
+        device = next(self.model.parameters()).device
+        result: Optional[np.ndarray] = None
+        with self._forward_lock, torch.no_grad():
+            for indices in passes:
+                features = [{key: encoded[key][i] for key in encoded.keys()} for i in indices]
+                batch = self.tokenizer.pad(features, padding=True, return_tensors="pt").to(device)
+                outputs = self.model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"])
+                # Среднее по токенам с учетом маски: результат не зависит от паддинга,
+                # то есть от того, с какими текстами попал в пакет данный текст
+                mask = batch["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+                summed = (outputs.last_hidden_state * mask).sum(dim=1)
+                pooled = summed / mask.sum(dim=1).clamp(min=1)
+                rows = pooled.float().cpu().numpy()
+                if result is None:
+                    result = np.empty((len(texts), rows.shape[1]), dtype=np.float32)
+                result[indices] = rows
+        return result if result is not None else np.empty((0, 0), dtype=np.float32)
+
+    def _cache_get_sync(self, texts: List[str]) -> Optional[List[Optional[np.ndarray]]]:
+        """Векторы из дискового кэша (None - кэш недоступен); при первом вызове открывает кэш."""
+        with self._cache_lock:
+            if self.cache is None and self.cache_enabled:
+                try:
+                    self.cache = EmbeddingCache(self.model_name)
+                except Exception as e:
+                    logging.warning(f"Embedding cache is unavailable, continuing without it: {e!r}")
+                    self.cache_enabled = False
+            cache = self.cache
+        return cache.get_many(texts) if cache is not None else None
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Возвращает эмбеддинги для списка текстов. Сначала проверяется дисковый
+        кэш, через модель (общую очередь микропакетов) идут только промахи.
+        Чтение и запись кэша (SQLite, сброс memmap) выполняются в потоке.
+        """
+        if self._batcher is None:
+            self._batcher = BatchingEmbedder(self)
+        cached = await asyncio.to_thread(self._cache_get_sync, texts) if self.cache_enabled and texts else None
+        if cached is None:
+            return await self._batcher.embed(texts)
+
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+        computed = {}
+        if missing:
+            vectors = await self._batcher.embed(missing)
+            await asyncio.to_thread(self.cache.put_many, missing, vectors)
+            computed = dict(zip(missing, vectors))
+        return np.stack([vector if vector is not None else computed[text]
+                         for text, vector in zip(texts, cached)])
+
+    def stats(self) -> dict:
+        stats = {
+            "model": self.model_name,
+            "loaded": self.loaded,
+            "load_seconds": self.load_seconds,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "process_rss_bytes": get_rss_bytes(),
+        }
+        if self._batcher is not None:
+            stats["batching"] = self._batcher.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    async def shutdown(self):
+        """Останавливает очередь микропакетов и освобождает модель и память устройства."""
+        if self._batcher is not None:
+            await self._batcher.close()
+            self._batcher = None
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.close)
+            self.cache = None
+        with self._load_lock:
+            if self.model is None:
+                return
+            self.model = None
+            self.tokenizer = None
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        logging.info(f"Embedding model '{self.model_name}' unloaded")
+
+
+class BatchingEmbedder:
+    """
+    Асинхронная очередь микропакетов поверх encode_sync().
+    Собирает тексты от конкурентных вызовов и выполняет один прогон модели на всех.
+    """
+
+    def __init__(self, service, max_wait_ms: float = EMBED_BATCH_WAIT_MS,
+                 max_items: int = EMBED_BATCH_MAX_ITEMS):
+        self.service = service
+        self.max_wait = max_wait_ms / 1000
+        self.max_items = max_items
+        self._queue: "asyncio.Queue[Tuple[List[str], asyncio.Future, float]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+        self.requests = 0
+        self._latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._batch_sizes = deque(maxlen=_LATENCY_WINDOW)
+        self._busy_seconds = 0.0
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((list(texts), future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> List[Tuple[List[str], asyncio.Future, float]]:
+        """Ждет первый запрос, затем добирает остальные в пределах окна ожидания."""
+        batch = [await self._queue.get()]
+        count = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while count < self.max_items:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch
+
+    async def _run(self):
+        # Пакет объединяет запросы разных апдейтов: span-ы пакетов без идентификатора корреляции
+        trace_id.set(None)
+        while True:
+            batch = await self._collect()
+            # Вызовы, которые уже отменены, не считаем
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            texts = [text for item in batch for text in item[0]]
+            started_at = time.time()
+            started = time.perf_counter()
+            try:
+                vectors = await asyncio.to_thread(self.service.encode_sync, texts)
+            except Exception as e:
+                record_span("embed_batch", started_at, time.perf_counter() - started, "error", items=len(texts))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            record_span("embed_batch", started_at, finished - started, items=len(texts), requests=len(batch))
+            EMBED_BATCH_ITEMS.observe(len(texts))
+            self._busy_seconds += finished - started
+            self.batches += 1
+            self.items += len(texts)
+            self._batch_sizes.append(len(texts))
+
+            offset = 0
+            for request_texts, future, enqueued in batch:
+                rows = vectors[offset:offset + len(request_texts)]
+                offset += len(request_texts)
+                self.requests += 1
+                self._latencies.append(finished - enqueued)
+                if not future.done():
+                    future.set_result(rows)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.cancel()
+
+    def stats(self) -> dict:
+        latencies = list(self._latencies)
+        sizes = list(self._batch_sizes)
+        return {
+            "requests": self.requests,
+            "items": self.items,
+            "batches": self.batches,
+            "mean_batch_size": (sum(sizes) / len(sizes)) if sizes else None,
+            "items_per_busy_second": (self.items / self._busy_seconds) if self._busy_seconds else None,
+            "latency_p50": _percentile(latencies, 0.50),
+            "latency_p95": _percentile(latencies, 0.95),
+            "queue_depth": self._queue.qsize(),
+        }
+
+
+# Общий для процесса сервис
+embedding_service = EmbeddingService()
@@ -0,0 +1,174 @@
+# Файл: moduls/extract_pool.py
+"""
+Пул процессов для извлечения текста из документов.
+
+process_document синхронный: PyMuPDF find_tables на большом PDF занимает
+секунды, и раньше все это время цикл событий бота стоял. Здесь извлечение
+выполняется в ограниченном ProcessPoolExecutor:
+  * одновременно выполняется не больше EXTRACT_POOL_SIZE задач, остальные ждут
+    в очереди длиной не больше EXTRACT_QUEUE_LIMIT;
+  * на каждую задачу действует таймаут EXTRACT_TIMEOUT секунд, зависший
+    процесс убивается, пул пересоздается;
+  * падение рабочего процесса (например, на поврежденном PDF) не роняет бота:
+    пул пересоздается, задачи, попавшие под падение, повторяются один раз.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+EXTRACT_POOL_SIZE = int(os.getenv("EXTRACT_POOL_SIZE", str(max(1, (os.cpu_count() or 2) // 2))))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "600"))
+EXTRACT_QUEUE_LIMIT = int(os.getenv("EXTRACT_QUEUE_LIMIT", "100"))
+# Перезапуск рабочего процесса после N задач защищает от утечек памяти в PyMuPDF
+EXTRACT_MAX_TASKS_PER_CHILD = int(os.getenv("EXTRACT_MAX_TASKS_PER_CHILD", "50"))
+
+
+class ExtractionError(Exception):
+    """Базовая ошибка пула извлечения."""
+
+
+class ExtractionTimeout(ExtractionError):
+    """Задача не уложилась в таймаут, рабочий процесс убит."""
+
+
+class ExtractionCrashed(ExtractionError):
+    """Рабочий процесс аварийно завершился во время выполнения задачи."""
+
+
+class ExtractionQueueFull(ExtractionError):
+    """Очередь задач переполнена."""
+
+
+class ExtractionPool:
+    """Ограниченный пул процессов с таймаутами и изоляцией падений."""
+
+    def __init__(self, max_workers: int = EXTRACT_POOL_SIZE,
+                 timeout: float = EXTRACT_TIMEOUT,
+                 queue_limit: int = EXTRACT_QUEUE_LIMIT,
+                 max_tasks_per_child: int = EXTRACT_MAX_TASKS_PER_CHILD):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.queue_limit = queue_limit
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._generation = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.restarts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: форк процесса с потоками (torch, asyncio) небезопасен
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=self.max_tasks_per_child,
+            )
+        return self._executor
+
+    def _restart(self, generation: int, kill: bool):
+        """Пересоздает пул, если он еще не был пересоздан другой задачей."""
+        if generation != self._generation or self._executor is None:
+            return
+        executor = self._executor
+        self._executor = None
+        self._generation += 1
+        self.restarts += 1
+        if kill:
+            # У ProcessPoolExecutor нет публичного способа убить занятый процесс
+            for process in list((getattr(executor, "_processes", None) or {}).values()):
+                try:
+                    process.terminate()
+                except Exception:
+                    pass
+        executor.shutdown(wait=False, cancel_futures=True)
+        logging.warning(f"Extraction pool restarted (generation {self._generation})")
+
+    async def run(self, func: Callable, *args, timeout: Optional[float] = None) -> Any:
+        """Выполняет func(*args) в рабочем процессе и возвращает результат."""
+        if self.queued >= self.queue_limit:
+            raise ExtractionQueueFull(f"Extraction queue is full ({self.queued} jobs waiting)")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+        self.queued += 1
+        if self.queued > 1 or self.running >= self.max_workers:
+            logging.info(f"Extraction job queued: {self.queued} waiting, {self.running} running")
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            # Задачу, попавшую под падение чужой задачи, повторяем один раз
+            for attempt in range(2):
+                try:
+                    result = await self._run_once(func, args, timeout or self.timeout)
+                    self.completed += 1
+                    return result
+                except BrokenProcessPool:
+                    if attempt == 1:
+                        self.crashes += 1
+                        self.failed += 1
+                        raise ExtractionCrashed(f"Worker process crashed while running {func.__name__}{args!r}")
+                    logging.warning(f"Extraction worker crashed, retrying {func.__name__}{args!r}")
+                except Exception:
+                    self.failed += 1
+                    raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    async def _run_once(self, func: Callable, args: tuple, timeout: float) -> Any:
+        loop = asyncio.get_running_loop()
+        generation = self._generation
+        try:
+            future = self._get_executor().submit(func, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._restart(generation, kill=False)
+            raise BrokenProcessPool("Executor was shut down")
+        wrapped = asyncio.wrap_future(future, loop=loop)
+        try:
+            return await asyncio.wait_for(asyncio.shield(wrapped), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._restart(generation, kill=True)
+            raise ExtractionTimeout(f"{func.__name__}{args!r} exceeded {timeout:.0f}s")
+        except asyncio.CancelledError:
+            # Еще не начатая задача снимается с очереди; начатая доработает, результат будет отброшен
+            future.cancel()
+            raise
+        except BrokenProcessPool:
+            self._restart(generation, kill=False)
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "crashes": self.crashes,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Общий для процесса пул
+extraction_pool = ExtractionPool()
@@ -2,13 +2,22 @@ import fitz
 import docx
 import subprocess
 import os
+import shutil
 import tempfile
+import heapq
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Iterator, Optional, List, Tuple
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Версия логики извлечения. Увеличивается при изменении формата результата,
+# чтобы уже загруженные документы были извлечены и добавлены в RAG заново.
+EXTRACTION_VERSION = 1
+
 # --- Вспомогательные функции ---
 def _convert_table_to_markdown(table: docx.table.Table) -> str:
     """Вспомогательная функция для конвертации таблицы docx в Markdown"""
@@ -89,85 +98,206 @@ def _convert_extracted_table_to_markdown(data: list[list]) -> str:
 
 # --- Обработка PDF ---
 
-def extract_markdown_from_pdf_with_tables(pdf_path: str) -> str:
+# Число процессов для постраничного параллельного разбора PDF (1 - последовательно)
+PDF_PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", "1"))
+# Параллельный режим включается только для документов не короче этого числа страниц
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "50"))
+# Сколько диапазонов страниц приходится на один процесс (для выравнивания нагрузки)
+_PDF_CHUNKS_PER_WORKER = 4
+
+def _mark_blocks_inside_tables(block_bboxes: List[fitz.Rect], table_bboxes: List[fitz.Rect]) -> List[bool]:
+    """
+    Для каждого текстового блока определяет, лежит ли он внутри какой-либо таблицы.
+    Заметание по оси y: блоки обходятся по возрастанию y0, таблица становится
+    активной, когда ее y0 <= y0 блока, и выбывает, когда ее y1 < y0 блока
+    (дальше она уже не может содержать ни один блок). Полная проверка
+    contains() выполняется только для активных таблиц, пересекающих строку
+    заметания, вместо всех таблиц страницы.
+    """
+    inside = [False] * len(block_bboxes)
+    if not table_bboxes:
+        return inside
+
+    tables = sorted(table_bboxes, key=lambda rect: rect.y0)
+    next_table = 0
+    active = [] # Куча (y1, порядковый_номер, прямоугольник_таблицы)
+    for block_idx in sorted(range(len(block_bboxes)), key=lambda i: block_bboxes[i].y0):
+        block_bbox = block_bboxes[block_idx]
+        if block_bbox.is_empty:
+            # Вырожденные прямоугольники проверяем как раньше - семантика contains() для них особая
+            inside[block_idx] = _is_block_inside_bbox(block_bbox, table_bboxes)
+            continue
+        while next_table < len(tables) and tables[next_table].y0 <= block_bbox.y0:
+            heapq.heappush(active, (tables[next_table].y1, next_table, tables[next_table]))
+            next_table += 1
+        while active and active[0][0] < block_bbox.y0:
+            heapq.heappop(active)
+        inside[block_idx] = any(table_bbox.contains(block_bbox) for _, _, table_bbox in active)
+    return inside
+
+def _layout_page_elements(blocks: list, table_bboxes: List[fitz.Rect], rendered_tables: dict) -> List[str]:
+    """
+    Раскладывает текстовые блоки и отрендеренные таблицы страницы в порядке чтения.
+    blocks - результат page.get_text("blocks", sort=True), table_bboxes - границы
+    всех найденных таблиц, rendered_tables - {индекс_таблицы: строка_markdown}
+    для таблиц с непустым содержимым.
+    """
+    page_elements = [] # Список для хранения текстовых блоков и Markdown таблиц
+
+    # Точки вставки таблиц - их верхние координаты; сортируем по вертикальному положению
+    table_insertion_points = {idx: table_bboxes[idx].y0 for idx in rendered_tables}
+    sorted_table_indices = sorted(table_insertion_points, key=table_insertion_points.get)
+    yielded_tables = {idx: False for idx in sorted_table_indices} # Отслеживаем вставленные таблицы
+
+    block_bboxes = [fitz.Rect(block[:4]) for block in blocks] # Координаты блоков (x0, y0, x1, y1)
+    blocks_inside_tables = _mark_blocks_inside_tables(block_bboxes, table_bboxes)
+
+    last_y_pos = 0 # Для отслеживания позиции вставки таблиц
+    # Таблицы левее указателя уже рассмотрены: вставлены, либо отброшены порогом
+    # (last_y_pos только растет, поэтому отброшенная таблица не пройдет порог и позже)
+    next_table = 0
+
+    # Обработать блоки и вставить таблицы одним упорядоченным проходом
+    for block, block_bbox, block_inside_table in zip(blocks, block_bboxes, blocks_inside_tables):
+        block_text = block[4].strip()     # Текст блока
+        block_top_y = block_bbox.y0       # Верхняя координата блока
+
+        # Вставляем таблицы, чья верхняя граница выше или на уровне текущего блока
+        while (next_table < len(sorted_table_indices)
+               and table_insertion_points[sorted_table_indices[next_table]] <= block_top_y):
+            table_idx = sorted_table_indices[next_table]
+            next_table += 1
+            # Дополнительная проверка, чтобы не вставлять таблицы слишком близко друг к другу
+            # или перед блоком, который является частью предыдущей таблицы.
+            # Порог (-5) можно настроить.
+            if table_insertion_points[table_idx] >= last_y_pos - 5:
+                page_elements.append(rendered_tables[table_idx])
+                yielded_tables[table_idx] = True
+                # Обновляем позицию, чтобы следующая таблица/текст вставлялись после этой таблицы
+                last_y_pos = max(last_y_pos, table_bboxes[table_idx].y1)
+
+        # Добавить текст блока, если он не является частью таблицы
+        if block_text and not block_inside_table:
+            page_elements.append(block_text)
+            # Обновляем позицию последним обработанным текстовым блоком
+            last_y_pos = max(last_y_pos, block_bbox.y1)
+
+    # Вставить оставшиеся таблицы (если они находятся в самом конце страницы)
+    for table_idx in sorted_table_indices:
+        if not yielded_tables[table_idx]:
+            page_elements.append(rendered_tables[table_idx])
+
+    return page_elements
+
+def _extract_markdown_from_pdf_page(page: fitz.Page, page_num: int) -> str:
+    """
+    Извлекает Markdown одной страницы PDF: таблицы через page.find_tables(),
+    остальной текст через page.get_text("blocks").
+    """
+    # 1. Найти таблицы и их границы
+    # Настройки find_tables можно тюнинговать (strategy, vertical_strategy и т.д.)
+    # https://pymupdf.readthedocs.io/en/latest/page.html#Page.find_tables
+    tabs = page.find_tables(snap_tolerance=3, join_tolerance=3)
+    table_bboxes = [fitz.Rect(t.bbox) for t in tabs.tables]
+    logging.info(f"Page {page_num + 1}: Found {len(tabs.tables)} table(s).")
+
+    # 2. Предварительно отрендерить таблицы в Markdown
+    rendered_tables = {} # Словарь {индекс_таблицы: строка_markdown}
+    for i, table in enumerate(tabs.tables):
+        table_data = table.extract()
+        if table_data: # Убедимся, что из таблицы извлеклись данные
+            md_table = _convert_extracted_table_to_markdown(table_data)
+            if md_table: # Убедимся, что Markdown не пустой
+                rendered_tables[i] = md_table
+
+    # 3. Получить текстовые блоки
+    # Используем "blocks" для получения текста с координатами
+    # sort=True упорядочивает блоки по y, затем по x (порядок чтения)
+    blocks = page.get_text("blocks", sort=True)
+
+    # 4. Разложить блоки и таблицы в порядке чтения
+    page_elements = _layout_page_elements(blocks, table_bboxes, rendered_tables)
+
+    # Объединяем элементы страницы в одну строку Markdown
+    return "\n\n".join(page_elements) + "\n\n" # Двойной перенос строки между элементами
+
+def _extract_markdown_from_pdf_pages(pdf_path: str, start: int, stop: int) -> List[str]:
+    """
+    Извлекает Markdown страниц [start, stop). Каждый вызов открывает свой
+    fitz-документ, поэтому функцию можно выполнять в отдельном процессе.
+    """
+    doc = fitz.open(pdf_path)
+    try:
+        return [_extract_markdown_from_pdf_page(doc.load_page(page_num), page_num)
+                for page_num in range(start, stop)]
+    finally:
+        doc.close()
+
+def _split_page_range(page_count: int, chunks: int) -> List[Tuple[int, int]]:
+    """Делит страницы [0, page_count) на не более чем chunks непрерывных диапазонов."""
+    chunks = max(1, min(chunks, page_count))
+    step, rest = divmod(page_count, chunks)
+    ranges = []
+    start = 0
+    for i in range(chunks):
+        stop = start + step + (1 if i < rest else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+def _iter_markdown_from_pdf_parallel(pdf_path: str, page_count: int, workers: int) -> Iterator[str]:
+    """
+    Распределяет диапазоны страниц по процессам и отдает результат в порядке страниц.
+    В работе одновременно не больше 2 * workers диапазонов, чтобы не держать
+    в памяти весь документ.
+    """
+    ranges = _split_page_range(page_count, workers * _PDF_CHUNKS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < 2 * workers:
+                start, stop = ranges[next_range]
+                pending.append(executor.submit(_extract_markdown_from_pdf_pages, pdf_path, start, stop))
+                next_range += 1
+            # Результаты забираются в порядке отправки, то есть в порядке страниц
+            yield from pending.popleft().result()
+
+def iter_markdown_from_pdf(pdf_path: str, workers: Optional[int] = None) -> Iterator[str]:
+    """
+    Постранично отдает Markdown PDF-документа без пустых строк.
+    Пустые страницы пропускаются; "\n".join() всех фрагментов совпадает с
+    результатом extract_markdown_from_pdf_with_tables().
+    Исключения не перехватываются.
+    """
+    workers = PDF_PAGE_WORKERS if workers is None else workers
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    if workers > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        logging.info(f"Extracting {page_count} pages of {pdf_path} with {workers} worker processes")
+        pages = _iter_markdown_from_pdf_parallel(pdf_path, page_count, workers)
+    else:
+        pages = (_extract_markdown_from_pdf_pages(pdf_path, page_num, page_num + 1)[0]
+                 for page_num in range(page_count))
+
+    for page_markdown in pages:
+        # Очистка от лишних пустых строк (каждая страница заканчивается "\n\n",
+        # поэтому строки соседних страниц не склеиваются)
+        page_markdown = "\n".join(line for line in page_markdown.splitlines() if line.strip())
+        if page_markdown:
+            yield page_markdown
+
+def extract_markdown_from_pdf_with_tables(pdf_path: str, workers: Optional[int] = None) -> str:
     """
     Извлекает текст из PDF в Markdown, используя page.find_tables()
     для явной обработки таблиц и page.get_text("blocks") для остального текста.
+    При workers > 1 и достаточном числе страниц страницы разбираются
+    параллельно в нескольких процессах; результат совпадает с последовательным.
     """
-    final_markdown_content = ""
     try:
-        doc = fitz.open(pdf_path)
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            page_elements = [] # Список для хранения текстовых блоков и Markdown таблиц
-
-            # 1. Найти таблицы и их границы
-            # Настройки find_tables можно тюнинговать (strategy, vertical_strategy и т.д.)
-            # https://pymupdf.readthedocs.io/en/latest/page.html#Page.find_tables
-            tabs = page.find_tables(snap_tolerance=3, join_tolerance=3)
-            table_bboxes = [fitz.Rect(t.bbox) for t in tabs.tables]
-            logging.info(f"Page {page_num + 1}: Found {len(tabs.tables)} table(s).")
-
-            # 2. Предварительно отрендерить таблицы в Markdown
-            rendered_tables = {} # Словарь {индекс_таблицы: строка_markdown}
-            table_insertion_points = {} # Словарь {индекс_таблицы: верхняя_координата_y}
-            for i, table in enumerate(tabs.tables):
-                table_data = table.extract()
-                if table_data: # Убедимся, что из таблицы извлеклись данные
-                    md_table = _convert_extracted_table_to_markdown(table_data)
-                    if md_table: # Убедимся, что Markdown не пустой
-                        rendered_tables[i] = md_table
-                        table_insertion_points[i] = fitz.Rect(table.bbox).y0 # y0 - верхняя координата
-
-            # Сортируем индексы таблиц по их вертикальному положению
-            sorted_table_indices = sorted(table_insertion_points, key=table_insertion_points.get)
-            yielded_tables = {idx: False for idx in sorted_table_indices} # Отслеживаем вставленные таблицы
-
-            # 3. Получить текстовые блоки
-            # Используем "blocks" для получения текста с координатами
-            # sort=True упорядочивает блоки по y, затем по x (порядок чтения)
-            blocks = page.get_text("blocks", sort=True)
-
-            last_y_pos = 0 # Для отслеживания позиции вставки таблиц
-
-            # 4. Обработать блоки и вставить таблицы
-            for block in blocks:
-                block_bbox = fitz.Rect(block[:4]) # Координаты блока (x0, y0, x1, y1)
-                block_text = block[4].strip()     # Текст блока
-                block_top_y = block_bbox.y0       # Верхняя координата блока
-
-                # Проверяем, нужно ли вставить таблицу ПЕРЕД этим блоком
-                for table_idx in sorted_table_indices:
-                    # Если таблица еще не вставлена и ее верхняя граница выше или на уровне текущего блока
-                    if not yielded_tables[table_idx] and table_insertion_points[table_idx] <= block_top_y:
-                         # Дополнительная проверка, чтобы не вставлять таблицы слишком близко друг к другу
-                         # или перед блоком, который является частью предыдущей таблицы.
-                         # Порог (-5) можно настроить.
-                         if table_insertion_points[table_idx] >= last_y_pos - 5:
-                            page_elements.append(rendered_tables[table_idx])
-                            yielded_tables[table_idx] = True
-                            # Обновляем позицию, чтобы следующая таблица/текст вставлялись после этой таблицы
-                            last_y_pos = max(last_y_pos, fitz.Rect(tabs.tables[table_idx].bbox).y1)
-
-
-                # 5. Добавить текст блока, если он не является частью таблицы
-                if block_text and not _is_block_inside_bbox(block_bbox, table_bboxes):
-                    page_elements.append(block_text)
-                    # Обновляем позицию последним обработанным текстовым блоком
-                    last_y_pos = max(last_y_pos, block_bbox.y1)
-
-            # 6. Вставить оставшиеся таблицы (если они находятся в самом конце страницы)
-            for table_idx in sorted_table_indices:
-                if not yielded_tables[table_idx]:
-                    page_elements.append(rendered_tables[table_idx])
-
-            # Объединяем элементы страницы в одну строку Markdown
-            final_markdown_content += "\n\n".join(page_elements) + "\n\n" # Двойной перенос строки между элементами
-
-        doc.close()
+        final_markdown_content = "\n".join(iter_markdown_from_pdf(pdf_path, workers))
         logging.info(f"Successfully extracted Markdown with explicit tables from PDF: {pdf_path}")
-        # Финальная очистка от лишних пустых строк
-        final_markdown_content = "\n".join(line for line in final_markdown_content.splitlines() if line.strip())
         return final_markdown_content
 
     except Exception as e:
@@ -178,30 +308,34 @@ def extract_markdown_from_pdf_with_tables(pdf_path: str) -> str:
 
 # --- Обработка DOCX ---
 
+def iter_markdown_from_docx(docx_path: str) -> Iterator[str]:
+    """
+    Поэлементно отдает Markdown DOCX-документа (параграфы и таблицы).
+    "\n\n".join() всех элементов совпадает с extract_markdown_from_docx().
+    """
+    doc = docx.Document(docx_path)
+    for element in doc.element.body:
+        if isinstance(element, docx.oxml.text.paragraph.CT_P):
+            para = docx.text.paragraph.Paragraph(element, doc)
+            if para.text.strip(): # Дообавляем только непустые параграфы
+                level = int(para.style.name[-1]) if para.style.name[-1].isdigit() else 1
+                yield f"{'#' * level} {para.text.strip()}"
+            else:
+                yield para.text.strip()
+        elif isinstance(element, docx.oxml.table.CT_Tbl):
+            table = docx.table.Table(element, doc)
+            if table.rows:
+                yield _convert_table_to_markdown(table)
+
 def extract_markdown_from_docx(docx_path: str) -> str:
     """
     Извлекает текст из DOCX и форматирует его в markdown.
     Обрабатывает параграфы и таблицы.
     """
-
-    markdown_elements = []
     try:
-        doc = docx.Document(docx_path)
-        for element in doc.element.body:
-            if isinstance(element, docx.oxml.text.paragraph.CT_P):
-                para = docx.text.paragraph.Paragraph(element, doc)
-                if para.text.strip(): # Дообавляем только непустые параграфы
-                    level = int(para.style.name[-1]) if para.style.name[-1].isdigit() else 1
-                    markdown_elements.append(f"{'#' * level} {para.text.strip()}")
-                else:
-                    markdown_elements.append(para.text.strip())
-            elif isinstance(element, docx.oxml.table.CT_Tbl):
-                table = docx.table.Table(element, doc)
-                if table.rows:
-                    markdown_elements.append(_convert_table_to_markdown(table))
-
+        markdown_content = "\n\n".join(iter_markdown_from_docx(docx_path))
         logging.info(f"Successfully extracted Markdown from DOCX: {docx_path}")
-        return "\n\n".join(markdown_elements)
+        return markdown_content
     except Exception as e:
         logging.error(f"Error processing DOCX file {docx_path}: {e}")
         raise
@@ -226,9 +360,13 @@ def convert_doc_to_docx(doc_path: str, output_dir: str) -> Optional[str]:
         # Путь к soffice может отличаться в вашей системе
         # На Windows это может быть что-то вроде "C:\Program Files\LibreOffice\program\soffice.exe"
         # На Linux/macOS часто просто "soffice" или "/usr/bin/soffice"
+        # Отдельный временный профиль LibreOffice: с общим профилем параллельные конвертации падают.
+        # В боте используется moduls/doc_converter.py с заранее прогретыми профилями.
+        profile_dir = tempfile.mkdtemp(prefix="soffice-profile-")
         cmd = [
             "soffice", # или полный путь к исполняемому файлу soffice
             "--headless", # Запуск без GUI
+            f"-env:UserInstallation={Path(profile_dir).as_uri()}",
             "--convert-to", "docx",
             "--outdir", str(output_dir),
             str(doc_path)
@@ -236,7 +374,10 @@ def convert_doc_to_docx(doc_path: str, output_dir: str) -> Optional[str]:
         logging.info(f"Attempting to convert DOC to DOCX: {' '.join(cmd)}")
 
         # Запуск процесса конвертации
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False) # check=False, чтобы обработать ошибки вручную
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, check=False) # check=False, чтобы обработать ошибки вручную
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
 
         if result.returncode == 0 and output_path.exists():
             logging.info(f"Successfully converted {doc_path} to {output_path}")
@@ -317,6 +458,76 @@ def process_document(file_path: str) -> Optional[str]:
         logging.error(f"An unexpected error occurred while processing {file_path}: {e}")
         return None # Возвращаем None при любой необработанной ошибке
 
+# --- Потоковое извлечение ---
+
+def _join_stream(fragments: Iterator[str], separator: str) -> Iterator[str]:
+    """Вставляет separator между фрагментами, не собирая их в одну строку."""
+    first = True
+    for fragment in fragments:
+        if not first:
+            yield separator
+        first = False
+        yield fragment
+
+def _iter_markdown_from_doc(doc_path: str) -> Iterator[str]:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        converted_docx_path = convert_doc_to_docx(doc_path, temp_dir)
+        if not converted_docx_path:
+            raise RuntimeError(f"Conversion failed for {doc_path}")
+        yield from iter_markdown_from_docx(converted_docx_path)
+
+def iter_document_markdown(file_path: str) -> Iterator[str]:
+    """
+    Потоково отдает Markdown документа (PDF, DOCX, DOC) фрагментами
+    (страница PDF, элемент DOCX) вместе с разделителями: "".join() всех
+    фрагментов совпадает с результатом process_document().
+    Для неподдерживаемого формата выбрасывает ValueError, ошибки
+    извлечения не перехватываются.
+    """
+    file_ext = Path(file_path).suffix.lower()
+    if file_ext == ".pdf":
+        yield from _join_stream(iter_markdown_from_pdf(file_path), "\n")
+    elif file_ext == ".docx":
+        yield from _join_stream(iter_markdown_from_docx(file_path), "\n\n")
+    elif file_ext == ".doc":
+        yield from _join_stream(_iter_markdown_from_doc(file_path), "\n\n")
+    else:
+        raise ValueError(f"Unsupported file format: {file_ext}")
+
+def document_page_count(file_path: str) -> Optional[int]:
+    """Число страниц PDF (для метрик извлечения); для других форматов - None."""
+    if Path(file_path).suffix.lower() != ".pdf":
+        return None
+    with fitz.open(file_path) as doc:
+        return len(doc)
+
+def extract_document_to_file(file_path: str, txt_path: str) -> Optional[int]:
+    """
+    Извлекает Markdown документа и потоково пишет его в txt_path, не держа
+    весь текст в памяти. Файл появляется атомарно, только после успешного
+    извлечения. Возвращает число записанных символов или None в случае
+    ошибки или неподдерживаемого формата.
+    """
+    if not Path(file_path).is_file():
+        logging.error(f"File not found: {file_path}")
+        return None
+
+    tmp_path = f"{txt_path}.part"
+    written = 0
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as txt_out_file:
+            for fragment in iter_document_markdown(file_path):
+                txt_out_file.write(fragment)
+                written += len(fragment)
+        os.replace(tmp_path, txt_path)
+        logging.info(f"Streamed {written} characters from {file_path} to {txt_path}")
+        return written
+    except Exception as e:
+        logging.error(f"An unexpected error occurred while processing {file_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
 #file_path = "D:\\BOT\\data\\contexts\\866070767\\test\\documents\\test_pdf.pdf"
 #extracted_text = process_document(file_path)
 #
@@ -0,0 +1,205 @@
+# Файл: moduls/fsm_storage.py
+"""
+Персистентное хранилище состояний FSM aiogram.
+
+С MemoryStorage выбранный пользователем контекст (current_context) и
+состояние диалога терялись при каждом перезапуске бота, а несколько
+процессов бота не могли работать с одними и теми же пользователями.
+
+SqliteStorage хранит состояние и данные FSM в SQLite (FSM_STORAGE_DB, режим
+WAL - файл можно открывать из нескольких процессов на одной машине) с
+кэшем записей в памяти процесса:
+  * чтение (state.get_data() в каждом хендлере) обслуживается из кэша, в
+    базу идет только первое обращение к пользователю;
+  * запись откладывается (write-behind): измененные записи сбрасываются
+    одной транзакцией не позже чем через FSM_FLUSH_INTERVAL секунд и при
+    остановке бота. При аварийном завершении теряются изменения последнего
+    интервала; FSM_FLUSH_INTERVAL=0 - запись сразу;
+  * кэш ограничен FSM_CACHE_MAX_KEYS записями, вытесняются давно не
+    использованные, уже сохраненные записи.
+Кэш процесса не синхронизируется с другими процессами, поэтому при
+нескольких процессах апдейты одного пользователя должны всегда приходить в
+один и тот же процесс (маршрутизация по user_id).
+
+FSM_STORAGE выбирает хранилище: "sqlite" (по умолчанию), "memory" или URL
+redis://... (aiogram RedisStorage, нужен пакет redis; подходит и любой
+сервер с протоколом Redis).
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Set, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_STORAGE_DB = os.getenv("FSM_STORAGE_DB", os.path.join("data", "fsm.sqlite3"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_CACHE_MAX_KEYS = int(os.getenv("FSM_CACHE_MAX_KEYS", "10000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+class SqliteStorage(BaseStorage):
+    """FSM-хранилище aiogram в SQLite с кэшем чтения и отложенной записью."""
+
+    def __init__(self, db_path: str = FSM_STORAGE_DB, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 max_cached: int = FSM_CACHE_MAX_KEYS, key_builder: Optional[KeyBuilder] = None):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db: Optional[sqlite3.Connection] = None
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._pending: Optional[asyncio.Task] = None
+        self.reads = 0
+        self.loads = 0
+        self.flushes = 0
+        self.flushed_records = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+        return self._db
+
+    def _record(self, key: StorageKey) -> Tuple[str, _Record]:
+        storage_key = self.key_builder.build(key)
+        self.reads += 1
+        record = self._cache.get(storage_key)
+        if record is not None:
+            self._cache.move_to_end(storage_key)
+            return storage_key, record
+        row = self._connect().execute("SELECT state, data FROM fsm WHERE key = ?", (storage_key,)).fetchone()
+        self.loads += 1
+        record = _Record(state=row[0], data=json.loads(row[1])) if row else _Record()
+        # Место освобождается до добавления: запрошенная запись не должна вытесниться сама
+        self._evict(reserve=1)
+        self._cache[storage_key] = record
+        return storage_key, record
+
+    def _evict(self, reserve: int = 0):
+        limit = self.max_cached - reserve
+        if len(self._cache) <= limit:
+            return
+        # Несохраненные записи не вытесняются: они уйдут при следующем сбросе
+        for storage_key in list(self._cache):
+            if len(self._cache) <= limit:
+                break
+            if storage_key not in self._dirty:
+                del self._cache[storage_key]
+
+    async def _changed(self, storage_key: str):
+        self._dirty.add(storage_key)
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Сохраняет измененные записи одной транзакцией."""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts, deletes = [], []
+        for storage_key in keys:
+            record = self._cache.get(storage_key)
+            if record is None:
+                continue
+            if record.state is None and not record.data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False), now))
+        try:
+            db = self._connect()
+            db.executemany("INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+            db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            db.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            # Запись повторится при следующем сбросе
+            logging.warning(f"Failed to flush {len(keys)} FSM records: {e!r}")
+            self._dirty |= keys
+            if self._db is not None:
+                self._db.rollback()
+            return
+        self.flushes += 1
+        self.flushed_records += len(keys)
+        self._evict()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, record = self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._changed(storage_key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._record(key)[1].state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key, record = self._record(key)
+        record.data = data.copy()
+        await self._changed(storage_key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._record(key)[1].data.copy()
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "reads": self.reads,
+            "cache_hit_rate": 1 - self.loads / self.reads if self.reads else None,
+            "flushes": self.flushes,
+            "flushed_records": self.flushed_records,
+        }
+
+    async def close(self) -> None:
+        if self._pending is not None and not self._pending.done():
+            self._pending.cancel()
+        await self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def build_fsm_storage(spec: str = FSM_STORAGE) -> BaseStorage:
+    """Создает FSM-хранилище по значению FSM_STORAGE."""
+    if spec == "memory":
+        return MemoryStorage()
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        # Необязательная зависимость: нужна только при хранении состояний в Redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(spec, key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True))
+    if spec == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"Unknown FSM_STORAGE: {spec!r}")
@@ -0,0 +1,340 @@
+# Файл: moduls/ingest_manifest.py
+"""
+Манифест загрузки документов контекста.
+
+Раньше документ считался обработанным, если существовал файл
+text/<filename.split('.')[0]>.txt: report.v1.pdf и report.v2.pdf попадали
+в один и тот же .txt, а обновленный файл с тем же именем никогда не
+добавлялся заново. Манифест (SQLite в директории контекста) хранит для
+каждого файла хэш содержимого, размер, версию извлечения, идентификаторы
+документов LightRAG, число чанков и статус загрузки, и по нему строится
+план инкрементальной загрузки:
+  * new       - файл еще не загружался (или предыдущая попытка не удалась);
+  * changed   - содержимое или версия извлечения изменились, старые данные
+                нужно удалить из RAG и загрузить файл заново;
+  * duplicate - в контексте уже загружен файл с тем же содержимым.
+
+Извлеченный текст дополнительно сохраняется в общем хранилище по хэшу
+содержимого (ExtractedTextStore), поэтому один и тот же файл, загруженный в
+несколько контекстов, извлекается только один раз.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from moduls.extract_text import EXTRACTION_VERSION
+
+MANIFEST_FILE_NAME = "manifest.sqlite3"
+EXTRACTED_TEXT_DIR = os.getenv("EXTRACTED_TEXT_DIR", os.path.join("data", "extracted"))
+
+STATUS_PENDING = "pending"
+STATUS_PROCESSED = "processed"
+STATUS_FAILED = "failed"
+STATUS_DUPLICATE = "duplicate"
+
+ACTION_NEW = "new"
+ACTION_CHANGED = "changed"
+ACTION_DUPLICATE = "duplicate"
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    """Потоково считает SHA-256 файла."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def txt_name_for(filename: str) -> str:
+    """Имя файла с извлеченным текстом: полное имя документа + .txt (report.v1.pdf -> report.v1.pdf.txt)."""
+    return f"{filename}.txt"
+
+
+@dataclass
+class DocumentRecord:
+    filename: str
+    content_hash: str
+    size: int
+    mtime: float
+    extraction_version: int
+    status: str
+    doc_ids: List[str]
+    chunk_count: Optional[int] = None
+    error: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    updated_at: Optional[float] = None
+
+
+@dataclass
+class PlannedDocument:
+    filename: str
+    path: str
+    content_hash: str
+    size: int
+    mtime: float
+    action: str
+    previous: Optional[DocumentRecord] = None
+    duplicate_of: Optional[str] = None
+
+
+class ExtractedTextStore:
+    """Общее для всех контекстов хранилище извлеченного текста по хэшу содержимого."""
+
+    def __init__(self, root: str = EXTRACTED_TEXT_DIR):
+        self.root = root
+
+    def path_for(self, content_hash: str) -> str:
+        return os.path.join(self.root, content_hash[:2], f"{content_hash}-v{EXTRACTION_VERSION}.txt")
+
+    def fetch(self, content_hash: str, target_path: str) -> bool:
+        """Кладет сохраненный текст в target_path (жесткой ссылкой или копией). False, если текста нет."""
+        source = self.path_for(content_hash)
+        if not os.path.isfile(source):
+            return False
+        _link_or_copy(source, target_path)
+        return True
+
+    def store(self, content_hash: str, txt_path: str):
+        target = self.path_for(content_hash)
+        if os.path.isfile(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            _link_or_copy(txt_path, target)
+        except OSError as e:
+            logging.warning(f"Could not store extracted text for {content_hash}: {e}")
+
+
+def _link_or_copy(source: str, target: str):
+    tmp_target = f"{target}.part"
+    if os.path.exists(tmp_target):
+        os.remove(tmp_target)
+    try:
+        os.link(source, tmp_target)
+    except OSError:
+        shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+class IngestManifest:
+    """SQLite-манифест документов одного контекста."""
+
+    def __init__(self, context_path: str):
+        self.context_path = context_path
+        self.documents_path = os.path.join(context_path, "documents")
+        self.txt_path = os.path.join(context_path, "text")
+        # plan() с хэшированием файлов вызывается загрузкой в потоке (asyncio.to_thread);
+        # манифест используется последовательно, одновременных обращений из разных потоков нет
+        self._db = sqlite3.connect(os.path.join(context_path, MANIFEST_FILE_NAME), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                filename TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                extraction_version INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                doc_ids TEXT NOT NULL DEFAULT '[]',
+                chunk_count INTEGER,
+                error TEXT,
+                duplicate_of TEXT,
+                updated_at REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS documents_hash ON documents (content_hash)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- Чтение ---
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> DocumentRecord:
+        return DocumentRecord(
+            filename=row["filename"], content_hash=row["content_hash"], size=row["size"],
+            mtime=row["mtime"], extraction_version=row["extraction_version"], status=row["status"],
+            doc_ids=json.loads(row["doc_ids"]), chunk_count=row["chunk_count"], error=row["error"],
+            duplicate_of=row["duplicate_of"], updated_at=row["updated_at"])
+
+    def get(self, filename: str) -> Optional[DocumentRecord]:
+        row = self._db.execute("SELECT * FROM documents WHERE filename = ?", (filename,)).fetchone()
+        return self._record(row) if row else None
+
+    def records(self) -> Dict[str, DocumentRecord]:
+        return {row["filename"]: self._record(row) for row in self._db.execute("SELECT * FROM documents")}
+
+    @property
+    def content_version(self) -> int:
+        """Версия содержимого контекста: растет при каждом добавлении или удалении документа."""
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'content_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_content_version(self):
+        self._db.execute("INSERT INTO meta (name, value) VALUES ('content_version', '1') "
+                         "ON CONFLICT(name) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    # --- План загрузки ---
+
+    def plan(self) -> List[PlannedDocument]:
+        """
+        Сравнивает файлы в documents/ с манифестом и возвращает файлы, которые
+        нужно загрузить. Хэш пересчитывается только для файлов, у которых
+        изменились размер или время модификации.
+        """
+        if not os.path.isdir(self.documents_path):
+            return []
+        records = self.records()
+        unchanged: Dict[str, DocumentRecord] = {}
+        candidates = []
+        for filename in sorted(os.listdir(self.documents_path)):
+            path = os.path.join(self.documents_path, filename)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            record = records.get(filename)
+            settled = (record is not None and record.extraction_version == EXTRACTION_VERSION
+                       and record.status in (STATUS_PROCESSED, STATUS_DUPLICATE))
+            if settled and record.size == stat.st_size and record.mtime == stat.st_mtime:
+                unchanged[filename] = record  # быстрый путь: файл не менялся
+                continue
+
+            content_hash = file_sha256(path)
+            if settled and record.content_hash == content_hash:
+                # Изменилось только время модификации
+                self._touch(filename, stat.st_size, stat.st_mtime)
+                unchanged[filename] = record
+                continue
+            if record is None:
+                legacy = self._adopt_legacy(filename, content_hash, stat)
+                if legacy is not None:
+                    unchanged[filename] = legacy
+                    continue
+            candidates.append((filename, path, content_hash, stat, record))
+
+        processed_by_hash = {record.content_hash: name for name, record in unchanged.items()
+                             if record.status == STATUS_PROCESSED}
+        for filename, record in unchanged.items():
+            if record.status == STATUS_DUPLICATE and processed_by_hash.get(record.content_hash) != record.duplicate_of:
+                # Оригинал удален или изменился - дубликат нужно загрузить самостоятельно
+                path = os.path.join(self.documents_path, filename)
+                candidates.append((filename, path, record.content_hash, os.stat(path), record))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        planned = []
+        for filename, path, content_hash, stat, record in candidates:
+            duplicate_of = processed_by_hash.get(content_hash)
+            if duplicate_of is not None and duplicate_of != filename:
+                action = ACTION_DUPLICATE
+            elif record is not None and record.doc_ids:
+                action = ACTION_CHANGED
+            else:
+                action = ACTION_NEW
+            planned.append(PlannedDocument(filename=filename, path=path, content_hash=content_hash,
+                                           size=stat.st_size, mtime=stat.st_mtime, action=action,
+                                           previous=record, duplicate_of=duplicate_of))
+            if action != ACTION_DUPLICATE:
+                # Второй такой же файл в этой же загрузке будет дубликатом
+                processed_by_hash.setdefault(content_hash, filename)
+        self._db.commit()
+        return planned
+
+    def removed(self) -> List[DocumentRecord]:
+        """Записи о файлах, которых больше нет в documents/."""
+        return [record for name, record in self.records().items()
+                if not os.path.isfile(os.path.join(self.documents_path, name))]
+
+    def _touch(self, filename: str, size: int, mtime: float):
+        self._db.execute("UPDATE documents SET size = ?, mtime = ?, updated_at = ? WHERE filename = ?",
+                         (size, mtime, time.time(), filename))
+
+    def _adopt_legacy(self, filename: str, content_hash: str, stat) -> Optional[DocumentRecord]:
+        """
+        Контексты, загруженные до появления манифеста: если есть .txt по старой
+        схеме именования, документ уже в RAG под идентификатором, который
+        LightRAG вычислил по всему тексту.
+        """
+        from lightrag.utils import compute_mdhash_id
+
+        legacy_txt = os.path.join(self.txt_path, f"{filename.split('.')[0]}.txt")
+        if not os.path.isfile(legacy_txt):
+            return None
+        with open(legacy_txt, encoding="utf-8") as legacy_file:
+            doc_id = compute_mdhash_id(legacy_file.read().strip(), prefix="doc-")
+        target_txt = os.path.join(self.txt_path, txt_name_for(filename))
+        if not os.path.exists(target_txt):
+            _link_or_copy(legacy_txt, target_txt)
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents (filename, content_hash, size, mtime, extraction_version, status, "
+            "doc_ids, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (filename, content_hash, stat.st_size, stat.st_mtime, EXTRACTION_VERSION, STATUS_PROCESSED,
+             json.dumps([doc_id]), time.time()))
+        logging.info(f"Manifest: adopted legacy document {filename} as {doc_id}")
+        return self.get(filename)
+
+    # --- Запись статусов ---
+
+    def _upsert(self, item: PlannedDocument, status: str, doc_ids: List[str], chunk_count: Optional[int] = None,
+                error: Optional[str] = None, duplicate_of: Optional[str] = None):
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents (filename, content_hash, size, mtime, extraction_version, status, "
+            "doc_ids, chunk_count, error, duplicate_of, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (item.filename, item.content_hash, item.size, item.mtime, EXTRACTION_VERSION, status,
+             json.dumps(doc_ids), chunk_count, error, duplicate_of, time.time()))
+        # Прежние данные файла удалены из RAG или вставлены новые (даже частично) - ответы по старому
+        # содержимому устарели; версия меняется в одной транзакции со строкой манифеста
+        if doc_ids or (item.previous is not None and item.previous.doc_ids):
+            self._bump_content_version()
+        self._db.commit()
+
+    def mark_pending(self, item: PlannedDocument):
+        self._upsert(item, STATUS_PENDING, [])
+
+    def mark_processed(self, item: PlannedDocument, doc_ids: List[str], chunk_count: Optional[int]):
+        self._upsert(item, STATUS_PROCESSED, doc_ids, chunk_count=chunk_count)
+
+    def mark_failed(self, item: PlannedDocument, error: str, doc_ids: Optional[List[str]] = None):
+        # Идентификаторы сохраняются, чтобы при повторной попытке удалить частично вставленные данные
+        self._upsert(item, STATUS_FAILED, doc_ids or [], error=error)
+
+    def mark_duplicate(self, item: PlannedDocument):
+        self._upsert(item, STATUS_DUPLICATE, [], duplicate_of=item.duplicate_of)
+
+    def duplicates_of(self, filename: str) -> List[str]:
+        """Файлы, пропущенные при загрузке как копии данного."""
+        rows = self._db.execute("SELECT filename FROM documents WHERE duplicate_of = ? AND status = ?",
+                                (filename, STATUS_DUPLICATE)).fetchall()
+        return [row[0] for row in rows]
+
+    def doc_ids_in_use(self, exclude: str) -> Set[str]:
+        """Идентификаторы документов LightRAG, на которые ссылаются другие файлы контекста."""
+        return {doc_id for name, record in self.records().items() if name != exclude for doc_id in record.doc_ids}
+
+    def remove(self, filename: str) -> Optional[DocumentRecord]:
+        record = self.get(filename)
+        if record is None:
+            return None
+        self._db.execute("DELETE FROM documents WHERE filename = ?", (filename,))
+        # Дубликаты удаленного файла теряют оригинал и при следующей загрузке добавятся сами
+        self._db.execute("DELETE FROM documents WHERE duplicate_of = ?", (filename,))
+        if record.status == STATUS_PROCESSED or record.doc_ids:
+            self._bump_content_version()
+        self._db.commit()
+        return record
@@ -0,0 +1,319 @@
+# Файл: moduls/ingest_queue.py
+"""
+Фоновая очередь загрузки документов в RAG.
+
+Раньше save_uploaded_document прямо в хендлере Telegram ждал полного цикла
+извлечение -> вставка для всех файлов контекста: пользователь, отправивший
+десять документов, запускал десять пересекающихся пересканирований
+documents/ и держал обработчик апдейта до конца загрузки.
+
+Теперь хендлер только сохраняет файл и ставит задание в очередь:
+  * задания хранятся в SQLite и переживают перезапуск бота - незавершенные
+    (running) при старте возвращаются в очередь, а манифест загрузки
+    (moduls/ingest_manifest.py) пропускает уже обработанные файлы;
+  * для одного контекста в очереди не больше одного ожидающего задания:
+    документы, пришедшие пока задание ждет, обработаются им же, а пришедшие
+    во время выполнения - следующим заданием;
+  * фиксированное число воркеров (INGEST_WORKERS), у одного пользователя
+    выполняется не больше одного задания, а свободный воркер берет задание
+    пользователя, которого обслуживали дольше всех (справедливость между
+    пользователями);
+  * задание, которое несколько раз обрывалось перезапуском, помечается
+    failed, чтобы не зациклиться на "ядовитом" документе;
+  * в режиме webhook с несколькими процессами (webhook.py) база очереди
+    общая, а каждый процесс выполняет и восстанавливает только задания
+    своих пользователей (owns_user в start()): контексты пользователя
+    открываются только в его процессе.
+
+Сама обработка передается в start() как корутина runner(job): очередь не
+зависит от aiogram и LightRAG.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_DB = os.getenv("INGEST_QUEUE_DB", os.path.join("data", "ingest_queue.sqlite3"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    context TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    status_message_id INTEGER,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_context ON jobs (user_id, context, status);
+"""
+
+
+@dataclass
+class IngestJob:
+    id: int
+    user_id: int
+    context: str
+    chat_id: int
+    status_message_id: Optional[int]
+    status: str
+    attempts: int
+    error: Optional[str]
+    created_at: float
+    updated_at: float
+
+
+JobRunner = Callable[[IngestJob], Awaitable[None]]
+UserFilter = Callable[[int], bool]
+
+
+class IngestQueue:
+    """Персистентная очередь заданий загрузки с пулом воркеров."""
+
+    def __init__(self, db_path: str = INGEST_QUEUE_DB, workers: int = INGEST_WORKERS,
+                 max_attempts: int = INGEST_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._db: Optional[sqlite3.Connection] = None
+        self._runner: Optional[JobRunner] = None
+        self._owns_user: Optional[UserFilter] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._running_users: Dict[int, int] = {}
+        # Идентификатор выполняемого задания -> событие его завершения
+        self._finished: Dict[int, asyncio.Event] = {}
+        self._last_served: Dict[int, float] = {}
+        self._completed = 0
+        self._failed = 0
+
+    # --- Хранилище ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> IngestJob:
+        return IngestJob(**dict(row))
+
+    def _set_status(self, job_id: int, status: str, error: Optional[str] = None):
+        db = self._connect()
+        # Отмененное во время выполнения задание остается отмененным
+        db.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status != ?",
+                   (status, error, time.time(), job_id, JOB_CANCELLED))
+        db.commit()
+
+    def get(self, job_id: int) -> Optional[IngestJob]:
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def pending_jobs(self) -> List[IngestJob]:
+        rows = self._connect().execute(
+            "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY id", (JOB_QUEUED, JOB_RUNNING)).fetchall()
+        return [self._job(row) for row in rows]
+
+    # --- Постановка в очередь ---
+
+    def queued_job(self, user_id: int, context: str) -> Optional[IngestJob]:
+        """Ожидающее задание контекста, к которому присоединится новая загрузка."""
+        row = self._connect().execute(
+            "SELECT * FROM jobs WHERE user_id = ? AND context = ? AND status = ? ORDER BY id LIMIT 1",
+            (user_id, context, JOB_QUEUED)).fetchone()
+        return self._job(row) if row else None
+
+    async def enqueue(self, user_id: int, context: str, chat_id: int,
+                      status_message_id: Optional[int] = None) -> Tuple[IngestJob, bool]:
+        """
+        Ставит загрузку контекста в очередь. Если для контекста уже есть
+        ожидающее задание, возвращает его (второй элемент - False).
+        status_message_id - сообщение для прогресса: записывается вместе с
+        заданием, чтобы свободный воркер не захватил задание без него.
+        """
+        job = self.queued_job(user_id, context)
+        if job is not None:
+            return job, False
+        db = self._connect()
+        now = time.time()
+        cursor = db.execute(
+            "INSERT INTO jobs (user_id, context, chat_id, status, status_message_id, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, context, chat_id, JOB_QUEUED, status_message_id, now, now))
+        db.commit()
+        job = self.get(cursor.lastrowid)
+        logging.info(f"Ingest job {job.id} queued for context {context} of user {user_id}")
+        await self._notify()
+        return job, True
+
+    def cancel_context(self, user_id: int, context: str) -> int:
+        """
+        Отменяет задания контекста (например, при его удалении): ожидающие не
+        запустятся, выполняемое остановится при ближайшей проверке is_cancelled
+        (дождаться его - wait_running).
+        """
+        db = self._connect()
+        cursor = db.execute(
+            "UPDATE jobs SET status = ?, updated_at = ? WHERE user_id = ? AND context = ? AND status IN (?, ?)",
+            (JOB_CANCELLED, time.time(), user_id, context, JOB_QUEUED, JOB_RUNNING))
+        db.commit()
+        return cursor.rowcount
+
+    def is_cancelled(self, job_id: int) -> bool:
+        job = self.get(job_id)
+        return job is None or job.status == JOB_CANCELLED
+
+    async def wait_running(self, user_id: int, context: str):
+        """Ждет завершения задания контекста, выполняемого в этом процессе (задания пользователя - в его процессе)."""
+        job_id = self._running_users.get(user_id)
+        finished = self._finished.get(job_id) if job_id is not None else None
+        if finished is None:
+            return
+        job = self.get(job_id)
+        if job is not None and job.context == context:
+            await finished.wait()
+
+    # --- Воркеры ---
+
+    async def _notify(self):
+        if self._wakeup is not None:
+            async with self._wakeup:
+                self._wakeup.notify_all()
+
+    def _owned(self, user_id: int) -> bool:
+        return self._owns_user is None or self._owns_user(user_id)
+
+    def _claim_next(self) -> Optional[IngestJob]:
+        """Выбирает задание пользователя, которого обслуживали дольше всех, и помечает его running."""
+        rows = self._connect().execute("SELECT * FROM jobs WHERE status = ? ORDER BY id", (JOB_QUEUED,)).fetchall()
+        best = None
+        for row in rows:
+            job = self._job(row)
+            if job.user_id in self._running_users or not self._owned(job.user_id):
+                continue
+            if best is None or self._last_served.get(job.user_id, 0.0) < self._last_served.get(best.user_id, 0.0):
+                best = job
+        if best is None:
+            return None
+        db = self._connect()
+        # Условие на статус: задание могли отменить между выборкой и захватом
+        claimed = db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = ?",
+                             (JOB_RUNNING, time.time(), best.id, JOB_QUEUED)).rowcount
+        db.commit()
+        if not claimed:
+            return None
+        self._running_users[best.user_id] = best.id
+        self._finished[best.id] = asyncio.Event()
+        self._last_served[best.user_id] = time.monotonic()
+        best.status = JOB_RUNNING
+        best.attempts += 1
+        return best
+
+    async def _worker(self, index: int):
+        while True:
+            async with self._wakeup:
+                job = self._claim_next()
+                while job is None:
+                    await self._wakeup.wait()
+                    job = self._claim_next()
+            logging.info(f"Ingest worker {index}: job {job.id} (context {job.context} of user {job.user_id}, "
+                         f"attempt {job.attempts})")
+            started = time.perf_counter()
+            try:
+                await self._runner(job)
+            except asyncio.CancelledError:
+                # Остановка бота: задание останется running и будет возобновлено при следующем старте
+                raise
+            except Exception as e:
+                logging.exception(f"Ingest job {job.id} failed: {e!r}")
+                self._set_status(job.id, JOB_FAILED, repr(e))
+                self._failed += 1
+            else:
+                if self.is_cancelled(job.id):
+                    logging.info(f"Ingest job {job.id} cancelled after {time.perf_counter() - started:.1f}s")
+                else:
+                    self._set_status(job.id, JOB_DONE)
+                    self._completed += 1
+                    logging.info(f"Ingest job {job.id} done in {time.perf_counter() - started:.1f}s")
+            finally:
+                self._running_users.pop(job.user_id, None)
+                self._finished.pop(job.id).set()
+                # Освободившийся пользователь мог иметь следующее задание
+                await self._notify()
+
+    def _recover(self):
+        """Возвращает в очередь задания, прерванные остановкой бота."""
+        db = self._connect()
+        now = time.time()
+        # Задания чужих процессов не трогаем: они могут выполняться прямо сейчас
+        interrupted = [(row["id"], row["attempts"]) for row in db.execute(
+            "SELECT id, user_id, attempts FROM jobs WHERE status = ?", (JOB_RUNNING,)) if self._owned(row["user_id"])]
+        failed = [(JOB_FAILED, "interrupted too many times", now, job_id)
+                  for job_id, attempts in interrupted if attempts >= self.max_attempts]
+        resumed = [(JOB_QUEUED, None, now, job_id) for job_id, attempts in interrupted if attempts < self.max_attempts]
+        db.executemany("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?", failed + resumed)
+        db.commit()
+        failed, resumed = len(failed), len(resumed)
+        if failed or resumed:
+            logging.info(f"Ingest queue: resumed {resumed} interrupted jobs, gave up on {failed}")
+
+    def start(self, runner: JobRunner, owns_user: Optional[UserFilter] = None):
+        """
+        Запускает воркеры. runner(job) выполняет загрузку контекста задания.
+        owns_user(user_id) ограничивает выполняемые задания пользователями
+        этого процесса (по умолчанию - все).
+        """
+        if self._tasks:
+            return
+        self._runner = runner
+        self._owns_user = owns_user
+        self._wakeup = asyncio.Condition()
+        self._recover()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logging.info(f"Ingest queue started with {self.workers} workers, {len(self.pending_jobs())} jobs pending")
+
+    def stats(self) -> dict:
+        counts = dict(self._connect().execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status", (JOB_QUEUED, JOB_RUNNING)).fetchall())
+        return {
+            "workers": self.workers,
+            "queued": counts.get(JOB_QUEUED, 0),
+            "running": counts.get(JOB_RUNNING, 0),
+            "completed": self._completed,
+            "failed": self._failed,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+# Общая для процесса очередь
+ingest_queue = IngestQueue()
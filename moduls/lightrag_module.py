@@ -1,53 +1,145 @@
 # Файл: moduls/lightrag_module.py
 from lightrag import LightRAG, QueryParam
-from lightrag.llm.openai import openai_complete_if_cache
-from lightrag.utils import setup_logger, EmbeddingFunc
-from lightrag.llm.hf import hf_embed
+from lightrag.utils import setup_logger, EmbeddingFunc, compute_mdhash_id
 from lightrag.kg.shared_storage import initialize_pipeline_status
+from lightrag.operate import chunking_by_token_size
 
 # Возможно, потребуется импортировать initialize_pipeline_status, если оно асинхронное
 # from lightrag.kg.shared_storage import initialize_pipeline_status
 
-from transformers import AutoModel, AutoTokenizer
-import asyncio # asyncio больше не нужен здесь для run
+import asyncio
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
 import numpy as np
-from config import LLM_API_KEY, LLM_BASE_URL, MODEL_NAME, MAX_TOKEN_SIZE_EMBED, EMBED_TOKENIZER_NAME
+from config import LLM_API_KEY, LLM_BASE_URL, MODEL_NAME, MAX_TOKEN_SIZE_EMBED
+from moduls.admission import PRIORITIES, current_priority
+from moduls.embedding_service import embedding_service
+from moduls.llm_client import llm_client
+from moduls.local_storage import STORAGE_PROFILES, detect_storage_profile
+from moduls.metrics import SIZE_BUCKETS, TOKEN_BUCKETS, counter, histogram, stage
 
 setup_logger("lightrag", level="INFO")
 
+# Максимальный размер части текстового файла, передаваемой в одну вставку LightRAG
+INSERT_SEGMENT_CHARS = int(os.getenv("INSERT_SEGMENT_CHARS", "100000"))
+# Сколько текста (в символах) передается LightRAG одной пакетной вставкой из нескольких документов
+INSERT_BATCH_CHARS = int(os.getenv("INSERT_BATCH_CHARS", "2000000"))
+# Ограничения параллелизма LightRAG: запросы к LLM и к модели эмбеддингов в работе,
+# число документов, обрабатываемых конвейером одновременно
+LLM_MAX_ASYNC = int(os.getenv("LLM_MAX_ASYNC", "4"))
+EMBED_MAX_ASYNC = int(os.getenv("EMBED_MAX_ASYNC", "16"))
+MAX_PARALLEL_INSERT = int(os.getenv("MAX_PARALLEL_INSERT", "4"))
+# Хранилища новых контекстов: "local" - SQLite и memory-mapped векторы (см.
+# moduls/local_storage.py), "json" - стандартные файлы LightRAG. JSON-хранилища
+# LightRAG держат данные в общих на процесс словарях по имени пространства, и
+# второй открытый в процессе контекст видит документы первого; локальные
+# хранилища привязаны к директории контекста.
+RAG_STORAGE_PROFILE = os.getenv("RAG_STORAGE_PROFILE", "local")
+
+# Состояние конвейера вставки у LightRAG общее на процесс: если конвейер занят
+# одним контекстом, вставка в другой только ставит документы в очередь его
+# хранилища и возвращается, не обработав их. Поэтому вставки в разные
+# контексты выполняются по очереди, а параллелизм дает пакетная вставка.
+# Флаги "хранилище изменено" у LightRAG тоже общие на пространство имен, а не
+# на контекст, поэтому удаление и уборка выполняются под той же блокировкой.
+_insert_lock = asyncio.Lock()
+
+def storage_profile_for(storage_dir: str) -> str:
+    """Профиль хранилищ контекста: записанный на диске, а для нового контекста - RAG_STORAGE_PROFILE."""
+    profile = detect_storage_profile(storage_dir)
+    if profile is None:
+        return RAG_STORAGE_PROFILE
+    if profile != RAG_STORAGE_PROFILE:
+        logging.info(f"Context storage {storage_dir} uses '{profile}' storages "
+                     f"(RAG_STORAGE_PROFILE={RAG_STORAGE_PROFILE}), see python -m moduls.local_storage")
+    return profile
+
+
+LLM_TOKENS = counter("llm_tokens_total", "LLM tokens by operation kind and token type")
+LLM_PROMPT_TOKENS = histogram("llm_prompt_tokens", "Prompt size of LLM calls", TOKEN_BUCKETS)
+LLM_STREAM_CHUNKS = counter("llm_stream_chunks_total", "Streamed answer chunks")
+CHUNKS = histogram("chunks_per_document", "Chunks produced per inserted document", SIZE_BUCKETS)
+_KINDS = {priority: kind for kind, priority in PRIORITIES.items()}
+
+
+class _LLMUsage:
+    """token_tracker для llm_client.complete: расход токенов в метрики (без потокового режима и ответов из кэша)."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def add_usage(self, counts: dict):
+        for token_type in ("prompt_tokens", "completion_tokens"):
+            LLM_TOKENS.inc(counts.get(token_type) or 0, kind=self.kind, type=token_type)
+        LLM_PROMPT_TOKENS.observe(counts.get("prompt_tokens") or 0, kind=self.kind)
+
+
+async def _timed_stream(chunks, kind: str):
+    """Потоковый ответ LLM: время от первого до последнего фрагмента и число фрагментов."""
+    count = 0
+    with stage("llm_stream", detail=kind) as span:
+        async for chunk in chunks:
+            count += 1
+            yield chunk
+        span.set(chunks=count)
+    LLM_STREAM_CHUNKS.inc(count, kind=kind)
+
+
+def _timed_chunking(content: str, *args, **kwargs) -> List[Dict]:
+    """chunking_func для LightRAG: стандартное разбиение по токенам с замером."""
+    with stage("chunking") as span:
+        chunks = chunking_by_token_size(content, *args, **kwargs)
+        span.set(chars=len(content), chunks=len(chunks))
+    CHUNKS.observe(len(chunks))
+    return chunks
+
+
+async def _embed(texts: List[str]) -> np.ndarray:
+    # Функция, а не метод embedding_service.embed: LightRAG делает deepcopy своей
+    # конфигурации, а сервис с блокировками и моделью копировать нельзя
+    return await embedding_service.embed(texts)
+
+
 # Сделать build_rag асинхронной функцией
 async def build_rag(storage_dir: str):
 
     # Определим асинхронную функцию для модели LLM, как и было
     async def llm_model_func(
             prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs) -> str:
-        return await openai_complete_if_cache(
+        # Вид операции (вопрос или загрузка), внутри которой LightRAG вызывает LLM
+        kind = "keywords" if keyword_extraction else _KINDS.get(current_priority.get(), "query")
+        kwargs.setdefault("token_tracker", _LLMUsage(kind))
+        # Общие для всех контекстов пул соединений, лимит частоты и кэш ответов (moduls/llm_client.py)
+        result = await llm_client.complete(
             MODEL_NAME,
             prompt,
             system_prompt=system_prompt,
             api_key=LLM_API_KEY,
             history_messages=history_messages,
             base_url=LLM_BASE_URL,
+            kind=kind,
             **kwargs
         )
+        if hasattr(result, "__aiter__"):
+            return _timed_stream(result, kind)
+        return result
 
     # Создаем экземпляр LightRAG
     rag = LightRAG(
         working_dir=storage_dir,
         llm_model_func=llm_model_func, # Передаем async функцию
         llm_model_name=MODEL_NAME,
+        llm_model_max_async=LLM_MAX_ASYNC,
+        embedding_func_max_async=EMBED_MAX_ASYNC,
+        max_parallel_insert=MAX_PARALLEL_INSERT,
+        chunking_func=_timed_chunking,
+        **STORAGE_PROFILES[storage_profile_for(storage_dir)],
         embedding_func=EmbeddingFunc(
             embedding_dim=1024,
             max_token_size=MAX_TOKEN_SIZE_EMBED,
-            func=lambda texts: hf_embed( # Убедись, что hf_embed может работать в async контексте (обычно да)
-                texts,
-                tokenizer=AutoTokenizer.from_pretrained(
-                    EMBED_TOKENIZER_NAME, device_map="auto"
-                ),
-                embed_model=AutoModel.from_pretrained(
-                    EMBED_TOKENIZER_NAME, device_map="auto"
-                ),
-            ),
+            # Модель загружается один раз на процесс и общая для всех контекстов
+            func=_embed,
         ),
     )
 
@@ -67,4 +159,123 @@ async def build_rag(storage_dir: str):
     # Возвращаем инициализированный объект rag
     return rag
 
-# Убираем вложенную initialize_rag и вызов asyncio.run
\ No newline at end of file
+# Убираем вложенную initialize_rag и вызов asyncio.run
+
+
+def iter_text_file_segments(txt_path: str, max_chars: int = INSERT_SEGMENT_CHARS) -> Iterator[str]:
+    """
+    Читает текстовый файл построчно и отдает его частями не длиннее max_chars
+    символов (граница проходит по концу строки; строка длиннее лимита
+    отдается целиком). Весь файл в памяти не держится.
+    """
+    segment: List[str] = []
+    size = 0
+    with open(txt_path, encoding="utf-8") as txt_file:
+        for line in txt_file:
+            if segment and size + len(line) > max_chars:
+                yield "".join(segment)
+                segment, size = [], 0
+            segment.append(line)
+            size += len(line)
+    if segment:
+        yield "".join(segment)
+
+
+async def _ainsert(rag: LightRAG, texts: List[str], ids: List[str], file_paths: List[str]):
+    async with _insert_lock:
+        await rag.ainsert(texts, ids=ids, file_paths=file_paths)
+
+
+async def ainsert_text_file(rag: LightRAG, txt_path: str, max_chars: int = INSERT_SEGMENT_CHARS,
+                            file_path: Optional[str] = None) -> List[str]:
+    """
+    Инкрементально добавляет текстовый файл в LightRAG частями, не загружая
+    его в память целиком. Возвращает идентификаторы добавленных документов.
+    """
+    doc_ids = []
+    for segment in iter_text_file_segments(txt_path, max_chars):
+        if not segment.strip():
+            continue
+        # Тот же идентификатор, который LightRAG назначил бы сам
+        doc_id = compute_mdhash_id(segment.strip(), prefix="doc-")
+        await _ainsert(rag, [segment], [doc_id], [file_path or os.path.basename(txt_path)])
+        doc_ids.append(doc_id)
+    return doc_ids
+
+
+async def ainsert_text_files(rag: LightRAG, txt_paths: Dict[str, str], max_chars: int = INSERT_SEGMENT_CHARS,
+                             batch_chars: int = INSERT_BATCH_CHARS) -> Dict[str, List[str]]:
+    """
+    Добавляет несколько текстовых файлов (имя документа -> путь к .txt)
+    пакетными вставками: LightRAG обрабатывает до MAX_PARALLEL_INSERT
+    документов пакета параллельно, в пределах LLM_MAX_ASYNC запросов к LLM.
+    В памяти одновременно не больше batch_chars символов текста.
+
+    Возвращает идентификаторы документов LightRAG для каждого файла. Ошибки
+    обработки отдельных документов LightRAG записывает в doc_status (см.
+    summarize_doc_status), исключение означает сбой всей вставки.
+    """
+    doc_ids: Dict[str, List[str]] = {name: [] for name in txt_paths}
+    batch_texts: List[str] = []
+    batch_ids: List[str] = []
+    batch_paths: List[str] = []
+    batch_size = 0
+    seen = set()
+    for name, txt_path in txt_paths.items():
+        for segment in iter_text_file_segments(txt_path, max_chars):
+            if not segment.strip():
+                continue
+            doc_id = compute_mdhash_id(segment.strip(), prefix="doc-")
+            doc_ids[name].append(doc_id)
+            if doc_id in seen:
+                continue  # одинаковый фрагмент в нескольких файлах вставляется один раз
+            seen.add(doc_id)
+            batch_texts.append(segment)
+            batch_ids.append(doc_id)
+            batch_paths.append(name)
+            batch_size += len(segment)
+            if batch_size >= batch_chars:
+                await _ainsert(rag, batch_texts, batch_ids, batch_paths)
+                batch_texts, batch_ids, batch_paths, batch_size = [], [], [], 0
+    if batch_texts:
+        await _ainsert(rag, batch_texts, batch_ids, batch_paths)
+    return doc_ids
+
+
+async def summarize_doc_status(rag: LightRAG, doc_ids: List[str]) -> Tuple[int, List[str]]:
+    """
+    По хранилищу статусов LightRAG возвращает суммарное число чанков документов
+    и список документов, которые не были успешно обработаны.
+    """
+    chunk_count = 0
+    failed_ids = []
+    for doc_id in doc_ids:
+        status = await rag.doc_status.get_by_id(doc_id)
+        if not status:
+            failed_ids.append(doc_id)
+            continue
+        state = status.get("status")
+        state = getattr(state, "value", state)
+        if str(state).lower() != "processed":
+            failed_ids.append(doc_id)
+        chunk_count += status.get("chunks_count") or 0
+    return chunk_count, failed_ids
+
+
+async def adelete_documents(rag: LightRAG, doc_ids: List[str]):
+    """Удаляет документы (чанки, векторы, сущности графа) из LightRAG."""
+    async with _insert_lock:
+        for doc_id in doc_ids:
+            await rag.adelete_by_doc_id(doc_id)
+            if await rag.doc_status.get_by_id(doc_id):
+                # Документ без чанков (упал до разбиения) LightRAG не удаляет - убираем его записи сами
+                await rag.full_docs.delete([doc_id])
+                await rag.doc_status.delete([doc_id])
+
+
+async def acompact_storage(rag: LightRAG) -> Dict[str, int]:
+    """Убирает висячие записи и переписывает файлы хранилища (см. moduls/storage_compaction.py)."""
+    from moduls.storage_compaction import compact_storage
+
+    async with _insert_lock:
+        return await compact_storage(rag)
@@ -0,0 +1,394 @@
+# Файл: moduls/llm_client.py
+"""
+Общий на процесс клиент LLM и кэш ответов LLM с адресацией по содержимому.
+
+Раньше каждый вызов LLM из LightRAG (openai_complete_if_cache) создавал
+новый клиент OpenAI со своим пулом соединений: каждое обращение к
+провайдеру начиналось с установки TCP и TLS. Кэш ответов LightRAG лежит в
+директории контекста, поэтому извлечение сущностей из одинаковых чанков,
+загруженных в разные контексты или разными пользователями, оплачивалось
+заново. Теперь:
+  * LLMClient держит один AsyncOpenAI на процесс с пулом keep-alive
+    соединений (LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY), HTTP/2 при установленном пакете h2 (LLM_HTTP2:
+    auto, 1 или 0) и общими тайм-аутами (LLM_TIMEOUT, LLM_CONNECT_TIMEOUT);
+  * временные ошибки (лимит частоты, сеть, тайм-аут, 5xx, пустой ответ)
+    повторяются до LLM_MAX_RETRIES раз с экспоненциальной задержкой и
+    случайным разбросом (full jitter, от LLM_RETRY_BASE_DELAY до
+    LLM_RETRY_MAX_DELAY секунд), Retry-After провайдера учитывается;
+  * LLMResponseCache хранит ответы (не потоковые) в SQLite (LLM_CACHE_DB,
+    общий для процессов webhook.py) с ключом SHA-256 от модели, сообщений
+    и параметров запроса; при LLM_CACHE_MAX_ENTRIES записей вытесняются
+    давно не использованные;
+  * одинаковые одновременные запросы выполняются один раз (single-flight).
+Ответ из кэша не расходует лимит частоты LLM_RATE_LIMIT_RPM; сэкономленные
+токены - в stats().
+"""
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from lightrag.utils import safe_unicode_decode
+from openai import (APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, InternalServerError,
+                    RateLimitError)
+
+from moduls.admission import TokenBucket, llm_rate_limiter
+from moduls.metrics import stage
+from moduls.single_flight import SingleFlight
+
+try:
+    import httpx
+except ImportError:
+    # Новые версии openai работают поверх httpx2 с тем же API
+    import httpx2 as httpx
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "180"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_KEEPALIVE_CONNECTIONS", "16"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+# auto - HTTP/2, если установлен пакет h2 (pip install httpx[http2])
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "auto")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", os.path.join("data", "llm_cache.sqlite3"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+
+# Заголовки, как у клиента LightRAG
+_DEFAULT_HEADERS = {"User-Agent": "LightRAG", "Content-Type": "application/json"}
+# Вытеснение проверяется не на каждой записи
+_EVICT_EVERY = 100
+# Время обращения к записям копится в памяти и пишется пачкой из стольких записей
+_TOUCH_FLUSH_EVERY = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    content TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class InvalidResponseError(Exception):
+    """Провайдер вернул пустой или неполный ответ (запрос повторяется)."""
+
+
+def _http2_enabled(setting: str = LLM_HTTP2) -> bool:
+    if setting == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return setting == "1"
+
+
+def request_key(model: str, messages: List[dict], params: Dict[str, Any]) -> str:
+    """Ключ кэша: хэш модели, сообщений и параметров, влияющих на ответ."""
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True,
+                         ensure_ascii=False, default=repr)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Дисковый кэш ответов LLM, общий для всех контекстов и процессов бота.
+    Методы блокирующие (SQLite с ожиданием блокировки записи других
+    процессов) - LLMClient вызывает их в потоке. Попадание только читает
+    базу: счетчик и время обращения копятся в памяти и записываются пачкой.
+    """
+
+    def __init__(self, db_path: str = LLM_CACHE_DB, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._puts = 0
+        # key -> (время последнего обращения, число попаданий) с последней записи
+        self._touched: Dict[str, Tuple[float, int]] = {}
+        self._entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Открывается при первом обращении: путь по умолчанию относительный
+        if self._db is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+            self._entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self._db
+
+    def _flush_touched(self, db: sqlite3.Connection):
+        if self._touched:
+            db.executemany("UPDATE responses SET hits = hits + ?, last_used = ? WHERE key = ?",
+                           [(hits, last_used, key) for key, (last_used, hits) in self._touched.items()])
+            self._touched.clear()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT content, prompt_tokens, completion_tokens FROM responses WHERE key = ?",
+                             (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._touched[key] = (time.time(), self._touched.get(key, (0.0, 0))[1] + 1)
+            if len(self._touched) >= _TOUCH_FLUSH_EVERY:
+                self._flush_touched(db)
+                db.commit()
+        content, prompt_tokens, completion_tokens = row
+        self.hits += 1
+        self.saved_prompt_tokens += prompt_tokens
+        self.saved_completion_tokens += completion_tokens
+        return content
+
+    def put(self, key: str, kind: str, content: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO responses (key, kind, content, prompt_tokens, completion_tokens, "
+                       "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (key, kind, content, prompt_tokens, completion_tokens, now, now))
+            self._puts += 1
+            self._entries += 1
+            if self._puts % _EVICT_EVERY == 0:
+                # Перед вытеснением - накопленные обращения, чтобы LRU учитывал недавние попадания
+                self._flush_touched(db)
+                evicted = db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                                     "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+                self.evictions += max(0, evicted)
+                self._entries = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            db.commit()
+
+    def stats(self) -> dict:
+        # Без обращения к базе: stats() вызывается из цикла событий (метрики)
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                try:
+                    self._flush_touched(self._db)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.warning(f"LLM cache: failed to save access times: {e!r}")
+                self._db.close()
+                self._db = None
+
+
+class LLMClient:
+    """Вызовы chat completions через общий пул соединений, с повторами, кэшем и объединением запросов."""
+
+    def __init__(self, cache: Optional[LLMResponseCache] = None, rate_limiter: Optional[TokenBucket] = None,
+                 max_retries: int = LLM_MAX_RETRIES, retry_base_delay: float = LLM_RETRY_BASE_DELAY,
+                 retry_max_delay: float = LLM_RETRY_MAX_DELAY):
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.flights = SingleFlight("llm")
+        self._client: Optional[AsyncOpenAI] = None
+        self._client_key: Optional[Tuple] = None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _openai(self, base_url: Optional[str], api_key: Optional[str]) -> AsyncOpenAI:
+        """Клиент для адреса и ключа; соединения пула привязаны к циклу событий, в котором созданы."""
+        key = (base_url, api_key, asyncio.get_running_loop())
+        if self._client is None or self._client_key != key:
+            if self._client is not None and self._client_key[2] is key[2]:
+                asyncio.create_task(self._client.close())
+            http_client = httpx.AsyncClient(
+                http2=_http2_enabled(),
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                    max_keepalive_connections=LLM_KEEPALIVE_CONNECTIONS,
+                                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT))
+            # Повторы выполняет LLMClient: с разбросом задержки и с учетом лимита частоты
+            self._client = AsyncOpenAI(base_url=base_url, api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+                                       default_headers=_DEFAULT_HEADERS, http_client=http_client, max_retries=0)
+            self._client_key = key
+        return self._client
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        retry_after = None
+        if isinstance(error, APIStatusError):
+            try:
+                retry_after = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        # Full jitter: одновременно упавшие запросы не повторяются разом
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    async def _request(self, client: AsyncOpenAI, model: str, messages: List[dict], kind: str,
+                       params: Dict[str, Any]):
+        """Запрос к провайдеру с повторами временных ошибок."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                # Общий на процесс лимит частоты запросов к провайдеру LLM (LLM_RATE_LIMIT_RPM)
+                await self.rate_limiter.acquire()
+            self.requests += 1
+            try:
+                async with stage("llm", detail=kind) as span:
+                    if "response_format" in params:
+                        response = await client.beta.chat.completions.parse(model=model, messages=messages,
+                                                                            **params)
+                    else:
+                        response = await client.chat.completions.create(model=model, messages=messages, **params)
+                    if not params.get("stream"):
+                        content = response.choices[0].message.content if response and response.choices else None
+                        if not content or not content.strip():
+                            raise InvalidResponseError("Empty content in LLM response")
+                    span.set(attempt=attempt)
+                return response
+            except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError,
+                    InvalidResponseError) as e:
+                if attempt >= self.max_retries:
+                    self.failures += 1
+                    logging.error(f"LLM request failed after {attempt + 1} attempts: {e!r}")
+                    raise
+                delay = self._retry_delay(attempt, e)
+                attempt += 1
+                self.retries += 1
+                logging.warning(f"LLM request failed ({e!r}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            except Exception:
+                self.failures += 1
+                raise
+
+    async def complete(self, model: str, prompt: str, system_prompt: Optional[str] = None,
+                       history_messages: Optional[List[dict]] = None, base_url: Optional[str] = None,
+                       api_key: Optional[str] = None, token_tracker: Any = None, kind: str = "query",
+                       **kwargs) -> Union[str, AsyncIterator[str]]:
+        """
+        Замена openai_complete_if_cache из LightRAG: текст ответа или, при
+        stream=True, асинхронный поток фрагментов (потоковые ответы не кэшируются).
+        """
+        # Служебные аргументы LightRAG, не параметры запроса
+        kwargs.pop("hashing_kv", None)
+        kwargs.pop("keyword_extraction", None)
+        messages: List[dict] = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.extend(history_messages or [])
+        messages.append({"role": "user", "content": prompt})
+        client = self._openai(base_url, api_key)
+
+        if kwargs.get("stream"):
+            response = await self._request(client, model, messages, kind, kwargs)
+            return self._stream(response)
+
+        key = request_key(model, messages, kwargs)
+        if self.cache is not None:
+            try:
+                cached = await asyncio.to_thread(self.cache.get, key)
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache: lookup failed: {e!r}")
+                cached = None
+            if cached is not None:
+                return cached
+        # Такой же запрос уже выполняется (например, одинаковый чанк в двух контекстах): ждем его ответ
+        flight, leader = self.flights.join(key)
+        if not leader:
+            try:
+                return "".join([chunk async for chunk in flight.follow()])
+            except RuntimeError:
+                # Запрос ведущего не удался или отменен вместе с его операцией - выполняем свой
+                return await self._fetch(client, model, messages, kind, kwargs, key, token_tracker)
+        error = None
+        try:
+            content = await self._fetch(client, model, messages, kind, kwargs, key, token_tracker)
+            await flight.publish(content)
+            return content
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await self.flights.finish(flight, error)
+
+    async def _fetch(self, client: AsyncOpenAI, model: str, messages: List[dict], kind: str,
+                     params: Dict[str, Any], key: str, token_tracker: Any) -> str:
+        """Ответ провайдера: учет токенов и запись в кэш."""
+        response = await self._request(client, model, messages, kind, params)
+        content = response.choices[0].message.content
+        if r"\u" in content:
+            content = safe_unicode_decode(content.encode("utf-8"))
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        if token_tracker is not None and usage is not None:
+            token_tracker.add_usage({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                     "total_tokens": getattr(usage, "total_tokens", 0) or 0})
+        if self.cache is not None:
+            try:
+                await asyncio.to_thread(self.cache.put, key, kind, content, prompt_tokens, completion_tokens)
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache: failed to store response: {e!r}")
+        return content
+
+    @staticmethod
+    async def _stream(response) -> AsyncIterator[str]:
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                if r"\u" in content:
+                    content = safe_unicode_decode(content.encode("utf-8"))
+                yield content
+
+    def stats(self) -> dict:
+        return {
+            "http2": _http2_enabled(),
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            **{f"flight_{name}": value for name, value in self.flights.stats().items()},
+            **({f"cache_{name}": value for name, value in self.cache.stats().items()} if self.cache else {}),
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._client_key = None
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.close)
+
+
+# Общий для процесса клиент LLM (кэш ответов - при LLM_CACHE_ENABLED=1)
+llm_client = LLMClient(cache=LLMResponseCache() if LLM_CACHE_ENABLED else None, rate_limiter=llm_rate_limiter)
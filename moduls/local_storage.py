@@ -0,0 +1,927 @@
+# Файл: moduls/local_storage.py
+"""
+Встроенные локальные хранилища LightRAG для контекстов.
+
+Стандартные хранилища LightRAG (JsonKVStorage, JsonDocStatusStorage,
+NanoVectorDBStorage) при открытии контекста целиком читают JSON-файлы в
+память (векторы - base64 внутри JSON) и целиком переписывают их при каждом
+сохранении. Контекст с десятками тысяч чанков открывается секундами и
+занимает сотни мегабайт.
+
+Кроме того, JSON-хранилища держат данные в общих на процесс словарях по
+имени пространства (full_docs, text_chunks, doc_status), так что контексты,
+открытые в одном процессе, видят данные друг друга.
+
+Профиль хранилищ "local" (RAG_STORAGE_PROFILE=local) заменяет их на:
+  * SqliteKVStorage / SqliteDocStatusStorage - записи в SQLite
+    (rag_store.sqlite3 в директории storage), читаются по ключу по мере
+    надобности, сохранение - коммит транзакции, а не перезапись файла;
+  * MmapVectorDBStorage - нормированные векторы float32 в memory-mapped
+    файле (vdb_<namespace>.f32, после уборки хранилища - новое поколение
+    vdb_<namespace>.g<N>.f32, имя записано в SQLite), метаданные - в той же SQLite. При открытии
+    читаются только идентификаторы и номера строк. Поиск точный (скалярное
+    произведение по строкам файла), а начиная с VECTOR_IVF_MIN_ROWS векторов -
+    приближенный по IVF-индексу (k-means центроиды, просматриваются
+    VECTOR_IVF_NPROBE ближайших списков), индекс хранится в vdb_<namespace>.ivf.npz.
+Граф остается в NetworkXStorage.
+
+Профиль выбирается для новых контекстов; существующий контекст всегда
+открывается в том формате, в котором он записан (detect_storage_profile).
+Перенос контекста из JSON в локальные хранилища (бот должен быть остановлен):
+    python -m moduls.local_storage data/contexts/<user_id>/<context>/storage
+Исходные JSON-файлы переносятся в storage/json_backup/.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple, Union, final
+
+import numpy as np
+
+from lightrag.base import BaseKVStorage, BaseVectorStorage, DocProcessingStatus, DocStatus, DocStatusStorage
+from lightrag.utils import compute_mdhash_id
+
+from moduls.metrics import stage
+
+VECTOR_IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS", "20000"))
+VECTOR_IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "16"))
+
+LOCAL_STORE_FILE_NAME = "rag_store.sqlite3"
+JSON_BACKUP_DIR_NAME = "json_backup"
+
+# Имена хранилищ LightRAG для профилей (аргументы конструктора LightRAG)
+STORAGE_PROFILES = {
+    "json": {
+        "kv_storage": "JsonKVStorage",
+        "vector_storage": "NanoVectorDBStorage",
+        "doc_status_storage": "JsonDocStatusStorage",
+    },
+    "local": {
+        "kv_storage": "SqliteKVStorage",
+        "vector_storage": "MmapVectorDBStorage",
+        "doc_status_storage": "SqliteDocStatusStorage",
+    },
+}
+
+# Начальная емкость файла векторов в строках; дальше файл растет вдвое
+_INITIAL_VECTOR_ROWS = 1024
+# SQLite ограничивает число параметров в запросе
+_SQL_BATCH = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    id TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS llm_cache (
+    namespace TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    id TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, mode, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS doc_status (
+    namespace TEXT NOT NULL,
+    id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS doc_status_by_status ON doc_status (namespace, status);
+CREATE TABLE IF NOT EXISTS vectors (
+    namespace TEXT NOT NULL,
+    id TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    created_at REAL,
+    PRIMARY KEY (namespace, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vector_files (
+    namespace TEXT PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    file TEXT
+);
+"""
+
+
+def _batches(items: List[Any], size: int = _SQL_BATCH):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+# --- Общее соединение с SQLite контекста ---
+
+class _StoreDB:
+    """
+    Одно соединение на файл rag_store.sqlite3: все хранилища контекста пишут в
+    одну транзакцию, которая фиксируется в index_done_callback (как запись
+    JSON-файлов у стандартных хранилищ). Раздельные соединения блокировали бы
+    друг друга незафиксированными записями.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        # Базы, созданные до поколений файла векторов: file = NULL - файл vdb_<namespace>.f32
+        if "file" not in {column[1] for column in self.db.execute("PRAGMA table_info(vector_files)")}:
+            self.db.execute("ALTER TABLE vector_files ADD COLUMN file TEXT")
+        self.db.commit()
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.db.commit()
+
+    def vacuum(self) -> bool:
+        """Возвращает место удаленных записей файлу, если оно есть."""
+        self.commit()
+        if self.db.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+            return False
+        self.db.execute("VACUUM")
+        # VACUUM пишет копию базы в WAL - возвращаем место сразу
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+
+_open_dbs: Dict[str, _StoreDB] = {}
+
+
+def _acquire_db(working_dir: str) -> _StoreDB:
+    path = os.path.abspath(os.path.join(working_dir, LOCAL_STORE_FILE_NAME))
+    store = _open_dbs.get(path)
+    if store is None:
+        store = _open_dbs[path] = _StoreDB(path)
+    store.refs += 1
+    return store
+
+
+def _release_db(store: _StoreDB):
+    store.refs -= 1
+    if store.refs <= 0:
+        store.commit()
+        store.db.close()
+        _open_dbs.pop(store.path, None)
+
+
+# --- KV и статусы документов ---
+
+@final
+@dataclass
+class SqliteKVStorage(BaseKVStorage):
+    """KV-хранилище LightRAG в таблице SQLite; кэш LLM - по записи на (режим, хэш)."""
+
+    def __post_init__(self):
+        self._store: Optional[_StoreDB] = None
+        self._is_cache = self.namespace.endswith("cache")
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._store.db
+
+    async def initialize(self):
+        if self._store is None:
+            self._store = _acquire_db(self.global_config["working_dir"])
+
+    async def finalize(self):
+        if self._store is not None:
+            _release_db(self._store)
+            self._store = None
+
+    async def index_done_callback(self) -> None:
+        self._store.commit()
+
+    def _mode_cache(self, mode: str, cache_id: Optional[str] = None) -> Dict[str, Any]:
+        if cache_id is None:
+            rows = self._db.execute("SELECT id, value FROM llm_cache WHERE namespace = ? AND mode = ?",
+                                    (self.namespace, mode))
+        else:
+            rows = self._db.execute("SELECT id, value FROM llm_cache WHERE namespace = ? AND mode = ? AND id = ?",
+                                    (self.namespace, mode, cache_id))
+        return {cache_id: json.loads(value) for cache_id, value in rows}
+
+    async def get_all(self) -> Dict[str, Any]:
+        if self._is_cache:
+            result: Dict[str, Dict[str, Any]] = {}
+            for mode, cache_id, value in self._db.execute(
+                    "SELECT mode, id, value FROM llm_cache WHERE namespace = ?", (self.namespace,)):
+                result.setdefault(mode, {})[cache_id] = json.loads(value)
+            return result
+        return {key: json.loads(value) for key, value in
+                self._db.execute("SELECT id, value FROM kv WHERE namespace = ?", (self.namespace,))}
+
+    async def get_by_id(self, id: str) -> Optional[Dict[str, Any]]:
+        if self._is_cache:
+            return self._mode_cache(id) or None
+        row = self._db.execute("SELECT value FROM kv WHERE namespace = ? AND id = ?", (self.namespace, id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get_by_mode_and_id(self, mode: str, id: str) -> Optional[Dict[str, Any]]:
+        """Одна запись кэша LLM без чтения всех записей режима (LightRAG вызывает, если метод есть)."""
+        return self._mode_cache(mode, id) or None
+
+    async def get_by_ids(self, ids: List[str]) -> List[Optional[Dict[str, Any]]]:
+        if self._is_cache:
+            return [await self.get_by_id(key) for key in ids]
+        found: Dict[str, Any] = {}
+        for part in _batches(list(set(ids))):
+            placeholders = ",".join("?" * len(part))
+            for key, value in self._db.execute(
+                    f"SELECT id, value FROM kv WHERE namespace = ? AND id IN ({placeholders})", (self.namespace, *part)):
+                found[key] = json.loads(value)
+        return [found.get(key) for key in ids]
+
+    async def filter_keys(self, keys: Set[str]) -> Set[str]:
+        table = "llm_cache" if self._is_cache else "kv"
+        column = "mode" if self._is_cache else "id"
+        existing = set()
+        for part in _batches(list(keys)):
+            placeholders = ",".join("?" * len(part))
+            existing.update(key for (key,) in self._db.execute(
+                f"SELECT DISTINCT {column} FROM {table} WHERE namespace = ? AND {column} IN ({placeholders})",
+                (self.namespace, *part)))
+        return set(keys) - existing
+
+    async def upsert(self, data: Dict[str, Dict[str, Any]]) -> None:
+        if not data:
+            return
+        if self._is_cache:
+            # LightRAG передает словарь режима целиком или только измененную запись - записи сливаются
+            self._db.executemany(
+                "INSERT OR REPLACE INTO llm_cache (namespace, mode, id, value) VALUES (?, ?, ?, ?)",
+                [(self.namespace, mode, cache_id, _dumps(entry))
+                 for mode, entries in data.items() for cache_id, entry in entries.items()])
+            return
+        self._db.executemany("INSERT OR REPLACE INTO kv (namespace, id, value) VALUES (?, ?, ?)",
+                             [(self.namespace, key, _dumps(value)) for key, value in data.items()])
+
+    async def delete(self, ids: List[str]) -> None:
+        table, column = ("llm_cache", "mode") if self._is_cache else ("kv", "id")
+        self._db.executemany(f"DELETE FROM {table} WHERE namespace = ? AND {column} = ?",
+                             [(self.namespace, key) for key in ids])
+        self._store.commit()
+
+    async def drop(self) -> None:
+        self._db.execute(f"DELETE FROM {'llm_cache' if self._is_cache else 'kv'} WHERE namespace = ?",
+                         (self.namespace,))
+        self._store.commit()
+
+    async def compact(self) -> bool:
+        """VACUUM файла SQLite (общего для всех хранилищ контекста)."""
+        return self._store.vacuum()
+
+
+def _status_value(status: Any) -> str:
+    return getattr(status, "value", status)
+
+
+@final
+@dataclass
+class SqliteDocStatusStorage(DocStatusStorage):
+    """Статусы документов LightRAG в SQLite с индексом по статусу."""
+
+    def __post_init__(self):
+        self._store: Optional[_StoreDB] = None
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._store.db
+
+    async def initialize(self):
+        if self._store is None:
+            self._store = _acquire_db(self.global_config["working_dir"])
+
+    async def finalize(self):
+        if self._store is not None:
+            _release_db(self._store)
+            self._store = None
+
+    async def index_done_callback(self) -> None:
+        self._store.commit()
+
+    async def filter_keys(self, keys: Set[str]) -> Set[str]:
+        existing = set()
+        for part in _batches(list(keys)):
+            placeholders = ",".join("?" * len(part))
+            existing.update(key for (key,) in self._db.execute(
+                f"SELECT id FROM doc_status WHERE namespace = ? AND id IN ({placeholders})", (self.namespace, *part)))
+        return set(keys) - existing
+
+    async def get_by_id(self, id: str) -> Union[Dict[str, Any], None]:
+        row = self._db.execute("SELECT value FROM doc_status WHERE namespace = ? AND id = ?",
+                               (self.namespace, id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get_by_ids(self, ids: List[str]) -> List[Dict[str, Any]]:
+        found: Dict[str, Any] = {}
+        for part in _batches(list(set(ids))):
+            placeholders = ",".join("?" * len(part))
+            for key, value in self._db.execute(
+                    f"SELECT id, value FROM doc_status WHERE namespace = ? AND id IN ({placeholders})",
+                    (self.namespace, *part)):
+                found[key] = json.loads(value)
+        return [found[key] for key in ids if key in found]
+
+    async def get_status_counts(self) -> Dict[str, int]:
+        counts = {status.value: 0 for status in DocStatus}
+        for status, count in self._db.execute(
+                "SELECT status, COUNT(*) FROM doc_status WHERE namespace = ? GROUP BY status", (self.namespace,)):
+            counts[status] = count
+        return counts
+
+    async def get_docs_by_status(self, status: DocStatus) -> Dict[str, DocProcessingStatus]:
+        result = {}
+        for key, value in self._db.execute("SELECT id, value FROM doc_status WHERE namespace = ? AND status = ?",
+                                           (self.namespace, status.value)):
+            data = json.loads(value)
+            # Те же подстановки, что в JsonDocStatusStorage
+            if "content" not in data and "content_summary" in data:
+                data["content"] = data["content_summary"]
+            data.setdefault("file_path", "no-file-path")
+            try:
+                result[key] = DocProcessingStatus(**data)
+            except (KeyError, TypeError) as e:
+                logging.error(f"Invalid doc status record {key} in {self.namespace}: {e}")
+        return result
+
+    async def upsert(self, data: Dict[str, Dict[str, Any]]) -> None:
+        if not data:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO doc_status (namespace, id, status, value) VALUES (?, ?, ?, ?)",
+            [(self.namespace, key, _status_value(value["status"]), _dumps(value)) for key, value in data.items()])
+        # Статусы сохраняются сразу, как в JsonDocStatusStorage: по ним конвейер продолжает работу после сбоя
+        self._store.commit()
+
+    async def delete(self, doc_ids: List[str]):
+        self._db.executemany("DELETE FROM doc_status WHERE namespace = ? AND id = ?",
+                             [(self.namespace, key) for key in doc_ids])
+        self._store.commit()
+
+    async def drop(self) -> None:
+        self._db.execute("DELETE FROM doc_status WHERE namespace = ?", (self.namespace,))
+        self._store.commit()
+
+
+# --- Векторы ---
+
+class VectorFile:
+    """Векторы float32 фиксированной ширины в memory-mapped файле, растущем вдвое по мере заполнения."""
+
+    def __init__(self, path: str, dim: int, rows: int = 0):
+        self.path = path
+        self.dim = dim
+        self._matrix: Optional[np.memmap] = None
+        self.capacity = 0
+        with open(path, "ab"):
+            pass
+        existing = os.path.getsize(path) // (dim * 4)
+        self._open(max(existing, rows, _INITIAL_VECTOR_ROWS))
+
+    def _open(self, capacity: int):
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        with open(self.path, "r+b") as vectors_file:
+            if os.path.getsize(self.path) < capacity * self.dim * 4:
+                vectors_file.truncate(capacity * self.dim * 4)
+        self._matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def ensure_capacity(self, rows: int):
+        if rows > self.capacity:
+            capacity = self.capacity
+            while capacity < rows:
+                capacity *= 2
+            self._open(capacity)
+
+    @property
+    def matrix(self) -> np.memmap:
+        return self._matrix
+
+    def flush(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+
+    def close(self):
+        self.flush()
+        self._matrix = None
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _train_ivf(matrix: np.ndarray, rows: np.ndarray, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Сферический k-means по выборке строк; возвращает нормированные центроиды."""
+    rng = np.random.default_rng(seed)
+    lists = max(1, int(np.sqrt(len(rows))))
+    sample = rows if len(rows) <= lists * 64 else rng.choice(rows, lists * 64, replace=False)
+    data = np.asarray(matrix[np.sort(sample)])
+    centroids = data[rng.choice(len(data), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        empty = np.bincount(assignment, minlength=lists) == 0
+        # Пустые списки получают случайные точки выборки
+        sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(matrix: np.ndarray, rows: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+    result = np.empty(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), block):
+        part = rows[start:start + block]
+        result[start:start + block] = np.argmax(np.asarray(matrix[part]) @ centroids.T, axis=1)
+    return result
+
+
+@final
+@dataclass
+class MmapVectorDBStorage(BaseVectorStorage):
+    """Векторное хранилище LightRAG: memory-mapped файл векторов, метаданные в SQLite, IVF-поиск."""
+
+    def __post_init__(self):
+        kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        cosine_threshold = kwargs.get("cosine_better_than_threshold")
+        if cosine_threshold is None:
+            raise ValueError("cosine_better_than_threshold must be specified in vector_db_storage_cls_kwargs")
+        self.cosine_better_than_threshold = cosine_threshold
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        working_dir = self.global_config["working_dir"]
+        self._working_dir = working_dir
+        # Имя файла векторов берется из vector_files: compact пишет новое поколение файла
+        self._vectors_path = os.path.join(working_dir, f"vdb_{self.namespace}.f32")
+        self._ivf_path = os.path.join(working_dir, f"vdb_{self.namespace}.ivf.npz")
+        self._store: Optional[_StoreDB] = None
+        self._file: Optional[VectorFile] = None
+        # Строка файла -> идентификатор (None - свободная строка) и обратно
+        self._row_ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._live = np.zeros(0, dtype=bool)
+        self._free: List[int] = []
+        # Строки, освобожденные в текущей транзакции: переиспользуются только после коммита
+        self._pending_free: List[int] = []
+        self._centroids: Optional[np.ndarray] = None
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._ivf_trained_rows = 0
+        self._ivf_dirty = False
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._store.db
+
+    async def initialize(self):
+        if self._store is not None:
+            return
+        started = time.perf_counter()
+        self._store = _acquire_db(self.global_config["working_dir"])
+        dim = self.embedding_func.embedding_dim
+        row = self._db.execute("SELECT dim, file FROM vector_files WHERE namespace = ?",
+                               (self.namespace,)).fetchone()
+        if row is None:
+            self._db.execute("INSERT INTO vector_files (namespace, dim) VALUES (?, ?)", (self.namespace, dim))
+            self._store.commit()
+        elif row[0] != dim:
+            raise ValueError(f"Embedding dim mismatch in {self.namespace}: expected {dim}, stored {row[0]}")
+        elif row[1]:
+            self._vectors_path = os.path.join(self._working_dir, row[1])
+        self._remove_stale_files()
+        pairs = self._db.execute("SELECT id, row FROM vectors WHERE namespace = ?", (self.namespace,)).fetchall()
+        used = max((row for _, row in pairs), default=-1) + 1
+        self._file = VectorFile(self._vectors_path, dim, used)
+        self._row_ids = [None] * used
+        for key, row in pairs:
+            self._row_ids[row] = key
+            self._rows[key] = row
+        self._live = np.zeros(self._file.capacity, dtype=bool)
+        self._live[[row for _, row in pairs]] = True
+        self._free = [row for row in range(used) if self._row_ids[row] is None]
+        self._load_ivf()
+        logging.info(f"Vector storage {self.namespace}: {len(pairs)} vectors opened in "
+                     f"{time.perf_counter() - started:.3f}s" + (", IVF index" if self._centroids is not None else ""))
+
+    def _remove_stale_files(self):
+        """Поколения файла векторов, оставшиеся от прерванного compact (до или после коммита)."""
+        current = os.path.basename(self._vectors_path)
+        pattern = rf"vdb_{re.escape(self.namespace)}(\.g\d+)?\.f32(\.tmp)?"
+        for name in os.listdir(self._working_dir):
+            if name != current and re.fullmatch(pattern, name):
+                logging.info(f"Vector storage {self.namespace}: removing stale vector file {name}")
+                os.remove(os.path.join(self._working_dir, name))
+
+    def _load_ivf(self):
+        if not os.path.exists(self._ivf_path):
+            return
+        try:
+            with np.load(self._ivf_path) as index:
+                centroids, lists = index["centroids"], index["lists"]
+        except Exception as e:
+            logging.warning(f"Vector storage {self.namespace}: IVF index is unreadable ({e!r}), will be rebuilt")
+            return
+        if centroids.shape[1] != self._file.dim or len(lists) < len(self._row_ids):
+            return
+        self._centroids = centroids
+        self._lists = np.full(self._file.capacity, -1, dtype=np.int32)
+        self._lists[:len(lists)] = lists[:self._file.capacity]
+        self._ivf_trained_rows = int(self._live.sum())
+
+    async def finalize(self):
+        if self._store is None:
+            return
+        await self.index_done_callback()
+        self._file.close()
+        _release_db(self._store)
+        self._store = None
+
+    def _grow(self, rows: int):
+        self._file.ensure_capacity(rows)
+        if len(self._live) < self._file.capacity:
+            self._live = np.concatenate([self._live, np.zeros(self._file.capacity - len(self._live), dtype=bool)])
+            if self._centroids is not None:
+                self._lists = np.concatenate(
+                    [self._lists, np.full(self._file.capacity - len(self._lists), -1, dtype=np.int32)])
+
+    def _take_row(self) -> int:
+        if self._free:
+            return self._free.pop()
+        self._row_ids.append(None)
+        self._grow(len(self._row_ids))
+        return len(self._row_ids) - 1
+
+    def write(self, ids: List[str], vectors: np.ndarray, metas: List[Dict[str, Any]], created_at: List[float]):
+        """Записывает готовые векторы (нормируются здесь); используется upsert и переносом из JSON."""
+        vectors = _normalize(vectors)
+        rows = []
+        for key in ids:
+            row = self._rows.get(key)
+            if row is None:
+                row = self._take_row()
+                self._rows[key] = row
+                self._row_ids[row] = key
+            rows.append(row)
+        rows_array = np.asarray(rows)
+        self._file.matrix[rows_array] = vectors
+        self._live[rows_array] = True
+        if self._centroids is not None:
+            self._lists[rows_array] = np.argmax(vectors @ self._centroids.T, axis=1)
+        self._ivf_dirty = True
+        self._db.executemany(
+            "INSERT OR REPLACE INTO vectors (namespace, id, row, meta, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(self.namespace, key, row, _dumps(meta), created) for key, row, meta, created
+             in zip(ids, rows, metas, created_at)])
+
+    async def upsert(self, data: Dict[str, Dict[str, Any]]) -> None:
+        logging.info(f"Inserting {len(data)} to {self.namespace}")
+        if not data:
+            return
+        contents = [value["content"] for value in data.values()]
+        embeddings = np.concatenate([await self.embedding_func(batch)
+                                     for batch in _batches(contents, self._max_batch_size)])
+        if len(embeddings) != len(data):
+            logging.error(f"embedding is not 1-1 with data, {len(embeddings)} != {len(data)}")
+            return
+        now = time.time()
+        self.write(list(data), embeddings,
+                   [{field: value for field, value in item.items() if field in self.meta_fields}
+                    for item in data.values()],
+                   [now] * len(data))
+
+    def _candidate_rows(self, query: np.ndarray) -> np.ndarray:
+        count = len(self._row_ids)
+        if self._centroids is None:
+            return np.flatnonzero(self._live[:count])
+        probes = np.argsort(-(self._centroids @ query))[:VECTOR_IVF_NPROBE]
+        return np.flatnonzero(np.isin(self._lists[:count], probes) & self._live[:count])
+
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """Строки и косинусная близость top_k ближайших векторов не хуже порога."""
+        query = _normalize(query.reshape(-1))
+        rows = self._candidate_rows(query)
+        if len(rows) == 0:
+            return []
+        if len(rows) == len(self._row_ids):
+            scores = np.asarray(self._file.matrix[:len(rows)]) @ query
+        else:
+            scores = np.asarray(self._file.matrix[rows]) @ query
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [(int(rows[i]), float(scores[i])) for i in best if scores[i] >= self.cosine_better_than_threshold]
+
+    def _records(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        for part in _batches(list(set(ids))):
+            placeholders = ",".join("?" * len(part))
+            for key, meta, created_at in self._db.execute(
+                    f"SELECT id, meta, created_at FROM vectors WHERE namespace = ? AND id IN ({placeholders})",
+                    (self.namespace, *part)):
+                records[key] = {**json.loads(meta), "__id__": key, "__created_at__": created_at}
+        return records
+
+    async def query(self, query: str, top_k: int, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        embedding = (await self.embedding_func([query]))[0]
+        with stage("vector_search", detail=self.namespace) as span:
+            found = self.search(np.asarray(embedding, dtype=np.float32), top_k)
+            records = self._records([self._row_ids[row] for row, _ in found])
+            span.set(vectors=len(self._rows), top_k=top_k)
+        results = []
+        for row, score in found:
+            record = records.get(self._row_ids[row])
+            if record is not None:
+                results.append({**record, "id": record["__id__"], "__metrics__": score, "distance": score,
+                                "created_at": record["__created_at__"]})
+        return results
+
+    async def delete(self, ids: List[str]):
+        removed = [key for key in ids if key in self._rows]
+        for key in removed:
+            row = self._rows.pop(key)
+            self._row_ids[row] = None
+            self._live[row] = False
+            self._pending_free.append(row)
+        if removed:
+            self._db.executemany("DELETE FROM vectors WHERE namespace = ? AND id = ?",
+                                 [(self.namespace, key) for key in removed])
+            self._ivf_dirty = True
+            logging.debug(f"Deleted {len(removed)} vectors from {self.namespace}")
+
+    async def delete_entity(self, entity_name: str) -> None:
+        await self.delete([compute_mdhash_id(entity_name, prefix="ent-")])
+
+    async def delete_entity_relation(self, entity_name: str) -> None:
+        ids = [key for (key,) in self._db.execute(
+            "SELECT id FROM vectors WHERE namespace = ? AND "
+            "(json_extract(meta, '$.src_id') = ? OR json_extract(meta, '$.tgt_id') = ?)",
+            (self.namespace, entity_name, entity_name))]
+        await self.delete(ids)
+
+    async def get_by_id(self, id: str) -> Optional[Dict[str, Any]]:
+        return self._records([id]).get(id)
+
+    async def get_by_ids(self, ids: List[str]) -> List[Dict[str, Any]]:
+        records = self._records(ids)
+        return [records[key] for key in ids if key in records]
+
+    async def search_by_prefix(self, prefix: str) -> List[Dict[str, Any]]:
+        return [{**record, "id": key} for key, record in
+                self._records([key for key in self._rows if key.startswith(prefix)]).items()]
+
+    @property
+    async def client_storage(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Все записи без векторов - в формате NanoVectorDB (для уборки хранилища)."""
+        return {"data": list(self._records(list(self._rows)).values())}
+
+    @staticmethod
+    def _train_and_assign(matrix: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        centroids = _train_ivf(matrix, rows)
+        return centroids, _assign(matrix, rows, centroids)
+
+    async def _maybe_train_ivf(self):
+        live_rows = np.flatnonzero(self._live[:len(self._row_ids)])
+        if len(live_rows) < VECTOR_IVF_MIN_ROWS:
+            if self._centroids is not None:
+                self._drop_ivf()
+            return
+        # Переобучение, когда коллекция выросла вдвое с прошлого обучения
+        if self._centroids is not None and len(live_rows) < 2 * self._ivf_trained_rows:
+            return
+        started = time.perf_counter()
+        # k-means на десятках тысяч векторов занимает секунды - в потоке, чтобы не останавливать бота;
+        # пока идет обучение, поиск пользуется прежним индексом, новый подставляется целиком
+        centroids, assigned = await asyncio.to_thread(self._train_and_assign, self._file.matrix, live_rows)
+        lists = np.full(self._file.capacity, -1, dtype=np.int32)
+        lists[live_rows] = assigned
+        # Строки, записанные во время обучения, распределяются по новым центроидам здесь
+        count = len(self._row_ids)
+        fresh = np.flatnonzero(self._live[:count] & (lists[:count] == -1))
+        if len(fresh):
+            lists[fresh] = _assign(self._file.matrix, fresh, centroids)
+        self._centroids, self._lists = centroids, lists
+        self._ivf_trained_rows = len(live_rows)
+        self._ivf_dirty = True
+        logging.info(f"Vector storage {self.namespace}: IVF index with {len(self._centroids)} lists "
+                     f"trained on {len(live_rows)} vectors in {time.perf_counter() - started:.1f}s")
+
+    def _drop_ivf(self):
+        self._centroids = None
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._ivf_trained_rows = 0
+        if os.path.exists(self._ivf_path):
+            os.remove(self._ivf_path)
+
+    def _save_ivf(self):
+        if self._centroids is None:
+            return
+        tmp_path = self._ivf_path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self._centroids, lists=self._lists[:len(self._row_ids)])
+        os.replace(tmp_path, self._ivf_path)
+
+    async def index_done_callback(self) -> bool:
+        self._file.flush()
+        self._store.commit()
+        self._free.extend(self._pending_free)
+        self._pending_free = []
+        if self._ivf_dirty:
+            await self._maybe_train_ivf()
+            self._save_ivf()
+            self._ivf_dirty = False
+        return True
+
+    async def compact(self) -> bool:
+        """Переписывает файл векторов без свободных строк."""
+        await self.index_done_callback()
+        live_rows = np.flatnonzero(self._live[:len(self._row_ids)])
+        if len(live_rows) == len(self._row_ids):
+            return False
+        keys = [self._row_ids[row] for row in live_rows]
+        # Новое поколение файла: старый файл остается действующим, пока перенумерация строк не
+        # зафиксирована вместе с именем нового файла - при сбое на любом шаге строки в базе
+        # указывают в тот файл, по которому они записаны
+        file_name = f"vdb_{self.namespace}.g{time.time_ns()}.f32"
+        packed_path = os.path.join(self._working_dir, file_name)
+        try:
+            packed = VectorFile(packed_path, self._file.dim, len(live_rows))
+            for start in range(0, len(live_rows), 8192):
+                part = live_rows[start:start + 8192]
+                packed.matrix[start:start + len(part)] = self._file.matrix[part]
+            packed.close()
+            # Списки IVF на диске пронумерованы по старым строкам; после сбоя индекс строится заново
+            if os.path.exists(self._ivf_path):
+                os.remove(self._ivf_path)
+            self._db.executemany("UPDATE vectors SET row = ? WHERE namespace = ? AND id = ?",
+                                 [(row, self.namespace, key) for row, key in enumerate(keys)])
+            self._db.execute("UPDATE vector_files SET file = ? WHERE namespace = ?", (file_name, self.namespace))
+            self._store.commit()
+        except BaseException:
+            self._db.rollback()
+            if os.path.exists(packed_path):
+                os.remove(packed_path)
+            raise
+        lists = self._lists[live_rows] if self._centroids is not None else None
+        old_path = self._vectors_path
+        self._file.close()
+        os.remove(old_path)
+        self._vectors_path = packed_path
+        self._file = VectorFile(self._vectors_path, self._file.dim, len(keys))
+        self._row_ids = list(keys)
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._live = np.zeros(self._file.capacity, dtype=bool)
+        self._live[:len(keys)] = True
+        self._free = []
+        if lists is not None:
+            self._lists = np.full(self._file.capacity, -1, dtype=np.int32)
+            self._lists[:len(keys)] = lists
+            self._save_ivf()
+        return True
+
+
+def register_local_storages():
+    """Регистрирует хранилища профиля "local" в реестре LightRAG (LightRAG выбирает хранилища по имени)."""
+    from lightrag import kg
+
+    storage_types = {
+        "SqliteKVStorage": "KV_STORAGE",
+        "SqliteDocStatusStorage": "DOC_STATUS_STORAGE",
+        "MmapVectorDBStorage": "VECTOR_STORAGE",
+    }
+    for name, storage_type in storage_types.items():
+        kg.STORAGES[name] = __name__
+        kg.STORAGE_ENV_REQUIREMENTS[name] = []
+        implementations = kg.STORAGE_IMPLEMENTATIONS[storage_type]["implementations"]
+        if name not in implementations:
+            implementations.append(name)
+
+
+register_local_storages()
+
+
+def detect_storage_profile(storage_dir: str) -> Optional[str]:
+    """Формат, в котором записан контекст: "local", "json" или None для пустого контекста."""
+    if os.path.exists(os.path.join(storage_dir, LOCAL_STORE_FILE_NAME)):
+        return "local"
+    if os.path.isdir(storage_dir) and any(re.fullmatch(r"(kv_store|vdb)_.+\.json", name)
+                                          for name in os.listdir(storage_dir)):
+        return "json"
+    return None
+
+
+# --- Перенос контекста из JSON ---
+
+def _json_namespaces(storage_dir: str, prefix: str) -> Dict[str, str]:
+    result = {}
+    for name in sorted(os.listdir(storage_dir)):
+        match = re.fullmatch(rf"{prefix}_(.+)\.json", name)
+        if match:
+            result[match.group(1)] = os.path.join(storage_dir, name)
+    return result
+
+
+def migrate_context(storage_dir: str) -> Dict[str, int]:
+    """
+    Переносит хранилища контекста из JSON-файлов в SQLite и memory-mapped
+    векторы. Новые файлы пишутся под временными именами и подставляются в
+    конце, исходные JSON переносятся в json_backup/. Возвращает число
+    перенесенных записей по пространствам имен.
+    """
+    from nano_vectordb.dbs import load_storage
+
+    if detect_storage_profile(storage_dir) != "json":
+        raise ValueError(f"{storage_dir} has no JSON storages to migrate")
+    db_path = os.path.join(storage_dir, LOCAL_STORE_FILE_NAME)
+    tmp_db_path = db_path + ".migrating"
+    kv_files = _json_namespaces(storage_dir, "kv_store")
+    vector_files = _json_namespaces(storage_dir, "vdb")
+    counts: Dict[str, int] = {}
+    # Временный файл -> итоговое имя
+    replacements: Dict[str, str] = {}
+    store = _StoreDB(tmp_db_path)
+    try:
+        for namespace, path in kv_files.items():
+            with open(path, encoding="utf-8") as json_file:
+                data = json.load(json_file) or {}
+            if namespace.endswith("doc_status"):
+                store.db.executemany(
+                    "INSERT OR REPLACE INTO doc_status (namespace, id, status, value) VALUES (?, ?, ?, ?)",
+                    [(namespace, key, _status_value(value["status"]), _dumps(value)) for key, value in data.items()])
+            elif namespace.endswith("cache"):
+                store.db.executemany(
+                    "INSERT OR REPLACE INTO llm_cache (namespace, mode, id, value) VALUES (?, ?, ?, ?)",
+                    [(namespace, mode, cache_id, _dumps(entry)) for mode, entries in data.items()
+                     if isinstance(entries, dict) for cache_id, entry in entries.items()])
+            else:
+                store.db.executemany("INSERT OR REPLACE INTO kv (namespace, id, value) VALUES (?, ?, ?)",
+                                     [(namespace, key, _dumps(value)) for key, value in data.items()])
+            counts[namespace] = len(data)
+
+        for namespace, path in vector_files.items():
+            nano = load_storage(path)
+            if nano is None:
+                continue
+            dim = int(nano["embedding_dim"])
+            rows = np.arange(len(nano["data"]))
+            vectors_path = os.path.join(storage_dir, f"vdb_{namespace}.f32.migrating")
+            replacements[vectors_path] = os.path.join(storage_dir, f"vdb_{namespace}.f32")
+            vectors = VectorFile(vectors_path, dim, len(rows))
+            if len(rows):
+                vectors.matrix[:len(rows)] = _normalize(nano["matrix"])
+            if len(rows) >= VECTOR_IVF_MIN_ROWS:
+                ivf_path = os.path.join(storage_dir, f"vdb_{namespace}.ivf.migrating.npz")
+                replacements[ivf_path] = os.path.join(storage_dir, f"vdb_{namespace}.ivf.npz")
+                centroids = _train_ivf(vectors.matrix, rows)
+                np.savez(ivf_path, centroids=centroids, lists=_assign(vectors.matrix, rows, centroids))
+            vectors.close()
+            store.db.execute("INSERT OR REPLACE INTO vector_files (namespace, dim) VALUES (?, ?)", (namespace, dim))
+            store.db.executemany(
+                "INSERT OR REPLACE INTO vectors (namespace, id, row, meta, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(namespace, item["__id__"], row,
+                  _dumps({key: value for key, value in item.items() if not key.startswith("__")}),
+                  item.get("__created_at__")) for row, item in enumerate(nano["data"])])
+            counts[f"vdb_{namespace}"] = len(nano["data"])
+        store.commit()
+        store.db.close()
+    except BaseException:
+        store.db.close()
+        for path in [tmp_db_path, *replacements]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    for tmp_path, path in replacements.items():
+        os.replace(tmp_path, path)
+    backup_dir = os.path.join(storage_dir, JSON_BACKUP_DIR_NAME)
+    os.makedirs(backup_dir, exist_ok=True)
+    for path in [*kv_files.values(), *vector_files.values()]:
+        shutil.move(path, os.path.join(backup_dir, os.path.basename(path)))
+    # Файл SQLite подставляется последним: по нему detect_storage_profile определяет формат контекста
+    os.replace(tmp_db_path, db_path)
+    logging.info(f"Migrated {storage_dir} to local storages: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for directory in sys.argv[1:]:
+        print(directory, migrate_context(directory))
@@ -0,0 +1,340 @@
+# Файл: moduls/metrics.py
+"""
+Метрики и трассировка конвейеров загрузки документов и ответов на вопросы.
+
+По строкам logging.info нельзя было понять, откуда взялся медленный ответ:
+из build_rag, эмбеддингов, поиска или LLM. Здесь:
+  * stage("имя", detail=...) - замер этапа (with или async with): время
+    попадает в гистограмму ragbot_stage_seconds{stage, detail, status}, а
+    при METRICS_TRACE_FILE - строкой JSONL (span) в файл трассировки;
+  * counter()/histogram() - счетчики и гистограммы (размеры пакетов
+    эмбеддингов, токены LLM, страницы извлечения);
+  * register_collector(имя, stats) - числовые поля stats() модулей бота
+    (пул RAG, очереди, кэши, контроль допуска) выводятся как gauge;
+  * trace_id - идентификатор корреляции: один на апдейт Telegram
+    (UpdateMetricsMiddleware) или на задание загрузки; наследуется задачами
+    LightRAG и записывается в каждый span;
+  * TelegramRequestMetrics - время каждого запроса к Bot API по методам;
+  * при METRICS_PORT > 0 метрики в формате Prometheus отдаются на
+    http://METRICS_HOST:METRICS_PORT/metrics (в режиме webhook.py у воркера
+    с номером N - порт METRICS_PORT + N).
+Реестр свой на процесс; работа с ним - из потока цикла событий.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import secrets
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 - endpoint /metrics не запускается
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_TRACE_FILE = os.getenv("METRICS_TRACE_FILE", "")
+
+PREFIX = "ragbot_"
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> LabelValues:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    pairs = [f'{key}="{value}"'.replace("\n", " ") for key, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self._values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: счетчики по корзинам, сумма, количество
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(_labels(labels))
+        return state[2] if state else 0
+
+    def samples(self) -> List[Tuple[Dict[str, str], int, float]]:
+        """Метки, количество и сумма наблюдений по каждому набору меток."""
+        return [(dict(key), count, total) for key, (_, total, count) in self._values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (buckets, total, count) in self._values.items():
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    """Метрики процесса и источники gauge-значений (stats() модулей)."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = self._metrics.get(PREFIX + name)
+        if metric is None:
+            metric = self._metrics[PREFIX + name] = Counter(PREFIX + name, help_text)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = TIME_BUCKETS) -> Histogram:
+        metric = self._metrics.get(PREFIX + name)
+        if metric is None:
+            metric = self._metrics[PREFIX + name] = Histogram(PREFIX + name, help_text, buckets)
+        return metric
+
+    def register_collector(self, component: str, stats: Callable[[], dict]):
+        self._collectors[component] = stats
+
+    def _render_collectors(self) -> List[str]:
+        lines = []
+        for component, stats in self._collectors.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logging.warning(f"Metrics: stats() of {component} failed: {e!r}")
+                continue
+            for key, value in values.items():
+                name = f"{PREFIX}{component}_{key}"
+                # Вложенный словарь (например, по видам операций) - значения с меткой key
+                samples = value.items() if isinstance(value, dict) else [(None, value)]
+                for label, sample in samples:
+                    if isinstance(sample, bool):
+                        sample = int(sample)
+                    if not isinstance(sample, (int, float)):
+                        continue
+                    labels = _format_labels([("key", str(label))]) if label is not None else ""
+                    lines.append(f"{name}{labels} {_format_value(sample)}")
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        lines.extend(self._render_collectors())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+register_collector = registry.register_collector
+
+STAGE_SECONDS = histogram("stage_seconds", "Duration of pipeline stages")
+
+
+# --- Трассировка ---
+
+class TraceWriter:
+    """Запись span-ов в файл JSONL."""
+
+    def __init__(self, path: str = METRICS_TRACE_FILE):
+        self.path = path
+        self._file = None
+
+    def write(self, record: dict):
+        if not self.path:
+            return
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+trace_writer = TraceWriter()
+
+
+def new_trace(prefix: str) -> str:
+    """Начинает трассировку в текущем контексте и возвращает ее идентификатор."""
+    value = f"{prefix}-{secrets.token_hex(4)}"
+    trace_id.set(value)
+    return value
+
+
+def record_span(name: str, started_at: float, duration: float, status: str = "ok", detail: Optional[str] = None,
+                **fields):
+    """Учитывает уже измеренный этап: гистограмма этапов и строка в файле трассировки."""
+    STAGE_SECONDS.observe(duration, stage=name, detail=detail, status=status)
+    if trace_writer.path:
+        record = {"ts": round(started_at, 6), "trace_id": trace_id.get(), "span": name,
+                  "duration_ms": round(duration * 1000, 3), "status": status, "pid": os.getpid()}
+        if detail is not None:
+            record["detail"] = detail
+        record.update(fields)
+        trace_writer.write(record)
+
+
+class Stage:
+    """Замер этапа; set() добавляет поля в span (например, число страниц)."""
+
+    def __init__(self, name: str, detail: Optional[str] = None, **fields):
+        self.name = name
+        self.detail = detail
+        self.fields = fields
+        self._started = 0.0
+        self._started_at = 0.0
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self) -> "Stage":
+        self._started_at = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, asyncio.CancelledError):
+            status = "cancelled"
+        else:
+            status = "error"
+        record_span(self.name, self._started_at, time.perf_counter() - self._started, status, self.detail,
+                    **self.fields)
+        return False
+
+    async def __aenter__(self) -> "Stage":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback) -> bool:
+        return self.__exit__(exc_type, exc, traceback)
+
+
+def stage(name: str, detail: Optional[str] = None, **fields) -> Stage:
+    return Stage(name, detail, **fields)
+
+
+# --- aiogram ---
+
+UPDATES = counter("updates_total", "Telegram updates by type and outcome")
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Идентификатор корреляции и время обработки каждого апдейта."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        new_trace(f"u{getattr(event, 'update_id', 0)}")
+        status = "error"
+        try:
+            with stage("update", detail=update_type):
+                result = await handler(event, data)
+            status = "ok"
+            return result
+        finally:
+            UPDATES.inc(type=update_type, status=status)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Время запросов к Bot API (отправка и правка сообщений и т.д.)."""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        with stage("telegram_request", detail=type(method).__name__):
+            return await make_request(bot, method)
+
+
+# --- Endpoint ---
+
+class MetricsServer:
+    """HTTP endpoint /metrics в формате Prometheus."""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def start(self, port_offset: int = 0):
+        if self.port <= 0 or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port + port_offset).start()
+        logging.info(f"Metrics endpoint: http://{self.host}:{self.port + port_offset}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        trace_writer.close()
+
+
+# Общий для процесса endpoint метрик
+metrics_server = MetricsServer()
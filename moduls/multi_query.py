@@ -0,0 +1,220 @@
+# Файл: moduls/multi_query.py
+"""
+Вопрос сразу к нескольким контекстам пользователя (fan-out).
+
+Раньше вопрос можно было задать только текущему контексту, и чтобы
+спросить о нескольких, пользователь повторял вопрос в каждом: N полных
+rag.aquery - N извлечений ключевых слов и N генераций ответа. Теперь
+multi_context_query:
+  * извлекает ключевые слова вопроса один раз (LLM, кэш LightRAG первого
+    контекста);
+  * параллельно выполняет поиск в прогретых экземплярах LightRAG всех
+    контекстов - те же хранилища, что у режима запроса: чанки векторного
+    хранилища (naive, mix), сущности по low-level ключевым словам (local,
+    hybrid, mix), связи по high-level ключевым словам (global, hybrid, mix)
+    и исходные чанки найденных сущностей и связей;
+  * объединяет найденное: одинаковые чанки и сущности из разных контекстов
+    учитываются один раз, порядок - по косинусной близости (модель
+    эмбеддингов общая, оценки контекстов сравнимы), и обрезает его под общий
+    бюджет MULTI_QUERY_MAX_TOKENS токенов (сущностям и связям - по
+    MULTI_QUERY_KG_SHARE бюджета, остальное - чанкам);
+  * делает один вызов LLM с промптом LightRAG для режима, в котором у
+    каждой записи указан ее контекст.
+Не больше MULTI_QUERY_MAX_CONTEXTS контекстов в одном вопросе, из каждого
+хранилища - до MULTI_QUERY_TOP_K записей.
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from lightrag import LightRAG
+from lightrag.operate import extract_keywords_only
+from lightrag.prompt import GRAPH_FIELD_SEP, PROMPTS
+from lightrag.base import QueryParam
+from lightrag.utils import encode_string_by_tiktoken, list_of_list_to_csv, truncate_list_by_token_size
+
+from moduls.metrics import stage
+
+MULTI_QUERY_MAX_CONTEXTS = int(os.getenv("MULTI_QUERY_MAX_CONTEXTS", "5"))
+MULTI_QUERY_TOP_K = int(os.getenv("MULTI_QUERY_TOP_K", "20"))
+MULTI_QUERY_MAX_TOKENS = int(os.getenv("MULTI_QUERY_MAX_TOKENS", "12000"))
+# Доля бюджета на сущности и на связи в режимах с графом знаний
+MULTI_QUERY_KG_SHARE = float(os.getenv("MULTI_QUERY_KG_SHARE", "0.25"))
+
+CHUNK = "chunk"
+ENTITY = "entity"
+RELATIONSHIP = "relationship"
+
+_ENTITY_MODES = ("local", "hybrid", "mix")
+_RELATIONSHIP_MODES = ("global", "hybrid", "mix")
+_VECTOR_MODES = ("naive", "mix")
+
+
+@dataclass
+class Retrieved:
+    """Найденная запись: чанк, сущность или связь."""
+    kind: str
+    key: str
+    score: float
+    text: str
+    fields: List[str]
+    contexts: List[str] = field(default_factory=list)
+
+
+def merge(found: List[Retrieved]) -> Dict[str, List[Retrieved]]:
+    """Объединяет записи контекстов: одинаковые - одна запись с лучшей оценкой и списком контекстов."""
+    merged: Dict[Tuple[str, str], Retrieved] = {}
+    for item in found:
+        known = merged.get((item.kind, item.key))
+        if known is None:
+            merged[(item.kind, item.key)] = Retrieved(item.kind, item.key, item.score, item.text, item.fields,
+                                                      list(item.contexts))
+            continue
+        known.contexts.extend(name for name in item.contexts if name not in known.contexts)
+        if item.score > known.score:
+            known.score, known.text, known.fields = item.score, item.text, item.fields
+    result: Dict[str, List[Retrieved]] = {CHUNK: [], ENTITY: [], RELATIONSHIP: []}
+    for item in merged.values():
+        result[item.kind].append(item)
+    for items in result.values():
+        items.sort(key=lambda item: item.score, reverse=True)
+    return result
+
+
+def _tokens(items: List[Retrieved]) -> int:
+    return sum(len(encode_string_by_tiktoken(item.text)) for item in items)
+
+
+def fit_budget(merged: Dict[str, List[Retrieved]], max_tokens: int, mode: str) -> Dict[str, List[Retrieved]]:
+    """Лучшие записи в пределах общего бюджета токенов; неизрасходованное сущностями и связями достается чанкам."""
+    selected = {kind: [] for kind in merged}
+    if mode != "naive":
+        for kind in (ENTITY, RELATIONSHIP):
+            selected[kind] = truncate_list_by_token_size(merged[kind], key=lambda item: item.text,
+                                                         max_token_size=int(max_tokens * MULTI_QUERY_KG_SHARE))
+    left = max_tokens - _tokens(selected[ENTITY]) - _tokens(selected[RELATIONSHIP])
+    selected[CHUNK] = truncate_list_by_token_size(merged[CHUNK], key=lambda item: item.text, max_token_size=left)
+    return selected
+
+
+async def _chunks(rag: LightRAG, name: str, scored_ids: Dict[str, float]) -> List[Retrieved]:
+    ids = list(scored_ids)
+    chunks = await rag.text_chunks.get_by_ids(ids) if ids else []
+    return [Retrieved(CHUNK, chunk_id, scored_ids[chunk_id], chunk["content"],
+                      [chunk.get("file_path") or "unknown_source", chunk["content"]], [name])
+            for chunk_id, chunk in zip(ids, chunks) if chunk and "content" in chunk]
+
+
+def _source_ids(data: dict, score: float, sources: Dict[str, float]):
+    """Исходные чанки сущности или связи получают ее оценку (лучшую из нескольких)."""
+    for chunk_id in (data.get("source_id") or "").split(GRAPH_FIELD_SEP):
+        if chunk_id:
+            sources[chunk_id] = max(score, sources.get(chunk_id, score))
+
+
+async def retrieve(rag: LightRAG, name: str, question: str, mode: str, hl_keywords: List[str],
+                   ll_keywords: List[str], top_k: int = MULTI_QUERY_TOP_K) -> List[Retrieved]:
+    """Поиск в одном контексте: записи тех хранилищ, которые использует режим mode."""
+    found: List[Retrieved] = []
+    sources: Dict[str, float] = {}
+    graph = rag.chunk_entity_relation_graph
+    if mode in _ENTITY_MODES and ll_keywords:
+        results = await rag.entities_vdb.query(", ".join(ll_keywords), top_k=top_k)
+        nodes = await asyncio.gather(*(graph.get_node(result["entity_name"]) for result in results))
+        for result, node in zip(results, nodes):
+            if node is None:
+                continue
+            description = node.get("description") or ""
+            found.append(Retrieved(ENTITY, result["entity_name"], result["distance"], description,
+                                   [result["entity_name"], node.get("entity_type") or "UNKNOWN", description],
+                                   [name]))
+            _source_ids(node, result["distance"], sources)
+    if mode in _RELATIONSHIP_MODES and hl_keywords:
+        results = await rag.relationships_vdb.query(", ".join(hl_keywords), top_k=top_k)
+        edges = await asyncio.gather(*(graph.get_edge(result["src_id"], result["tgt_id"]) for result in results))
+        for result, edge in zip(results, edges):
+            if edge is None:
+                continue
+            description = edge.get("description") or ""
+            found.append(Retrieved(RELATIONSHIP, f"{result['src_id']}{GRAPH_FIELD_SEP}{result['tgt_id']}",
+                                   result["distance"], description,
+                                   [result["src_id"], result["tgt_id"], description, edge.get("keywords") or ""],
+                                   [name]))
+            _source_ids(edge, result["distance"], sources)
+    if mode in _VECTOR_MODES:
+        for result in await rag.chunks_vdb.query(question, top_k=top_k):
+            sources[result["id"]] = max(result["distance"], sources.get(result["id"], result["distance"]))
+    # Чанки сущностей и связей - только лучшие top_k, как у поиска по векторному хранилищу
+    best = dict(sorted(sources.items(), key=lambda item: item[1], reverse=True)[:top_k])
+    found.extend(await _chunks(rag, name, best))
+    return found
+
+
+def _csv(header: List[str], items: List[Retrieved]) -> str:
+    rows = [["id", "context", *header]]
+    rows.extend([index, ", ".join(item.contexts), *item.fields] for index, item in enumerate(items))
+    return list_of_list_to_csv(rows)
+
+
+def build_prompt(selected: Dict[str, List[Retrieved]], mode: str, response_type: str) -> Optional[str]:
+    """Системный промпт LightRAG для режима с объединенными записями; None - ничего не найдено."""
+    if not any(selected.values()):
+        return None
+    chunks = "\n--New Chunk--\n".join(f"Context: {', '.join(item.contexts)}\nFile path: {item.fields[0]}\n"
+                                       f"{item.fields[1]}" for item in selected[CHUNK])
+    if mode == "naive":
+        return PROMPTS["naive_rag_response"].format(content_data=chunks, response_type=response_type, history="")
+    kg_context = (f"-----Entities-----\n```csv\n{_csv(['entity', 'type', 'description'], selected[ENTITY])}\n```\n"
+                  f"-----Relationships-----\n```csv\n"
+                  f"{_csv(['source', 'target', 'description', 'keywords'], selected[RELATIONSHIP])}\n```")
+    if mode == "mix":
+        return PROMPTS["mix_rag_response"].format(kg_context=kg_context, vector_context=chunks,
+                                                  response_type=response_type, history="")
+    sources = _csv(["file_path", "content"], selected[CHUNK])
+    return PROMPTS["rag_response"].format(context_data=f"{kg_context}\n-----Sources-----\n```csv\n{sources}\n```",
+                                          response_type=response_type, history="")
+
+
+async def multi_context_query(rags: Dict[str, LightRAG], question: str, mode: str, stream: bool = False,
+                              max_tokens: int = MULTI_QUERY_MAX_TOKENS, top_k: int = MULTI_QUERY_TOP_K
+                              ) -> Tuple[Union[str, AsyncIterator[str]], dict]:
+    """
+    Ответ на вопрос по контекстам rags (имя контекста -> экземпляр LightRAG)
+    одним вызовом LLM: строка или, при stream=True, поток фрагментов. Второй
+    элемент - сводка поиска (найдено и использовано записей по контекстам).
+    """
+    first = next(iter(rags.values()))
+    param = QueryParam(mode=mode, stream=stream, top_k=top_k)
+    hl_keywords, ll_keywords = [], []
+    if mode != "naive":
+        # Ключевые слова вопроса не зависят от контекста: один вызов LLM на все контексты
+        hl_keywords, ll_keywords = await extract_keywords_only(
+            question, param, {"addon_params": first.addon_params, "llm_model_func": first.llm_model_func},
+            hashing_kv=first.llm_response_cache)
+
+    async with stage("multi_retrieve", detail=mode) as span:
+        results = await asyncio.gather(*(retrieve(rag, name, question, mode, hl_keywords, ll_keywords, top_k)
+                                         for name, rag in rags.items()), return_exceptions=True)
+        found: List[Retrieved] = []
+        summary = {"contexts": {}, "failed": []}
+        for name, result in zip(rags, results):
+            if isinstance(result, BaseException):
+                logging.warning(f"Multi-context query: retrieval in context '{name}' failed: {result!r}")
+                summary["failed"].append(name)
+                continue
+            found.extend(result)
+            summary["contexts"][name] = len(result)
+        selected = fit_budget(merge(found), max_tokens, mode)
+        span.set(contexts=len(rags), found=len(found), **{kind: len(items) for kind, items in selected.items()})
+    summary["used"] = {kind: len(items) for kind, items in selected.items()}
+    summary["used_contexts"] = sorted({name for items in selected.values() for item in items
+                                       for name in item.contexts})
+
+    system_prompt = build_prompt(selected, mode, param.response_type)
+    if system_prompt is None:
+        return PROMPTS["fail_response"], summary
+    logging.info(f"Multi-context query over {len(rags)} contexts ({mode}): {summary['used']}, "
+                 f"{len(encode_string_by_tiktoken(system_prompt))} prompt tokens")
+    return await first.llm_model_func(question, system_prompt=system_prompt, stream=stream), summary
@@ -0,0 +1,328 @@
+# Файл: moduls/rag_pool.py
+"""
+Пул прогретых экземпляров LightRAG, общий для всего процесса.
+
+Раньше каждый вопрос и каждая загрузка вызывали build_rag(), то есть заново
+выполняли initialize_storages() и перечитывали с диска JSON/граф/векторные
+хранилища контекста. Пул держит уже инициализированные объекты LightRAG,
+ключом служит путь к директории storage контекста.
+
+Вытеснение:
+  * LRU - при превышении RAG_POOL_MAX_SIZE экземпляров;
+  * idle-TTL - экземпляр, не используемый дольше RAG_POOL_IDLE_TTL секунд;
+  * бюджет памяти - оценка по размеру файлов хранилища (RAG_POOL_MEMORY_BUDGET_MB).
+При вытеснении вызывается finalize_storages(), чтобы данные были сброшены на диск.
+
+Для каждого контекста заводится блокировка "читатели-писатель": запросы
+(aquery) выполняются параллельно, вставка (ainsert) и удаление документов
+получают эксклюзивный доступ.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+from moduls.lightrag_module import build_rag
+from moduls.metrics import stage
+
+RAG_POOL_MAX_SIZE = int(os.getenv("RAG_POOL_MAX_SIZE", "16"))
+RAG_POOL_IDLE_TTL = float(os.getenv("RAG_POOL_IDLE_TTL", "900"))
+RAG_POOL_MEMORY_BUDGET_MB = int(os.getenv("RAG_POOL_MEMORY_BUDGET_MB", "2048"))
+
+# Во сколько раз объект в памяти больше своего JSON-представления на диске (грубая оценка)
+_MEMORY_OVERHEAD_FACTOR = 2
+# Файлы, которые хранилища читают в память целиком. SQLite и memory-mapped векторы
+# локального профиля (moduls/local_storage.py) читаются страницами по мере надобности.
+_LOADED_FILE_SUFFIXES = (".json", ".graphml")
+
+
+def _estimate_storage_size(storage_dir: str) -> int:
+    """Оценивает объем памяти, занимаемый загруженным контекстом, по размеру файлов хранилища."""
+    total = 0
+    for file_name in os.listdir(storage_dir) if os.path.isdir(storage_dir) else []:
+        if not file_name.endswith(_LOADED_FILE_SUFFIXES):
+            continue
+        try:
+            total += os.path.getsize(os.path.join(storage_dir, file_name))
+        except OSError:
+            continue
+    return total * _MEMORY_OVERHEAD_FACTOR
+
+
+class ContextLock:
+    """Асинхронная блокировка "читатели-писатель" для одного контекста."""
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    async def acquire_read(self):
+        async with self._cond:
+            # Писатели имеют приоритет, чтобы поток вопросов не блокировал загрузку навсегда
+            await self._cond.wait_for(lambda: not self._writer and self._waiting_writers == 0)
+            self._readers += 1
+
+    async def release_read(self):
+        async with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    async def acquire_write(self):
+        async with self._cond:
+            self._waiting_writers += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    async def release_write(self):
+        async with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @property
+    def idle(self) -> bool:
+        return not self._writer and self._readers == 0 and self._waiting_writers == 0
+
+
+class _PoolEntry:
+    __slots__ = ("rag", "storage_dir", "size_bytes", "borrowers", "last_used")
+
+    def __init__(self, rag, storage_dir: str, size_bytes: int):
+        self.rag = rag
+        self.storage_dir = storage_dir
+        self.size_bytes = size_bytes
+        self.borrowers = 0
+        self.last_used = time.monotonic()
+
+
+class RagLease:
+    """Аренда экземпляра LightRAG из пула. Обязательно вызвать release()."""
+
+    def __init__(self, pool: "RagPool", entry: _PoolEntry, lock: ContextLock, write: bool):
+        self._pool = pool
+        self._entry = entry
+        self._lock = lock
+        self._write = write
+        self._released = False
+
+    @property
+    def rag(self):
+        return self._entry.rag
+
+    async def release(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            self._pool._release(self._entry, self._write)
+        finally:
+            if self._write:
+                await self._lock.release_write()
+            else:
+                await self._lock.release_read()
+
+
+class RagPool:
+    """
+    LRU-пул инициализированных объектов LightRAG с вытеснением по времени простоя
+    и по бюджету памяти.
+    """
+
+    def __init__(self,
+                 max_size: int = RAG_POOL_MAX_SIZE,
+                 idle_ttl: float = RAG_POOL_IDLE_TTL,
+                 memory_budget_bytes: int = RAG_POOL_MEMORY_BUDGET_MB * 1024 * 1024,
+                 factory: Callable[[str], Awaitable] = build_rag):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.memory_budget_bytes = memory_budget_bytes
+        self._factory = factory
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict()
+        self._context_locks: Dict[str, ContextLock] = {}
+        self._build_locks: Dict[str, asyncio.Lock] = {}
+        self._reaper_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # --- Служебные методы ---
+
+    @staticmethod
+    def _key(storage_dir: str) -> str:
+        return os.path.abspath(storage_dir)
+
+    def _context_lock(self, key: str) -> ContextLock:
+        lock = self._context_locks.get(key)
+        if lock is None:
+            lock = self._context_locks[key] = ContextLock()
+        return lock
+
+    def _build_lock(self, key: str) -> asyncio.Lock:
+        lock = self._build_locks.get(key)
+        if lock is None:
+            lock = self._build_locks[key] = asyncio.Lock()
+        return lock
+
+    def _ensure_reaper(self):
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def _reaper(self):
+        """Фоновая задача: периодически вытесняет простаивающие экземпляры."""
+        interval = max(1.0, self.idle_ttl / 2)
+        while not self._closed:
+            await asyncio.sleep(interval)
+            try:
+                await self._evict_idle()
+            except Exception as e:
+                logging.exception(f"RAG pool reaper failed: {e}")
+
+    @property
+    def total_size(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    # --- Аренда ---
+
+    async def acquire(self, storage_dir: str, write: bool = False) -> RagLease:
+        """
+        Возвращает аренду прогретого экземпляра LightRAG для storage_dir.
+        write=True - эксклюзивный доступ (вставка/удаление документов).
+        """
+        if self._closed:
+            raise RuntimeError("RAG pool is closed")
+        self._ensure_reaper()
+
+        key = self._key(storage_dir)
+        lock = self._context_lock(key)
+        if write:
+            await lock.acquire_write()
+        else:
+            await lock.acquire_read()
+
+        try:
+            async with self._build_lock(key):
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    started = time.perf_counter()
+                    async with stage("rag_init"):
+                        rag = await self._factory(key)
+                    entry = _PoolEntry(rag, key, _estimate_storage_size(key))
+                    self._entries[key] = entry
+                    logging.info(f"RAG pool: initialized {key} in {time.perf_counter() - started:.2f}s "
+                                 f"({len(self._entries)}/{self.max_size} instances)")
+                else:
+                    self.hits += 1
+                entry.borrowers += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(key)
+        except BaseException:
+            if write:
+                await lock.release_write()
+            else:
+                await lock.release_read()
+            raise
+
+        await self._evict_over_budget()
+        return RagLease(self, entry, lock, write)
+
+    @asynccontextmanager
+    async def borrow(self, storage_dir: str, write: bool = False):
+        """Контекстный менеджер поверх acquire()/release()."""
+        lease = await self.acquire(storage_dir, write=write)
+        try:
+            yield lease.rag
+        finally:
+            await lease.release()
+
+    def _release(self, entry: _PoolEntry, write: bool):
+        entry.borrowers -= 1
+        entry.last_used = time.monotonic()
+        if write:
+            # После вставки хранилище выросло - обновляем оценку
+            entry.size_bytes = _estimate_storage_size(entry.storage_dir)
+
+    # --- Вытеснение ---
+
+    async def _evict_entry(self, key: str, force: bool = False) -> bool:
+        # Финализация выполняется под блокировкой построения, чтобы новый экземпляр
+        # для того же контекста не начал читать файлы до того, как старый их сбросит
+        async with self._build_lock(key):
+            entry = self._entries.get(key)
+            if entry is None or (entry.borrowers and not force):
+                return False
+            del self._entries[key]
+            self.evictions += 1
+            try:
+                await entry.rag.finalize_storages()
+                logging.info(f"RAG pool: evicted {key}")
+            except Exception as e:
+                logging.exception(f"RAG pool: error while finalizing storages for {key}: {e}")
+        if self._context_lock(key).idle and key not in self._entries:
+            self._context_locks.pop(key, None)
+            self._build_locks.pop(key, None)
+        return True
+
+    async def _evict_over_budget(self):
+        while len(self._entries) > self.max_size or self.total_size > self.memory_budget_bytes:
+            # Кандидаты в порядке LRU, занятые экземпляры не трогаем
+            candidate = next((key for key, entry in self._entries.items() if entry.borrowers == 0), None)
+            if candidate is None:
+                break
+            await self._evict_entry(candidate)
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items()
+                   if entry.borrowers == 0 and now - entry.last_used > self.idle_ttl]
+        for key in expired:
+            await self._evict_entry(key)
+
+    async def discard(self, storage_dir: str):
+        """
+        Удаляет экземпляр контекста из пула (например, перед удалением контекста).
+        Дожидается завершения всех операций с контекстом.
+        """
+        key = self._key(storage_dir)
+        lock = self._context_lock(key)
+        await lock.acquire_write()
+        try:
+            await self._evict_entry(key)
+        finally:
+            await lock.release_write()
+
+    async def close(self):
+        """Финализирует все экземпляры. Вызывается при остановке бота."""
+        self._closed = True
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            try:
+                await self._reaper_task
+            except asyncio.CancelledError:
+                pass
+        for key in list(self._entries):
+            await self._evict_entry(key, force=True)
+
+    def stats(self) -> dict:
+        return {
+            "instances": len(self._entries),
+            "max_size": self.max_size,
+            "estimated_bytes": self.total_size,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Общий для процесса пул
+rag_pool = RagPool()
@@ -0,0 +1,101 @@
+# Файл: moduls/single_flight.py
+"""
+Объединение одинаковых одновременных запросов (single-flight).
+
+Когда несколько пользователей работают с одним контекстом, одинаковые
+вопросы часто приходят с разницей в секунды, и каждый запускал свой поиск
+и вызов LLM. Первый запрос с данным ключом становится "ведущим" и
+выполняется, остальные присоединяются к нему и получают тот же результат.
+Так как ответы выводятся потоково, присоединившиеся получают фрагменты по
+мере их появления у ведущего (Flight.follow), а не только итоговый текст.
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Tuple, Union
+
+
+class Flight:
+    """Выполняемый запрос: накопленные фрагменты результата и признак завершения."""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.chunks: List[str] = []
+        self.followers = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, chunk: str):
+        async with self._changed:
+            self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    async def tee(self, source: Union[str, AsyncIterator[str], None]) -> AsyncIterator[str]:
+        """Отдает фрагменты источника (строки или асинхронного потока) и публикует их присоединившимся."""
+        if source is None or isinstance(source, str):
+            if source:
+                await self.publish(source)
+                yield source
+            return
+        async for chunk in source:
+            await self.publish(chunk)
+            yield chunk
+
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    async def follow(self) -> AsyncIterator[str]:
+        """Фрагменты результата ведущего: уже полученные и новые, до завершения."""
+        position = 0
+        while True:
+            async with self._changed:
+                while position >= len(self.chunks) and not self.done:
+                    await self._changed.wait()
+                pending = self.chunks[position:]
+                done, error = self.done, self.error
+            for chunk in pending:
+                yield chunk
+            position += len(pending)
+            if done and position >= len(self.chunks):
+                if error is not None:
+                    raise RuntimeError(f"Shared request failed: {error!r}") from error
+                return
+
+
+class SingleFlight:
+    """Реестр выполняемых запросов по ключу."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, Flight] = {}
+        self.leaders = 0
+        self.saved_calls = 0
+
+    def join(self, key: Hashable) -> Tuple[Flight, bool]:
+        """Возвращает запрос с этим ключом и True, если вызывающий стал ведущим и должен его выполнить."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            self.saved_calls += 1
+            logging.info(f"{self.name}: joined in-flight request ({flight.followers} waiting)")
+            return flight, False
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight, True
+
+    async def finish(self, flight: Flight, error: Optional[BaseException] = None):
+        """Завершает запрос ведущего; следующие запросы с этим ключом начнут новый."""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        await flight.finish(error)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "saved_calls": self.saved_calls,
+        }
@@ -0,0 +1,195 @@
+# Файл: moduls/status_message.py
+"""
+Постепенно обновляемые сообщения Telegram.
+
+StatusMessage - прогресс длительной операции в одном сообщении. Вместо
+отдельного message.answer на каждый шаг (по пять сообщений на файл при
+загрузке документов) строки прогресса собираются в одно сообщение, которое
+редактируется не чаще раза в STATUS_EDIT_INTERVAL секунд: обновления между
+правками склеиваются, последняя правка всегда отправляется в finish().
+
+MessageStreamer - потоковый вывод текста (ответа LLM) правками сообщения
+не чаще раза в STREAM_EDIT_INTERVAL секунд; текст длиннее лимита Telegram
+продолжается в следующем сообщении.
+
+Ошибки Telegram (сообщение удалено, флуд-контроль) не прерывают саму
+операцию.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "1.5"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Ограничение Telegram на длину текста сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class StatusMessage:
+    """Сообщение со строками прогресса по ключам (например, по именам файлов)."""
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int] = None, header: str = "",
+                 min_interval: float = STATUS_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.min_interval = min_interval
+        self._lines: Dict[str, str] = {}
+        self._footer = ""
+        self._sent_text: Optional[str] = None
+        self._last_edit = 0.0
+        self._pending: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.edits = 0
+
+    def render(self) -> str:
+        parts = [self.header] if self.header else []
+        parts.extend(self._lines.values())
+        if self._footer:
+            parts.append(self._footer)
+        text = "\n".join(parts)
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            # Оставляем конец: самые свежие строки важнее
+            text = "…" + text[-(TELEGRAM_MESSAGE_LIMIT - 1):]
+        return text
+
+    def update(self, key: str, line: str):
+        """Обновляет строку прогресса; правка сообщения будет отправлена с задержкой."""
+        self._lines[key] = line
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        delay = self._last_edit + self.min_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        """Немедленно отправляет текущее состояние, если оно изменилось."""
+        async with self._lock:
+            text = self.render()
+            if not text or text == self._sent_text:
+                return
+            try:
+                if self.message_id is None:
+                    message = await self.bot.send_message(self.chat_id, text)
+                    self.message_id = message.message_id
+                else:
+                    await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+                self._sent_text = text
+                self.edits += 1
+            except TelegramRetryAfter as e:
+                # Флуд-контроль: следующая попытка после паузы
+                logging.warning(f"Status message edit throttled by Telegram for {e.retry_after}s")
+                self._last_edit = time.monotonic() + e.retry_after
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._sent_text = text
+                else:
+                    # Сообщение удалено или недоступно - дальше пишем в новое
+                    logging.warning(f"Failed to edit status message {self.message_id}: {e}")
+                    self.message_id = None
+            except Exception as e:
+                logging.warning(f"Failed to update status message in chat {self.chat_id}: {e!r}")
+            else:
+                self._last_edit = time.monotonic()
+
+    async def finish(self, footer: str = ""):
+        """Дописывает итоговую строку и отправляет последнюю правку без задержки."""
+        if self._pending is not None and not self._pending.done():
+            self._pending.cancel()
+        self._footer = footer
+        await self.flush()
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Позиция разрыва текста длиннее limit: по абзацу, строке или пробелу во второй половине."""
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+class MessageStreamer:
+    """Выводит поступающий по частям текст в сообщение, редактируя его с ограничением частоты."""
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int] = None, prefix: str = "",
+                 min_interval: float = STREAM_EDIT_INTERVAL, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.limit = limit
+        self._text = prefix
+        self._sent_text: Optional[str] = None
+        self._next_edit = 0.0
+        self.messages = 0
+        self.edits = 0
+        self.first_edit_at: Optional[float] = None
+
+    async def _show(self, text: str):
+        if not text.strip() or text == self._sent_text:
+            return
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_message(self.chat_id, text)
+                self.message_id = message.message_id
+                self.messages += 1
+            else:
+                await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+            self._sent_text = text
+            self.edits += 1
+            if self.first_edit_at is None:
+                self.first_edit_at = time.monotonic()
+            self._next_edit = time.monotonic() + self.min_interval
+        except TelegramRetryAfter as e:
+            logging.warning(f"Streaming edit throttled by Telegram for {e.retry_after}s")
+            self._next_edit = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._sent_text = text
+            else:
+                logging.warning(f"Failed to edit streamed message {self.message_id}: {e}")
+                self.message_id = None
+        except Exception as e:
+            # Сетевая ошибка или ошибка сервера Telegram: текст остается неотправленным, следующая
+            # правка (или повтор в _show_final) отправит его - вывод ответа не прерывается
+            logging.warning(f"Failed to update streamed message in chat {self.chat_id}: {e!r}")
+            self._next_edit = time.monotonic() + self.min_interval
+
+    async def _show_final(self, text: str):
+        """Показ, который нельзя пропустить (завершенное сообщение): ждет флуд-контроль."""
+        for _ in range(3):
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._show(text)
+            if self._sent_text == text or not text.strip():
+                return
+
+    async def append(self, chunk: str):
+        if not chunk:
+            return
+        self._text += chunk
+        while len(self._text) > self.limit:
+            # Текущее сообщение заполнено: дописываем его и продолжаем в новом
+            cut = _split_point(self._text, self.limit)
+            await self._show_final(self._text[:cut])
+            self._text = self._text[cut:]
+            self.message_id = None
+            self._sent_text = None
+        if time.monotonic() >= self._next_edit:
+            await self._show(self._text)
+
+    async def finish(self) -> str:
+        """Отправляет окончательный текст последнего сообщения."""
+        await self._show_final(self._text)
+        return self._text
@@ -0,0 +1,148 @@
+# Файл: moduls/storage_compaction.py
+"""
+Уборка хранилища LightRAG контекста.
+
+adelete_by_doc_id удаляет чанки, векторы и сущности графа документа, но
+кое-что остается навсегда:
+  * документы, упавшие на середине обработки (часть чанков и векторов уже
+    записана, а удаление без чанков в text_chunks LightRAG пропускает);
+  * полные тексты (full_docs) без записи в doc_status;
+  * векторы сущностей и связей, которых больше нет в графе, и ссылки
+    вершин и ребер графа на удаленные чанки.
+Проход находит такие "висячие" записи, удаляет их и переписывает файлы
+хранилищ (JSON, nano-vectordb, graphml) только с живыми данными. У
+локальных хранилищ (moduls/local_storage.py) файл векторов переписывается
+без освободившихся строк, а SQLite сжимается VACUUM.
+
+Запуск вручную для контекста (бот должен быть остановлен):
+    python -m moduls.storage_compaction data/contexts/<user_id>/<context>/storage
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Dict, Set
+
+from lightrag.base import DocStatus
+from lightrag.prompt import GRAPH_FIELD_SEP
+
+
+def storage_size(storage_dir: str) -> int:
+    """Суммарный размер файлов хранилища в байтах."""
+    total = 0
+    for name in os.listdir(storage_dir):
+        path = os.path.join(storage_dir, name)
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def _live_sources(source_id: str, live_chunks: Set[str]) -> str:
+    # Источники, не похожие на чанки (например, из ainsert_custom_kg), не трогаем
+    return GRAPH_FIELD_SEP.join(source for source in source_id.split(GRAPH_FIELD_SEP)
+                                if not source.startswith("chunk-") or source in live_chunks)
+
+
+async def compact_storage(rag) -> Dict[str, int]:
+    """Удаляет висячие записи из всех хранилищ LightRAG и сохраняет их. Возвращает число удаленных записей."""
+    removed = {"full_docs": 0, "text_chunks": 0, "chunks_vdb": 0, "graph_nodes": 0, "graph_edges": 0,
+               "entities_vdb": 0, "relationships_vdb": 0}
+    before = storage_size(rag.working_dir)
+
+    # --- Документы: живые те, что есть в doc_status ---
+    doc_ids: Set[str] = set()
+    for status in DocStatus:
+        doc_ids.update((await rag.doc_status.get_docs_by_status(status)).keys())
+    orphan_docs = [doc_id for doc_id in (await rag.full_docs.get_all()) if doc_id not in doc_ids]
+    if orphan_docs:
+        await rag.full_docs.delete(orphan_docs)
+        removed["full_docs"] = len(orphan_docs)
+
+    # --- Чанки и их векторы ---
+    all_chunks = await rag.text_chunks.get_all()
+    orphan_chunks = [chunk_id for chunk_id, chunk in all_chunks.items()
+                     if not isinstance(chunk, dict) or chunk.get("full_doc_id") not in doc_ids]
+    if orphan_chunks:
+        await rag.text_chunks.delete(orphan_chunks)
+        removed["text_chunks"] = len(orphan_chunks)
+    live_chunks = set(all_chunks) - set(orphan_chunks)
+    chunk_vectors = (await rag.chunks_vdb.client_storage)["data"]
+    orphan_vectors = [dp["__id__"] for dp in chunk_vectors if dp["__id__"] not in live_chunks]
+    if orphan_vectors:
+        await rag.chunks_vdb.delete(orphan_vectors)
+        removed["chunks_vdb"] = len(orphan_vectors)
+
+    # --- Граф: ссылки на удаленные чанки, вершины и ребра без источников ---
+    graph = rag.chunk_entity_relation_graph
+    nodes_to_remove = []
+    edges = set()
+    for label in await graph.get_all_labels():
+        node = await graph.get_node(label)
+        if node and "source_id" in node:
+            sources = _live_sources(node["source_id"], live_chunks)
+            if not sources:
+                nodes_to_remove.append(label)
+                continue
+            if sources != node["source_id"]:
+                await graph.upsert_node(label, {**node, "source_id": sources})
+        for src, tgt in await graph.get_node_edges(label) or []:
+            edges.add(tuple(sorted((src, tgt))))
+    edges_to_remove = []
+    for src, tgt in edges:
+        if src in nodes_to_remove or tgt in nodes_to_remove:
+            continue  # уйдут вместе с вершиной
+        edge = await graph.get_edge(src, tgt)
+        if edge and "source_id" in edge:
+            sources = _live_sources(edge["source_id"], live_chunks)
+            if not sources:
+                edges_to_remove.append((src, tgt))
+            elif sources != edge["source_id"]:
+                await graph.upsert_edge(src, tgt, {**edge, "source_id": sources})
+    if edges_to_remove:
+        await graph.remove_edges(edges_to_remove)
+        removed["graph_edges"] = len(edges_to_remove)
+    if nodes_to_remove:
+        await graph.remove_nodes(nodes_to_remove)
+        removed["graph_nodes"] = len(nodes_to_remove)
+
+    # --- Векторы сущностей и связей, которых больше нет в графе ---
+    live_nodes = set(await graph.get_all_labels())
+    entity_vectors = (await rag.entities_vdb.client_storage)["data"]
+    orphan_entities = [dp["__id__"] for dp in entity_vectors if dp.get("entity_name") not in live_nodes]
+    if orphan_entities:
+        await rag.entities_vdb.delete(orphan_entities)
+        removed["entities_vdb"] = len(orphan_entities)
+    relation_vectors = (await rag.relationships_vdb.client_storage)["data"]
+    orphan_relations = [dp["__id__"] for dp in relation_vectors
+                        if not await graph.has_edge(dp.get("src_id"), dp.get("tgt_id"))]
+    if orphan_relations:
+        await rag.relationships_vdb.delete(orphan_relations)
+        removed["relationships_vdb"] = len(orphan_relations)
+
+    # --- Перезапись файлов хранилищ ---
+    for storage in (rag.full_docs, rag.text_chunks, rag.doc_status, rag.chunks_vdb, rag.entities_vdb,
+                    rag.relationships_vdb, rag.chunk_entity_relation_graph):
+        await storage.index_done_callback()
+        # Локальные хранилища (moduls/local_storage.py) дополнительно уплотняют свои файлы
+        if hasattr(storage, "compact"):
+            await storage.compact()
+
+    after = storage_size(rag.working_dir)
+    logging.info(f"Compacted storage {rag.working_dir}: removed {removed}, size {before} -> {after} bytes")
+    removed["bytes_freed"] = before - after
+    return removed
+
+
+async def _main(storage_dir: str):
+    from moduls.lightrag_module import build_rag
+
+    rag = await build_rag(storage_dir)
+    try:
+        print(await compact_storage(rag))
+    finally:
+        await rag.finalize_storages()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1]))
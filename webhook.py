@@ -0,0 +1,370 @@
+# Файл: webhook.py
+"""
+Режим webhook с несколькими процессами-воркерами (альтернатива bot.py).
+
+bot.py получает апдейты long polling в одном asyncio-цикле, и этот же цикл
+занят разбором PDF и эмбеддингами: бот упирается в одно ядро, а медленный
+апдейт задерживает всех. Здесь:
+  * front-процесс (aiohttp) принимает апдейты Telegram на WEBHOOK_PATH,
+    проверяет секрет (заголовок X-Telegram-Bot-Api-Secret-Token) и сразу
+    отвечает 200;
+  * апдейт передается одному из WEBHOOK_WORKERS процессов по пользователю
+    (user_id % WEBHOOK_WORKERS). Все апдейты пользователя обрабатывает один
+    процесс: этого требуют кэш FSM (moduls/fsm_storage.py), пул RAG и
+    очередь загрузки (каждый процесс выполняет задания своих пользователей);
+  * внутри воркера апдейты одного пользователя выполняются строго по
+    порядку, разных пользователей - параллельно (не больше
+    WEBHOOK_WORKER_CONCURRENCY одновременно);
+  * упавший воркер перезапускается с той же очередью апдейтов (апдейты,
+    которые он успел взять, теряются);
+  * SIGTERM/SIGINT: front перестает принимать апдейты (503 - Telegram
+    повторит их позже), воркеры дорабатывают уже принятые апдейты и
+    останавливают службы бота (on_shutdown), не дольше
+    WEBHOOK_DRAIN_TIMEOUT секунд.
+
+Каждый воркер загружает свою копию модели эмбеддингов и свои пулы
+извлечения текста - число воркеров ограничено памятью машины.
+
+Запуск:
+    WEBHOOK_URL=https://bot.example.com WEBHOOK_SECRET=... python webhook.py
+Без WEBHOOK_URL вебхук не регистрируется (например, если это уже сделано).
+TELEGRAM_API_URL - свой сервер Bot API (локальный telegram-bot-api или
+заглушка bench/replay_updates.py). WEBHOOK_RECORD_FILE - файл JSONL, куда
+записываются принятые апдейты для последующего воспроизведения.
+"""
+import asyncio
+import functools
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Dict, Hashable, List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_WORKER_CONCURRENCY = int(os.getenv("WEBHOOK_WORKER_CONCURRENCY", "64"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "60"))
+WEBHOOK_RECORD_FILE = os.getenv("WEBHOOK_RECORD_FILE", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Фабрика диспетчера воркера ("модуль:функция")
+DEFAULT_DISPATCHER_FACTORY = "bot:create_dispatcher"
+
+_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_SUPERVISE_INTERVAL = 1.0
+_QUEUE_POLL_INTERVAL = 1.0
+_IDLE = object()
+
+
+# --- Маршрутизация ---
+
+def update_user_id(update: dict) -> Optional[int]:
+    """Пользователь (или чат), от которого пришел апдейт; None, если его нет."""
+    for name, event in update.items():
+        if name == "update_id" or not isinstance(event, dict):
+            continue
+        for field in ("from", "user"):
+            user = event.get(field)
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def worker_for(update: dict, workers: int) -> int:
+    """Номер воркера апдейта: один и тот же для всех апдейтов пользователя."""
+    user_id = update_user_id(update)
+    return (user_id if user_id is not None else update.get("update_id", 0)) % workers
+
+
+def owns_user(user_id: int, worker_index: int, workers: int) -> bool:
+    return user_id % workers == worker_index
+
+
+def _make_bot(token: str, api_url: str = "") -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None
+    return Bot(token=token, session=session)
+
+
+def _load_factory(path: str):
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+# --- Воркер ---
+
+class UpdateFeeder:
+    """Передает апдейты диспетчеру: по порядку для каждого пользователя, параллельно для разных."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency: int = WEBHOOK_WORKER_CONCURRENCY):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.processed = 0
+        self.failed = 0
+
+    async def submit(self, update: dict):
+        """Ставит апдейт в обработку; ждет, если в работе уже concurrency апдейтов."""
+        # Слот занимается до создания задачи: ожидающий предшественника апдейт
+        # держит слот, но голова каждой цепочки уже выполняется, взаимной блокировки нет
+        await self._slots.acquire()
+        key = update_user_id(update)
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._process(update, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _process(self, update: dict, previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            result = await self.dispatcher.feed_raw_update(self.bot, update)
+            # Ответ методом API (как в webhook aiogram) выполняется отдельным запросом
+            if isinstance(result, TelegramMethod):
+                await self.bot(result)
+            self.processed += 1
+        except Exception as e:
+            # Подробности уже записал диспетчер
+            logging.warning(f"Update {update.get('update_id')} failed: {e!r}")
+            self.failed += 1
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        """Дожидается обработки всех переданных апдейтов."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+def _next_update(updates: multiprocessing.Queue):
+    try:
+        return updates.get(timeout=_QUEUE_POLL_INTERVAL)
+    except queue.Empty:
+        return _IDLE
+
+
+async def _run_worker(index: int, workers: int, updates: multiprocessing.Queue, ready, factory_path: str,
+                      token: str, api_url: str):
+    bot = _make_bot(token, api_url)
+    dispatcher = _load_factory(factory_path)()
+    lifecycle = {**dispatcher.workflow_data, "bot": bot, "bots": [bot], "dispatcher": dispatcher,
+                 "worker_index": index, "owns_user": functools.partial(owns_user, worker_index=index, workers=workers)}
+    await dispatcher.emit_startup(**lifecycle)
+    ready.set()
+    feeder = UpdateFeeder(dispatcher, bot)
+    loop = asyncio.get_running_loop()
+    parent = os.getppid()
+    logging.info(f"Webhook worker {index}/{workers} started (pid {os.getpid()})")
+    try:
+        while True:
+            update = await loop.run_in_executor(None, _next_update, updates)
+            if update is None:
+                break
+            if update is _IDLE:
+                # front завершился аварийно: дорабатываем принятое и выходим
+                if os.getppid() != parent:
+                    logging.warning(f"Webhook worker {index}: front process is gone, stopping")
+                    break
+                continue
+            await feeder.submit(update)
+        started = time.perf_counter()
+        await feeder.drain()
+        logging.info(f"Webhook worker {index} drained in {time.perf_counter() - started:.1f}s: "
+                     f"{feeder.processed} updates processed, {feeder.failed} failed")
+    finally:
+        await dispatcher.emit_shutdown(**lifecycle)
+        await bot.session.close()
+
+
+def _worker_main(index: int, workers: int, updates: multiprocessing.Queue, ready, factory_path: str, token: str,
+                 api_url: str):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    # Остановкой управляет front: сигналы группе процессов (Ctrl+C, systemd) воркер игнорирует
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, workers, updates, ready, factory_path, token, api_url))
+
+
+# --- Front ---
+
+class WebhookFront:
+    """Прием апдейтов по HTTP и распределение их по процессам-воркерам."""
+
+    def __init__(self, token: str, workers: int = WEBHOOK_WORKERS, factory_path: str = DEFAULT_DISPATCHER_FACTORY,
+                 api_url: str = TELEGRAM_API_URL, secret: str = WEBHOOK_SECRET, record_file: str = WEBHOOK_RECORD_FILE):
+        self.token = token
+        self.workers = workers
+        self.factory_path = factory_path
+        self.api_url = api_url
+        self.secret = secret
+        # spawn: воркеры не наследуют состояние front (потоки, сокеты aiohttp)
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        # Воркер выставляет событие после запуска служб бота (on_startup)
+        self._ready = [self._context.Event() for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self._record = open(record_file, "a", encoding="utf-8") if record_file else None
+        self.accepting = False
+        self.received = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        self._ready[index].clear()
+        process = self._context.Process(
+            target=_worker_main, name=f"bot-worker-{index}",
+            args=(index, self.workers, self._queues[index], self._ready[index], self.factory_path, self.token,
+                  self.api_url))
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self.accepting = True
+        logging.info(f"Webhook front started {self.workers} workers")
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(_SECRET_HEADER) != self.secret:
+            return web.Response(status=401)
+        if not self.accepting:
+            self.rejected += 1
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if self._record is not None:
+            self._record.write(json.dumps(update, ensure_ascii=False) + "\n")
+            self._record.flush()
+        self._queues[worker_for(update, self.workers)].put(update)
+        self.received += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        queued = []
+        for updates in self._queues:
+            try:
+                queued.append(updates.qsize())
+            except NotImplementedError:  # macOS
+                queued.append(None)
+        return {
+            "accepting": self.accepting,
+            "workers_alive": sum(1 for process in self._processes if process is not None and process.is_alive()),
+            "workers_ready": sum(1 for ready in self._ready if ready.is_set()),
+            "queued": queued,
+            "received": self.received,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+        }
+
+    async def supervise(self):
+        """Перезапускает упавшие воркеры, пока front принимает апдейты."""
+        while self.accepting:
+            await asyncio.sleep(_SUPERVISE_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if self.accepting and process is not None and not process.is_alive():
+                    logging.error(f"Webhook worker {index} exited with code {process.exitcode}, restarting")
+                    self.restarts += 1
+                    self._spawn(index)
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Останавливает воркеры после обработки уже принятых апдейтов."""
+        self.accepting = False
+        for updates in self._queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.error(f"Webhook worker {index} did not finish in {timeout:.0f}s, terminating")
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+            self._ready[index].clear()
+        if self._record is not None:
+            self._record.close()
+            self._record = None
+
+
+async def serve(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, workers: int = WEBHOOK_WORKERS,
+                factory_path: str = DEFAULT_DISPATCHER_FACTORY, token: Optional[str] = None,
+                api_url: str = TELEGRAM_API_URL, secret: str = WEBHOOK_SECRET,
+                drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT, stop: Optional[asyncio.Event] = None) -> dict:
+    """
+    Запускает front и воркеры и работает до сигнала остановки (или stop.set()).
+    Возвращает статистику front после остановки.
+    """
+    if token is None:
+        from config import BOT_TOKEN
+        token = BOT_TOKEN
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+    front = WebhookFront(token, workers, factory_path, api_url, secret)
+    front.start()
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, front.handle_update)
+    app.router.add_get("/health", front.handle_health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Webhook front listening on {host}:{port}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        bot = _make_bot(token, api_url)
+        try:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret or None)
+        finally:
+            await bot.session.close()
+
+    supervisor = asyncio.create_task(front.supervise())
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Webhook front stopping: draining workers")
+        supervisor.cancel()
+        front.accepting = False
+        started = time.perf_counter()
+        await runner.cleanup()
+        await front.drain(drain_timeout)
+        logging.info(f"Webhook front stopped, drain took {time.perf_counter() - started:.1f}s")
+    return front.stats()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())